@@ -14001,6 +14001,27 @@ ALTER TABLE ONLY public.django_session
 CREATE INDEX film_work_creation_rating_idx ON content.film_work USING btree (creation_date, rating);
 
 
+--
+-- Name: film_work_modified_id_idx; Type: INDEX; Schema: content; Owner: postgres
+--
+
+CREATE INDEX film_work_modified_id_idx ON content.film_work USING btree (modified, id);
+
+
+--
+-- Name: genre_modified_id_idx; Type: INDEX; Schema: content; Owner: postgres
+--
+
+CREATE INDEX genre_modified_id_idx ON content.genre USING btree (modified, id);
+
+
+--
+-- Name: person_modified_id_idx; Type: INDEX; Schema: content; Owner: postgres
+--
+
+CREATE INDEX person_modified_id_idx ON content.person USING btree (modified, id);
+
+
 --
 -- Name: film_work_genre_idx; Type: INDEX; Schema: content; Owner: postgres
 --
@@ -14015,6 +14036,20 @@ CREATE UNIQUE INDEX film_work_genre_idx ON content.genre_film_work USING btree (
 CREATE UNIQUE INDEX film_work_person_role_idx ON content.person_film_work USING btree (film_work_id, person_id, role);
 
 
+--
+-- Name: person_film_work_person_idx; Type: INDEX; Schema: content; Owner: postgres
+--
+
+CREATE INDEX person_film_work_person_idx ON content.person_film_work USING btree (person_id, film_work_id);
+
+
+--
+-- Name: genre_film_work_genre_idx; Type: INDEX; Schema: content; Owner: postgres
+--
+
+CREATE INDEX genre_film_work_genre_idx ON content.genre_film_work USING btree (genre_id, film_work_id);
+
+
 --
 -- Name: auth_group_name_a6ea08ec_like; Type: INDEX; Schema: public; Owner: postgres
 --
@@ -14106,6 +14141,177 @@ CREATE INDEX django_session_expire_date_a5c62663 ON public.django_session USING
 CREATE INDEX django_session_session_key_c0390e0f_like ON public.django_session USING btree (session_key varchar_pattern_ops);
 
 
+--
+-- Name: notify_etl_change(); Type: FUNCTION; Schema: content; Owner: postgres
+--
+
+CREATE FUNCTION content.notify_etl_change() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    PERFORM pg_notify('etl_changes', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION content.notify_etl_change() OWNER TO postgres;
+
+--
+-- Name: film_work film_work_notify_etl_change; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER film_work_notify_etl_change AFTER INSERT OR DELETE OR UPDATE ON content.film_work FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl_change();
+
+
+--
+-- Name: genre genre_notify_etl_change; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER genre_notify_etl_change AFTER INSERT OR DELETE OR UPDATE ON content.genre FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl_change();
+
+
+--
+-- Name: genre_film_work genre_film_work_notify_etl_change; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER genre_film_work_notify_etl_change AFTER INSERT OR DELETE OR UPDATE ON content.genre_film_work FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl_change();
+
+
+--
+-- Name: person person_notify_etl_change; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER person_notify_etl_change AFTER INSERT OR DELETE OR UPDATE ON content.person FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl_change();
+
+
+--
+-- Name: person_film_work person_film_work_notify_etl_change; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER person_film_work_notify_etl_change AFTER INSERT OR DELETE OR UPDATE ON content.person_film_work FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl_change();
+
+
+--
+-- Name: person_film_work_changes; Type: TABLE; Schema: content; Owner: postgres
+--
+
+CREATE TABLE content.person_film_work_changes (
+    seq bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    person_id uuid NOT NULL,
+    film_work_id uuid NOT NULL,
+    changed timestamp with time zone DEFAULT now() NOT NULL,
+    xid xid8 DEFAULT pg_current_xact_id() NOT NULL
+);
+
+
+ALTER TABLE content.person_film_work_changes OWNER TO postgres;
+
+--
+-- Name: person_film_work_changes_xid_seq_idx; Type: INDEX; Schema: content; Owner: postgres
+--
+
+-- ETL читает журнал по (xid, seq) только завершённых транзакций (xid < xmin снимка)
+CREATE INDEX person_film_work_changes_xid_seq_idx ON content.person_film_work_changes USING btree (xid, seq);
+
+--
+-- Name: log_person_film_work_change(); Type: FUNCTION; Schema: content; Owner: postgres
+--
+
+CREATE FUNCTION content.log_person_film_work_change() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        INSERT INTO content.person_film_work_changes (person_id, film_work_id) VALUES (OLD.person_id, OLD.film_work_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO content.person_film_work_changes (person_id, film_work_id) VALUES (NEW.person_id, NEW.film_work_id);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION content.log_person_film_work_change() OWNER TO postgres;
+
+--
+-- Name: person_film_work person_film_work_log_change; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER person_film_work_log_change AFTER INSERT OR DELETE OR UPDATE ON content.person_film_work FOR EACH ROW EXECUTE FUNCTION content.log_person_film_work_change();
+
+
+--
+-- Name: tombstone; Type: TABLE; Schema: content; Owner: postgres
+--
+
+CREATE TABLE content.tombstone (
+    seq bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    table_name text NOT NULL,
+    doc_id text NOT NULL,
+    deleted timestamp with time zone DEFAULT now() NOT NULL,
+    xid xid8 DEFAULT pg_current_xact_id() NOT NULL,
+    film_work_ids uuid[]
+);
+
+
+ALTER TABLE content.tombstone OWNER TO postgres;
+
+--
+-- Name: tombstone_xid_seq_idx; Type: INDEX; Schema: content; Owner: postgres
+--
+
+-- ETL читает надгробия по (xid, seq) только завершённых транзакций (xid < xmin снимка)
+CREATE INDEX tombstone_xid_seq_idx ON content.tombstone USING btree (xid, seq);
+
+--
+-- Name: record_tombstone(); Type: FUNCTION; Schema: content; Owner: postgres
+--
+
+CREATE FUNCTION content.record_tombstone() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    -- TG_ARGV[0]: колонка, значение которой служит _id документа в Elasticsearch.
+    -- film_work_ids: фильмы удаляемой персоналии или жанра, их документы пересобираются.
+    -- Связи удаляются каскадом, поэтому для person и genre триггер срабатывает BEFORE DELETE.
+    INSERT INTO content.tombstone (table_name, doc_id, film_work_ids) VALUES (
+        TG_TABLE_NAME,
+        to_jsonb(OLD) ->> TG_ARGV[0],
+        CASE TG_TABLE_NAME
+            WHEN 'person' THEN ARRAY(SELECT film_work_id FROM content.person_film_work WHERE person_id = OLD.id)
+            WHEN 'genre' THEN ARRAY(SELECT film_work_id FROM content.genre_film_work WHERE genre_id = OLD.id)
+        END
+    );
+    RETURN OLD;
+END;
+$$;
+
+
+ALTER FUNCTION content.record_tombstone() OWNER TO postgres;
+
+--
+-- Name: film_work film_work_tombstone; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER film_work_tombstone AFTER DELETE ON content.film_work FOR EACH ROW EXECUTE FUNCTION content.record_tombstone('id');
+
+
+--
+-- Name: genre genre_tombstone; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER genre_tombstone BEFORE DELETE ON content.genre FOR EACH ROW EXECUTE FUNCTION content.record_tombstone('name');
+
+
+--
+-- Name: person person_tombstone; Type: TRIGGER; Schema: content; Owner: postgres
+--
+
+CREATE TRIGGER person_tombstone BEFORE DELETE ON content.person FOR EACH ROW EXECUTE FUNCTION content.record_tombstone('id');
+
+
 --
 -- Name: genre_film_work fk_gfw_film_work_id; Type: FK CONSTRAINT; Schema: content; Owner: postgres
 --
@@ -0,0 +1,67 @@
+from collections import Counter
+
+from metrics import ADAPTIVE_DECISIONS, BATCH_SIZE
+from state import *
+from settings import *
+
+
+class AdaptiveBatchController:
+    """Подбор размера пачки и паузы простоя по измеренным задержкам.
+
+    Размер пачки уменьшается вдвое при отказах Elasticsearch (429) и на четверть,
+    если пачка обрабатывается заметно дольше settings.target_batch_latency.
+    Полная пачка, обработанная быстрее половины целевого времени, удваивается.
+    Пауза простоя растёт экспоненциально до settings.max_idle_sleep_time
+    и сбрасывается, как только появляются новые данные.
+
+    При settings.adaptive_batching = False размер пачки и пауза постоянны.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.enabled = settings.adaptive_batching
+        self.batch_size = settings.batch_size
+        self.idle_sleep_time = float(settings.default_sleep_time)
+        self.last_latency = 0.0
+        # Счётчики решений контроллера: grow, shrink_latency, shrink_rejected, idle_backoff
+        self.decisions = Counter()
+        BATCH_SIZE.labels(name).set(self.batch_size)
+
+    def _decide(self, decision: str) -> None:
+        self.decisions[decision] += 1
+        ADAPTIVE_DECISIONS.labels(self.name, decision).inc()
+
+    def _resize(self, batch_size: int, decision: str, reason: str) -> None:
+        batch_size = max(settings.min_batch_size, min(settings.max_batch_size, batch_size))
+        if batch_size == self.batch_size:
+            return
+        logger.info(f"Размер пачки {self.name}: {self.batch_size} -> {batch_size} ({reason})")
+        self.batch_size = batch_size
+        BATCH_SIZE.labels(self.name).set(batch_size)
+        self._decide(decision)
+
+    def record_batch(self, size: int, extract_time: float, load_time: float, rejected: int = 0) -> None:
+        """Учесть обработанную пачку: size записей, время extract и load в секундах, число отказов 429."""
+        self.idle_sleep_time = float(settings.default_sleep_time)
+        self.last_latency = extract_time + load_time
+        if not self.enabled:
+            return
+
+        target = settings.target_batch_latency
+        if rejected:
+            self._resize(self.batch_size // 2, "shrink_rejected", f"{rejected} отказ(ов) 429")
+        elif self.last_latency > target * 1.5:
+            self._resize(self.batch_size * 3 // 4, "shrink_latency",
+                         f"extract {extract_time:.2f} с + load {load_time:.2f} с > {target} с")
+        elif self.last_latency < target / 2 and size >= self.batch_size:
+            self._resize(self.batch_size * 2, "grow",
+                         f"extract {extract_time:.2f} с + load {load_time:.2f} с < {target / 2} с")
+
+    def next_idle_sleep(self) -> float:
+        """Пауза перед следующим опросом источника, когда новых данных нет."""
+        sleep_time = self.idle_sleep_time
+        if self.enabled and sleep_time < settings.max_idle_sleep_time:
+            self.idle_sleep_time = min(sleep_time * 2, float(settings.max_idle_sleep_time))
+            self._decide("idle_backoff")
+            logger.debug(f"Пауза простоя {self.name}: {sleep_time:.0f} -> {self.idle_sleep_time:.0f} с")
+        return sleep_time
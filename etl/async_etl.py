@@ -0,0 +1,228 @@
+import asyncio
+import re
+from datetime import datetime
+from typing import Awaitable, Callable, Optional, Tuple
+
+from transform_data import *
+from load_data import *
+from adaptive import AdaptiveBatchController
+from create_index import *
+from dead_letter import DeadLetterQueue
+from mappings import FILMWORK_MAPPING, GENRES_MAPPING, PERSONS_MAPPING
+from metrics import observe_batch, observe_checkpoint
+from notify import wait_for_changes
+from queries import *
+from state import AsyncRedisStorage, AsyncState, backfill_key, checkpoint_key, logger, previous_layout_checkpoint
+
+
+def to_asyncpg_query(query: str) -> str:
+    """Замена плейсхолдеров psycopg2 (%s) на позиционные параметры asyncpg ($1, $2, ...)."""
+    counter = iter(range(1, query.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", query)
+
+
+def to_pg_timestamp(value: str) -> datetime:
+    """Дата контрольной точки для колонки timestamp without time zone.
+
+    asyncpg, в отличие от psycopg2, не принимает строки вместо дат.
+    """
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+async def extract_batches(pg_conn: asyncpg.Connection, entity: str, query: str,
+                          position: Tuple[str, Optional[str]], queue: asyncio.Queue,
+                          on_caught_up: Callable[[], Awaitable[bool]],
+                          controller: AdaptiveBatchController) -> None:
+    """Extract: потоковое чтение изменённых записей и передача пачек в очередь.
+
+    Позиция чтения хранится в памяти и опережает сохранённую контрольную точку:
+    пока следующая пачка извлекается, предыдущая ещё загружается в Elasticsearch.
+    Ограниченный размер очереди не даёт extract уйти далеко вперёд загрузки.
+    Когда новых записей нет, вызывается on_caught_up; если он вернул True, ожидание пропускается.
+    """
+    query = to_asyncpg_query(query)
+    while True:
+        last_synced_time, last_id = position
+        processed = 0
+        async with pg_conn.transaction():
+            cursor = await pg_conn.cursor(query, to_pg_timestamp(last_synced_time), last_id or MIN_UUID)
+            while True:
+                started = time.perf_counter()
+                records = await cursor.fetch(controller.batch_size)
+                if not records:
+                    break
+                await queue.put((records, time.perf_counter() - started))
+                position = (records[-1]["modified"].isoformat(), records[-1]["id"])
+                processed += len(records)
+
+        if not processed:
+            observe_checkpoint(entity, None)
+        if not processed and not await on_caught_up():
+            await asyncio.to_thread(wait_for_changes, entity, controller.next_idle_sleep())
+
+
+async def load_batches(es_client: AsyncElasticsearch, state: AsyncState, entity: str,
+                       index_name: str, sync_time_key: str,
+                       transform: Callable[[List[dict]], Generator[dict, None, None]],
+                       queue: asyncio.Queue, controller: AdaptiveBatchController,
+                       dead_letters: Optional[DeadLetterQueue] = None) -> None:
+    """Transform и load пачек из очереди с сохранением контрольной точки после загрузки.
+
+    С dead_letters недоставленные документы ставятся в очередь повторов, как в etl.load_stream.
+    """
+    while True:
+        records, extract_time = await queue.get()
+        try:
+            started = time.perf_counter()
+            transformed_data = list(transform(records, index_name))
+            transform_time = time.perf_counter() - started
+            result = await async_load_data_to_es(es_client, transformed_data)
+            if dead_letters is not None:
+                await asyncio.to_thread(dead_letters.track, transformed_data, result)
+            controller.record_batch(len(records), extract_time + transform_time, result.duration, result.rejected)
+            observe_batch(entity, len(records), extract_time, transform_time, result)
+
+            new_last_synced_time = records[-1]["modified"].isoformat()
+            await state.set_checkpoint(sync_time_key, new_last_synced_time, records[-1]["id"])
+            observe_checkpoint(entity, records[-1]["modified"])
+            if queue.empty():
+                # Очередь разобрана: накопленная контрольная точка не должна ждать следующих пачек
+                await state.flush()
+            logger.debug(
+                f"Обработано и загружено {len(records)} записей {entity}. "
+                f"Последняя дата: {new_last_synced_time}, id: {records[-1]['id']}")
+        finally:
+            queue.task_done()
+
+
+async def async_etl_process(entity: str, mapping: dict, alias: str, query: str,
+                            transform: Callable[[List[dict]], Generator[dict, None, None]]) -> None:
+    """Асинхронный ETL процесс сущности.
+
+    extract и transform + load работают как отдельные задачи, связанные
+    ограниченной очередью размера settings.async_queue_size.
+    """
+    # Управление индексами выполняется редко, для него достаточно синхронного клиента
+    def prepare() -> Tuple[str, bool]:
+        sync_es_client = get_shared_es_client()
+        prepared_index = prepare_index(sync_es_client, mapping, alias)
+        return prepared_index, live_index(sync_es_client, alias) == prepared_index
+
+    def enable_backfill() -> Optional[str]:
+        sync_es_client = get_shared_es_client()
+        if not can_enable_backfill_mode(sync_es_client, alias, index_name):
+            return None
+        return enable_backfill_mode(sync_es_client, index_name)
+
+    def finish_backfill_and_promote() -> None:
+        sync_es_client = get_shared_es_client()
+        if number_of_replicas:
+            disable_backfill_mode(sync_es_client, index_name, number_of_replicas)
+        if not promoted:
+            promote_index(sync_es_client, alias, index_name)
+
+    index_name, promoted = await asyncio.to_thread(prepare)
+    number_of_replicas = None
+    queue = asyncio.Queue(maxsize=settings.async_queue_size)
+
+    async def on_caught_up() -> bool:
+        # ETL догнал источник: дожидаемся загрузки очереди, возвращаем настройки
+        # near-real-time и переключаем поиск на новую версию индекса
+        nonlocal number_of_replicas, promoted
+        if not number_of_replicas and promoted:
+            return False
+        await queue.join()
+        await asyncio.to_thread(finish_backfill_and_promote)
+        await state.set_state(backfill_key(index_name), "")
+        number_of_replicas, promoted = None, True
+        return True
+
+    pg_conn = await get_async_pg_connection()
+    es_client = await get_async_es_client()
+    redis_conn = await get_async_redis_connection()
+    # Очередь недоставленных общая с процессами на потоках и работает через синхронный клиент Redis
+    dead_letters = (DeadLetterQueue(await asyncio.to_thread(get_redis_connection))
+                    if settings.dead_letter_queue else None)
+    state = AsyncState(AsyncRedisStorage(redis_adapter=redis_conn),
+                       settings.checkpoint_flush_batches, settings.checkpoint_flush_interval)
+    try:
+        sync_time_key = checkpoint_key(entity, alias, index_name)
+        position = await state.get_checkpoint(sync_time_key)
+        if position is None:
+            # Процессы движка threads в шардированном режиме хранили контрольные точки партиций
+            position = previous_layout_checkpoint(
+                await state.storage.retrieve_state(), entity, alias, index_name, 1)
+            if position is not None:
+                await state.set_checkpoint(sync_time_key, *position)
+                await state.flush()
+                logger.info(f"Контрольная точка {sync_time_key} перенесена из прежней раскладки партиций: {position[0]}")
+        if position is None:
+            position = (settings.default_sync_time, None)
+            logger.debug(
+                f"Ключ состояния {sync_time_key} для {entity} не найден, использовано значение по умолчанию: {position[0]}")
+
+        number_of_replicas = await state.get_state(backfill_key(index_name))
+        if not number_of_replicas and position[0] == settings.default_sync_time:
+            number_of_replicas = await asyncio.to_thread(enable_backfill)
+            if number_of_replicas:
+                await state.set_state(backfill_key(index_name), number_of_replicas)
+
+        controller = AdaptiveBatchController(entity)
+        # При ошибке в одной из задач TaskGroup отменяет вторую
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(
+                extract_batches(pg_conn, entity, query, position, queue, on_caught_up, controller))
+            task_group.create_task(
+                load_batches(es_client, state, entity, index_name, sync_time_key, transform, queue, controller,
+                             dead_letters))
+    except Exception as e:
+        logger.error(f"Ошибка во время асинхронного ETL процесса {entity}: {str(e)}")
+    finally:
+        await pg_conn.close()
+        await es_client.close()
+        await redis_conn.close()
+
+
+# Зарегистрированные процессы (scheduler.pipeline), которые asyncio-движок выполняет сам
+ASYNC_PIPELINES = ("filmwork", "genres", "persons")
+
+
+def warn_unsupported_settings() -> None:
+    """Предупредить о настройках, которые асинхронные процессы сущностей не поддерживают."""
+    unsupported = {
+        "dedup_documents": "документы загружаются без пропуска неизменённых",
+        "propagate_deletes": "документы строк, удалённых после чтения, не проверяются после загрузки",
+    }
+    for name, consequence in unsupported.items():
+        if getattr(settings, name):
+            logger.warning(f"{name} не поддерживается процессами {', '.join(ASYNC_PIPELINES)} движка asyncio: "
+                           f"{consequence}")
+    if settings.persons_movies_mode == "incremental":
+        logger.warning("persons_movies_mode = incremental: процесс persons движка asyncio загружает полные документы, "
+                       "частичные обновления movies выполняет только процесс persons_movies")
+
+
+async def async_main() -> None:
+    """Запуск ETL процессов сущностей в одном цикле событий.
+
+    В шардированном режиме filmwork выполняют партиции на потоках (см. main.dedicated_tasks).
+    """
+    warn_unsupported_settings()
+    if settings.filmwork_source_mode == "postgres":
+        filmwork_query, filmwork_transform = FILMWORK_DOCUMENT_QUERY, transform_filmwork_documents
+    else:
+        filmwork_query, filmwork_transform = FILMWORK_QUERY, transform_filmwork
+    processes = [
+        async_etl_process('genres', GENRES_MAPPING, settings.genres_index_name, GENRES_QUERY, transform_genres),
+        async_etl_process('persons', PERSONS_MAPPING, settings.persons_index_name, PERSONS_QUERY,
+                          transform_persons),
+    ]
+    if settings.filmwork_partitions <= 1:
+        processes.append(async_etl_process('filmwork', FILMWORK_MAPPING, settings.filmwork_index_name,
+                                           filmwork_query, filmwork_transform))
+    await asyncio.gather(*processes)
+    logger.info("Все асинхронные ETL процессы завершены.")
+
+
+if __name__ == "__main__":
+    asyncio.run(async_main())
@@ -0,0 +1,103 @@
+"""Байты по сети и CPU сериализации bulk для документов movies: json против orjson, со сжатием gzip и без.
+
+Для каждого варианта settings.es_serializer / settings.es_http_compress:
+    serialize_cpu — CPU на кодирование тела bulk (строка метаданных и _source на документ);
+    gzip_cpu      — CPU на сжатие тела так же, как это делает клиент (gzip.compress);
+    body_bytes    — размер тела до сжатия, wire_bytes — переданный по сети;
+    load_seconds  — load_data_to_es в заглушку Elasticsearch (stub_es) целиком.
+Значения приводятся на 10 тыс. документов.
+
+Запуск из каталога etl: python benchmarks/bench_es_transport.py [--films 10000] [--repeat 5] [--output file.json]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import film_batches  # noqa: E402
+from stub_es import StubElasticsearch  # noqa: E402
+
+from elasticsearch import Elasticsearch  # noqa: E402
+
+from get_connections import get_serializers  # noqa: E402
+from load_data import load_data_to_es  # noqa: E402
+from transform_data import transform_filmwork  # noqa: E402
+from settings import settings  # noqa: E402
+
+PER_DOCS = 10_000
+
+
+def bulk_body(serializer, actions) -> bytes:
+    buffer = bytearray()
+    for action in actions:
+        buffer += serializer.dumps({"index": {"_index": action["_index"], "_id": action["_id"]}})
+        buffer += b"\n"
+        buffer += serializer.dumps(action["_source"])
+        buffer += b"\n"
+    return bytes(buffer)
+
+
+def best_cpu(function, repeat: int) -> float:
+    """Минимальное процессорное время из repeat запусков."""
+    times = []
+    for _ in range(repeat):
+        started = time.process_time()
+        function()
+        times.append(time.process_time() - started)
+    return min(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--films", type=int, default=PER_DOCS)
+    parser.add_argument("--batch-size", type=int, default=settings.es_bulk_chunk_size)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="файл результатов JSON")
+    args = parser.parse_args()
+
+    actions = [action for records in film_batches(args.films, args.batch_size)
+               for action in transform_filmwork(records, settings.filmwork_index_name)]
+    scale = PER_DOCS / len(actions)
+
+    results = []
+    with StubElasticsearch() as stub:
+        for serializer_name in ("json", "orjson"):
+            settings.es_serializer = serializer_name
+            serializers = get_serializers()
+            serializer = serializers["application/json"]
+            body = bulk_body(serializer, actions)
+            serialize_cpu = best_cpu(lambda: bulk_body(serializer, actions), args.repeat)
+            for compress in (False, True):
+                gzip_cpu = best_cpu(lambda: gzip.compress(body), args.repeat) if compress else 0.0
+                es_client = Elasticsearch(stub.url, serializers=serializers, http_compress=compress)
+                sent = stub.bytes
+                started = time.perf_counter()
+                for start in range(0, len(actions), args.batch_size):
+                    load_data_to_es(es_client, actions[start:start + args.batch_size])
+                load_seconds = time.perf_counter() - started
+                es_client.close()
+                results.append({
+                    "serializer": serializer_name,
+                    "http_compress": compress,
+                    "serialize_cpu": round(serialize_cpu * scale, 4),
+                    "gzip_cpu": round(gzip_cpu * scale, 4),
+                    "body_bytes": round(len(body) * scale),
+                    "wire_bytes": round((stub.bytes - sent) * scale),
+                    "load_seconds": round(load_seconds * scale, 4),
+                })
+                print(json.dumps(results[-1]))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"documents": len(actions), "per_documents": PER_DOCS, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    from state import logger
+    import logging
+
+    logger.setLevel(logging.INFO)
+    main()
@@ -0,0 +1,66 @@
+"""CPU на 10 тыс. документов movies: сборка _source в Python против готового JSON из PostgreSQL.
+
+Python-путь: разбор json_agg персоналий (как psycopg2 для колонки json), transform_filmwork
+и сериализация _source в bulk. Postgres-путь: строка документа только кодируется в байты.
+
+Запуск из каталога etl: python benchmarks/bench_source_json.py [--films 10000] [--cast 40]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_transform import Row, make_records  # noqa: E402
+
+from elastic_transport import JsonSerializer  # noqa: E402
+from transform_data import transform_filmwork, transform_filmwork_documents  # noqa: E402
+
+
+def cpu_time(function, repeat: int) -> float:
+    """Минимальное процессорное время выполнения function из repeat запусков."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.process_time()
+        function()
+        best = min(best, time.process_time() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--films", type=int, default=10000)
+    parser.add_argument("--cast", type=int, default=40, help="средний размер состава фильма")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    serializer = JsonSerializer()
+    records = make_records(args.films, args.cast)
+    # Строки в том виде, в каком их отдаёт PostgreSQL: персоналии текстом json для Python-пути
+    # и готовый документ для Postgres-пути (id, modified, document)
+    python_rows = [Row(record[:7] + (json.dumps(record[7]),) + record[8:]) for record in records]
+    postgres_rows = [
+        (action["_id"], None, json.dumps(action["_source"], ensure_ascii=False))
+        for action in transform_filmwork(records)
+    ]
+
+    def python_path() -> None:
+        rows = [Row(row[:7] + (json.loads(row[7]),) + row[8:]) for row in python_rows]
+        for action in transform_filmwork(rows):
+            serializer.dumps(action["_source"])
+
+    def postgres_path() -> None:
+        for action in transform_filmwork_documents(postgres_rows):
+            serializer.dumps(action["_source"])
+
+    per_10k = 10000 / args.films
+    results = {}
+    for name, function in (("python", python_path), ("postgres", postgres_path)):
+        results[name] = cpu_time(function, args.repeat) * per_10k
+        print(f"{name:9} {results[name] * 1000:8.1f} мс CPU на 10 тыс. документов")
+    print(f"Экономия CPU: x{results['python'] / results['postgres']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Воспроизводимый бенчмарк этапов ETL фильмов на синтетических данных.
+
+Этапы запускаются по отдельности и целиком:
+    transform — transform_filmwork над пачками datagen.film_batches();
+    load      — load_data_to_es в заглушку Elasticsearch (stub_es) в том же процессе;
+    extract   — extract_data_stream(FILMWORK_QUERY) из PostgreSQL настроек ETL, если он доступен
+                (данные загружаются заранее: python benchmarks/datagen.py --films N --load);
+    e2e       — etl.load_stream: extract (PostgreSQL или синтетический поток), transform и load.
+
+Запуск из каталога etl:
+    python benchmarks/bench_suite.py --scale 1m --stages transform,load,e2e
+Результаты пишутся в JSON (по умолчанию benchmarks/results/<commit>.json) для сравнения между коммитами.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, Iterator, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import SCALES, film_batches  # noqa: E402
+from stub_es import StubElasticsearch  # noqa: E402
+
+from elasticsearch import Elasticsearch  # noqa: E402
+
+from transform_data import transform_filmwork  # noqa: E402
+from settings import settings  # noqa: E402
+from state import logger  # noqa: E402
+
+STAGES = ("extract", "transform", "load", "e2e")
+START_CHECKPOINT = ("1970-01-01", "00000000-0000-0000-0000-000000000000")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def commit_sha() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def measure(rows: int, seconds: float, **extra) -> dict:
+    return {"rows": rows, "seconds": round(seconds, 4),
+            "rows_per_sec": round(rows / seconds, 1) if seconds else None, **extra}
+
+
+def pg_stream(batch_size: int):
+    """Поток пачек FILMWORK_QUERY из PostgreSQL или None, если база недоступна."""
+    import psycopg2
+    from extract_data import extract_data_stream
+    from queries import FILMWORK_QUERY
+
+    # Одна попытка подключения: get_pg_connection повторяет попытки бесконечно
+    try:
+        conn = psycopg2.connect(host=settings.postgres_host, port=settings.postgres_port,
+                                user=settings.postgres_user, password=settings.postgres_password,
+                                database=settings.postgres_db, connect_timeout=5)
+    except psycopg2.OperationalError as e:
+        print(f"PostgreSQL недоступен, этап пропущен: {e}", file=sys.stderr)
+        return None
+    return conn, extract_data_stream(conn, FILMWORK_QUERY, START_CHECKPOINT, batch_size)
+
+
+def bench_extract(args) -> dict:
+    source = pg_stream(args.batch_size)
+    if source is None:
+        return {"skipped": "PostgreSQL недоступен"}
+    conn, stream = source
+    rows = 0
+    started = time.perf_counter()
+    try:
+        for records in stream:
+            rows += len(records)
+            if rows >= args.films:
+                break
+    finally:
+        stream.close()
+        conn.close()
+    return measure(rows, time.perf_counter() - started)
+
+
+def bench_transform(args) -> dict:
+    """Только transform: генерация пачек в замер не входит."""
+    rows, seconds = 0, 0.0
+    for records in film_batches(args.films, args.batch_size, args.seed):
+        started = time.perf_counter()
+        for _ in transform_filmwork(records, settings.filmwork_index_name):
+            pass
+        seconds += time.perf_counter() - started
+        rows += len(records)
+    return measure(rows, seconds)
+
+
+def bench_load(args, es_client: Elasticsearch, stub: StubElasticsearch) -> dict:
+    """Только load: документы готовятся заранее по пачке, в замер входит load_data_to_es."""
+    from load_data import load_data_to_es
+
+    docs, failed, seconds = 0, 0, 0.0
+    requests, sent = stub.requests, stub.bytes
+    for records in film_batches(args.films, args.batch_size, args.seed):
+        actions = list(transform_filmwork(records, settings.filmwork_index_name))
+        started = time.perf_counter()
+        result = load_data_to_es(es_client, actions)
+        seconds += time.perf_counter() - started
+        docs += result.success
+        failed += len(result.failed)
+    return measure(docs, seconds, failed=failed, bulk_requests=stub.requests - requests,
+                   bulk_bytes=stub.bytes - sent)
+
+
+def bench_e2e(args, es_client: Elasticsearch) -> dict:
+    from etl import load_stream
+
+    source = None if args.synthetic else pg_stream(args.batch_size)
+    conn = None
+    if source is None:
+        stream: Iterator[List] = film_batches(args.films, args.batch_size, args.seed)
+        origin = "synthetic"
+    else:
+        conn, stream = source
+        origin = "postgres"
+
+    rows = 0
+    stages = {"extract": 0.0, "transform": 0.0, "load": 0.0}
+    started = time.perf_counter()
+    try:
+        for records, extract_time, transform_time, result in load_stream(
+                es_client, stream, transform_filmwork, settings.filmwork_index_name,
+                parallel_transform=args.parallel_transform):
+            rows += len(records)
+            stages["extract"] += extract_time
+            stages["transform"] += transform_time
+            stages["load"] += result.duration
+    finally:
+        if conn is not None:
+            conn.close()
+    return measure(rows, time.perf_counter() - started, source=origin,
+                   stages={stage: round(seconds, 4) for stage, seconds in stages.items()})
+
+
+def run(args) -> dict:
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise SystemExit(f"Неизвестные этапы: {', '.join(sorted(unknown))}")
+
+    results = {}
+    with StubElasticsearch(reject_rate=args.reject_rate, seed=args.seed) as stub:
+        es_client = Elasticsearch(stub.url)
+        benchmarks: dict[str, Callable[[], dict]] = {
+            "extract": lambda: bench_extract(args),
+            "transform": lambda: bench_transform(args),
+            "load": lambda: bench_load(args, es_client, stub),
+            "e2e": lambda: bench_e2e(args, es_client),
+        }
+        for stage in stages:
+            results[stage] = benchmarks[stage]()
+            print(f"{stage}: {json.dumps(results[stage], ensure_ascii=False)}")
+        es_client.close()
+
+    return {
+        "commit": commit_sha(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "films": args.films, "batch_size": args.batch_size, "seed": args.seed,
+            "reject_rate": args.reject_rate, "es_bulk_mode": settings.es_bulk_mode,
+            "es_bulk_chunk_size": settings.es_bulk_chunk_size, "transform_workers": settings.transform_workers,
+            "parallel_transform": args.parallel_transform,
+        },
+        "stages": results,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--films", type=int, help="число фильмов, вместо --scale")
+    parser.add_argument("--batch-size", type=int, default=settings.batch_size)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default="extract,transform,load,e2e",
+                        help=f"этапы через запятую из {', '.join(STAGES)}")
+    parser.add_argument("--synthetic", action="store_true", help="e2e на синтетическом потоке, без PostgreSQL")
+    parser.add_argument("--parallel-transform", action="store_true",
+                        help="e2e с пулом transform (settings.transform_workers)")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="доля документов, отклоняемых заглушкой с 429")
+    parser.add_argument("--output", help="файл результатов JSON")
+    args = parser.parse_args(argv)
+    # Отчёт о каждой пачке в DEBUG искажает замеры
+    logger.setLevel(logging.INFO)
+    args.films = args.films or SCALES[args.scale]
+
+    report = run(args)
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Микробенчмарк transform_filmwork: однопроходная версия против прежней.
+
+Запуск из каталога etl: python benchmarks/bench_transform.py [--films 10000] [--cast 40]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Подключения не нужны, но Settings требует переменные окружения
+for variable in ("POSTGRES_HOST", "POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB",
+                 "ELASTICSEARCH_HOST", "REDIS_HOST"):
+    os.environ.setdefault(variable, "localhost")
+for variable in ("POSTGRES_PORT", "ELASTICSEARCH_PORT", "REDIS_PORT"):
+    os.environ.setdefault(variable, "0")
+
+from transform_data import transform_filmwork  # noqa: E402
+from settings import settings  # noqa: E402
+
+COLUMNS = ("id", "title", "description", "imdb_rating", "type", "created", "modified", "persons", "genres")
+ROLES = ("actor", "actor", "actor", "writer", "director")
+
+
+class Row(tuple):
+    """Строка с доступом по индексу и по имени колонки, как psycopg2 DictRow."""
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = COLUMNS.index(key)
+        return tuple.__getitem__(self, key)
+
+
+def transform_filmwork_legacy(records):
+    """Прежняя реализация: шесть проходов по персоналиям на каждый фильм."""
+    for record in records:
+        yield {
+            "_index": settings.filmwork_index_name,
+            "_id": record["id"],
+            "_source": {
+                "id": record["id"],
+                "imdb_rating": record["imdb_rating"],
+                "genres": record["genres"],
+                "title": record["title"],
+                "description": record["description"],
+                "directors_names": [
+                    person["person_name"] for person in record["persons"] if person["person_role"] == "director"
+                ],
+                "actors_names": [
+                    person["person_name"] for person in record["persons"] if person["person_role"] == "actor"
+                ],
+                "writers_names": [
+                    person["person_name"] for person in record["persons"] if person["person_role"] == "writer"
+                ],
+                "directors": [
+                    {"id": person["person_id"], "name": person["person_name"]}
+                    for person in record["persons"] if person["person_role"] == "director"
+                ],
+                "actors": [
+                    {"id": person["person_id"], "name": person["person_name"]}
+                    for person in record["persons"] if person["person_role"] == "actor"
+                ],
+                "writers": [
+                    {"id": person["person_id"], "name": person["person_name"]}
+                    for person in record[7] if person["person_role"] == "writer"
+                ],
+            },
+        }
+
+
+def make_records(films: int, cast: int, seed: int = 0):
+    """Синтетические строки FILMWORK_SELECT с cast персоналиями на фильм."""
+    rnd = random.Random(seed)
+    records = []
+    for number in range(films):
+        persons = [
+            {"person_role": rnd.choice(ROLES), "person_id": str(uuid.UUID(int=rnd.getrandbits(128))),
+             "person_name": f"Person {rnd.randrange(100000)}"}
+            for _ in range(rnd.randint(1, cast * 2))
+        ]
+        records.append(Row((
+            str(uuid.UUID(int=rnd.getrandbits(128))), f"Film {number}", "Description " * 20,
+            round(rnd.uniform(1, 10), 1), "movie", None, None, persons, ["Action", "Drama"],
+        )))
+    return records
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--films", type=int, default=10000)
+    parser.add_argument("--cast", type=int, default=40, help="средний размер состава фильма")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records = make_records(args.films, args.cast)
+    assert list(transform_filmwork(records)) == list(transform_filmwork_legacy(records)), "Результаты различаются"
+
+    results = {}
+    for name, transform in (("legacy", transform_filmwork_legacy), ("single_pass", transform_filmwork)):
+        timer = timeit.Timer(lambda: list(transform(records)))
+        results[name] = min(timer.repeat(repeat=args.repeat, number=1))
+        print(f"{name:12} {results[name] * 1000:8.1f} мс на {args.films} фильмов "
+              f"({args.films / results[name]:,.0f} фильмов/с)")
+    print(f"Ускорение: x{results['legacy'] / results['single_pass']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Генератор синтетических данных кинотеки заданного масштаба.
+
+Состав фильма распределён логнормально (медиана около 10 человек, редкие фильмы — до сотен),
+персоналии выбираются из общего пула, поэтому у популярных людей большие фильмографии.
+Генерация детерминирована по seed и идёт пачками, весь набор в памяти не хранится.
+
+Строки для transform: film_batches(). Загрузка в PostgreSQL (схема content из database_dump.sql):
+    python benchmarks/datagen.py --films 1000000 --load
+"""
+import argparse
+import io
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Generator, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_transform import Row  # noqa: E402  (задаёт и переменные окружения для Settings)
+
+SCALES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+GENRES = [
+    "Action", "Adventure", "Animation", "Biography", "Comedy", "Crime", "Documentary", "Drama", "Family",
+    "Fantasy", "History", "Horror", "Music", "Musical", "Mystery", "News", "Reality-TV", "Romance",
+    "Sci-Fi", "Short", "Sport", "Talk-Show", "Thriller", "War", "Western", "Game-Show",
+]
+ROLES = ("actor", "actor", "actor", "actor", "writer", "director")
+EPOCH = datetime(2021, 6, 16, 20, 0, 0)
+
+
+def make_uuid(rnd: random.Random) -> str:
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def cast_size(rnd: random.Random) -> int:
+    """Логнормальный размер состава: медиана ~10, длинный хвост, не больше 500."""
+    return max(1, min(500, int(rnd.lognormvariate(math.log(10), 0.8))))
+
+
+def pool_size(films: int) -> int:
+    """Размер пула персоналий: примерно одна на фильм, но не меньше 1000."""
+    return max(1000, films)
+
+
+def person(number: int, seed: int = 0) -> Tuple[str, str]:
+    """Персоналия пула (id, имя) по номеру: вычисляется, а не хранится, чтобы 10 млн фильмов помещались в память."""
+    return str(uuid.UUID(int=(seed + 1) << 96 | number, version=4)), f"Person {number}"
+
+
+def films(count: int, seed: int = 0) -> Generator[dict, None, None]:
+    """Фильмы с составом и жанрами, упорядоченные по modified, как их читает FILMWORK_QUERY."""
+    rnd = random.Random(seed)
+    persons = pool_size(count)
+    genre_ids = [str(uuid.UUID(int=number + 1)) for number in range(len(GENRES))]
+    for number in range(count):
+        # Популярные персоналии встречаются чаще: квадрат равномерной величины смещает выбор к началу пула
+        cast = {person(int(rnd.random() ** 2 * persons), seed) for _ in range(cast_size(rnd))}
+        modified = EPOCH + timedelta(milliseconds=number)
+        yield {
+            "id": make_uuid(rnd),
+            "title": f"Film {number}",
+            "description": " ".join(f"word{rnd.randrange(5000)}" for _ in range(rnd.randint(5, 60))),
+            "rating": round(rnd.uniform(1, 10), 1),
+            "type": "movie" if rnd.random() < 0.8 else "tv_show",
+            "modified": modified,
+            "persons": [(person_id, name, rnd.choice(ROLES)) for person_id, name in cast],
+            "genres": [(genre_ids[index], GENRES[index]) for index in rnd.sample(range(len(GENRES)), rnd.randint(1, 3))],
+        }
+
+
+def film_batches(count: int, batch_size: int, seed: int = 0) -> Generator[List[Row], None, None]:
+    """Пачки строк в формате FILMWORK_SELECT (как из extract_data_stream) для этапа transform."""
+    batch = []
+    for film in films(count, seed):
+        batch.append(Row((
+            film["id"], film["title"], film["description"], film["rating"], film["type"],
+            film["modified"], film["modified"],
+            [{"person_role": role, "person_id": person_id, "person_name": name}
+             for person_id, name, role in film["persons"]],
+            [name for _, name in film["genres"]],
+        )))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_to_postgres(count: int, seed: int = 0, chunk: int = 10_000) -> None:
+    """Загрузка набора в схему content через COPY (таблицы должны быть пустыми)."""
+    from get_connections import get_pg_connection
+
+    def copy(cursor, table: str, columns: str, lines: List[str]) -> None:
+        if lines:
+            cursor.copy_expert(f"COPY content.{table} ({columns}) FROM STDIN", io.StringIO("".join(lines)))
+
+    conn = get_pg_connection()
+    started = time.perf_counter()
+    try:
+        with conn.cursor() as cursor:
+            now = EPOCH.isoformat()
+            copy(cursor, "genre", "id, name, created, modified",
+                 [f"{uuid.UUID(int=number + 1)}\t{name}\t{now}\t{now}\n" for number, name in enumerate(GENRES)])
+            persons = pool_size(count)
+            for start in range(0, persons, chunk):
+                copy(cursor, "person", "id, full_name, created, modified", [
+                    "{}\t{}\t{now}\t{now}\n".format(*person(number, seed), now=now)
+                    for number in range(start, min(start + chunk, persons))
+                ])
+
+            rnd = random.Random(seed + 2)
+            film_lines, person_links, genre_links = [], [], []
+            for number, film in enumerate(films(count, seed), 1):
+                modified = film["modified"].isoformat()
+                film_lines.append(
+                    f"{film['id']}\t{film['title']}\t{film['description']}\t{film['rating']}\t{film['type']}\t"
+                    f"{modified}\t{modified}\n")
+                person_links.extend(
+                    f"{make_uuid(rnd)}\t{person_id}\t{film['id']}\t{role}\t{modified}\n"
+                    for person_id, _, role in film["persons"])
+                genre_links.extend(
+                    f"{make_uuid(rnd)}\t{genre_id}\t{film['id']}\t{modified}\n" for genre_id, _ in film["genres"])
+                if number % chunk == 0 or number == count:
+                    copy(cursor, "film_work", "id, title, description, rating, type, created, modified", film_lines)
+                    copy(cursor, "person_film_work", "id, person_id, film_work_id, role, created", person_links)
+                    copy(cursor, "genre_film_work", "id, genre_id, film_work_id, created", genre_links)
+                    conn.commit()
+                    film_lines, person_links, genre_links = [], [], []
+                    print(f"\r{number}/{count} фильмов, {time.perf_counter() - started:.0f} с", end="", flush=True)
+        print()
+    finally:
+        conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--films", type=int, help="число фильмов, вместо --scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--load", action="store_true", help="загрузить набор в PostgreSQL из настроек ETL")
+    args = parser.parse_args()
+
+    count = args.films or SCALES[args.scale]
+    if args.load:
+        load_to_postgres(count, args.seed)
+        return
+    sizes = [len(film["persons"]) for film in films(min(count, 100_000), args.seed)]
+    sizes.sort()
+    print(f"Состав фильма: медиана {sizes[len(sizes) // 2]}, p99 {sizes[int(len(sizes) * 0.99)]}, "
+          f"максимум {sizes[-1]}, в среднем {sum(sizes) / len(sizes):.1f}")
+
+
+if __name__ == "__main__":
+    main()
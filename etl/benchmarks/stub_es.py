@@ -0,0 +1,106 @@
+"""Заглушка Elasticsearch в том же процессе: отвечает на _bulk, не индексируя документы.
+
+Позволяет мерить extract/transform/load без кластера: время загрузки складывается из
+сериализации, HTTP и разбора ответа на стороне ETL. reject_rate задаёт долю документов,
+отклоняемых с 429, чтобы нагрузить путь повторной отправки.
+"""
+import gzip
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INFO = {
+    "name": "stub",
+    "cluster_name": "benchmarks",
+    "version": {"number": "8.14.0", "build_flavor": "default"},
+    "tagline": "You Know, for Search",
+}
+# Операции bulk, за строкой которых следует строка с документом
+OPERATIONS_WITH_SOURCE = {"index", "create", "update"}
+
+
+class StubElasticsearch(ThreadingHTTPServer):
+    """HTTP сервер с минимальным API Elasticsearch: GET / и _bulk."""
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, reject_rate: float = 0.0, seed: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), BulkHandler)
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.documents = 0
+        self.bytes = 0  # тела запросов в том виде, в каком переданы по сети (со сжатием)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self) -> "StubElasticsearch":
+        threading.Thread(target=self.serve_forever, name="stub-es", daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class BulkHandler(BaseHTTPRequestHandler):
+    server: StubElasticsearch
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, body: dict, status: int = 200) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        # Клиент elasticsearch-py 8 проверяет, что отвечает именно Elasticsearch
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        self.send_json(INFO)
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        received = len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        if not self.path.split("?")[0].endswith("/_bulk"):
+            self.send_json({"error": f"unsupported {self.path}"}, 400)
+            return
+
+        items = []
+        lines = iter(line for line in body.split(b"\n") if line)
+        for line in lines:
+            operation, metadata = next(iter(json.loads(line).items()))
+            if operation in OPERATIONS_WITH_SOURCE:
+                next(lines, None)
+            with self.server.lock:
+                rejected = self.server.reject_rate and self.server.random.random() < self.server.reject_rate
+            status = 429 if rejected else (200 if operation in ("update", "delete") else 201)
+            item = {"_index": metadata.get("_index"), "_id": metadata.get("_id"), "status": status}
+            if rejected:
+                item["error"] = {"type": "es_rejected_execution_exception", "reason": "stub rejection"}
+            items.append({operation: item})
+
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.documents += len(items)
+            self.server.bytes += received
+        self.send_json({"took": 1, "errors": any("error" in next(iter(item.values())) for item in items),
+                        "items": items})
+
+    do_PUT = do_POST
@@ -1,37 +1,142 @@
+import re
+from typing import List, Optional
+
 from get_connections import *
+from mappings import INDEX_SETTINGS
 from state import *
 
 
-def create_index_with_mapping(es_client: Elasticsearch, mapping, index_name) -> None:
-    """Создание индекса с маппингом в Elasticsearch."""
+def index_versions(es_client: Elasticsearch, alias: str) -> List[str]:
+    """Все версии индекса alias_vN по возрастанию версии.
+
+    Индекс старого формата, созданный под именем alias без версии, считается версией 0.
+    """
+    versions = {}
+    if es_client.indices.exists(index=alias) and not es_client.indices.exists_alias(name=alias):
+        versions[alias] = 0
+    for index_name in es_client.indices.get(index=f"{alias}_v*", ignore_unavailable=True):
+        match = re.fullmatch(rf"{re.escape(alias)}_v(\d+)", index_name)
+        if match:
+            versions[index_name] = int(match.group(1))
+    return sorted(versions, key=versions.get)
+
+
+def live_index(es_client: Elasticsearch, alias: str) -> Optional[str]:
+    """Индекс, на который сейчас указывает alias (или индекс старого формата с именем alias)."""
+    if es_client.indices.exists_alias(name=alias):
+        return next(iter(es_client.indices.get_alias(name=alias)))
+    if es_client.indices.exists(index=alias):
+        return alias
+    return None
+
+
+def prepare_index(es_client: Elasticsearch, mapping: dict, alias: str) -> str:
+    """Подготовка индекса для записи ETL с переключением версий через alias.
+
+    Если маппинг рабочего индекса совпадает с mapping, ETL пишет в него.
+    Иначе запись идёт в новую версию alias_vN (или в уже начатую версию
+    с тем же маппингом), а поиск по alias продолжает работать со старым
+    индексом, пока promote_index не переключит alias.
+    """
+    current = live_index(es_client, alias)
+    if current is None:
+        index_name = f"{alias}_v1"
+        try:
+            es_client.indices.create(
+                index=index_name, settings=mapping['settings'], mappings=mapping['mappings'], aliases={alias: {}})
+        except elasticsearch.BadRequestError as e:
+            # Индекс одновременно создал другой воркер шардированного режима
+            if e.error != "resource_already_exists_exception":
+                raise
+            return index_name
+        logger.info(f"Индекс {index_name} создан с маппингом и алиасом {alias}")
+        return index_name
+
+    versions = index_versions(es_client, alias)
+    for index_name in reversed(versions):
+        current_mapping = es_client.indices.get_mapping(index=index_name)[index_name]['mappings']
+        if current_mapping == mapping['mappings']:
+            logger.info(f"Индекс {index_name} для {alias} уже существует и имеет тот же маппинг.")
+            return index_name
+        if index_name == current:
+            # Более старые версии не рассматриваем
+            break
+
+    version = max((int(name.rsplit("_v", 1)[1]) for name in versions if name != alias), default=0) + 1
+    index_name = f"{alias}_v{version}"
+    try:
+        es_client.indices.create(index=index_name, settings=mapping['settings'], mappings=mapping['mappings'])
+    except elasticsearch.BadRequestError as e:
+        if e.error != "resource_already_exists_exception":
+            raise
+        return index_name
+    logger.warning(
+        f"Маппинг {alias} изменился: создан индекс {index_name}, "
+        f"поиск работает с {current} до завершения загрузки.")
+    return index_name
+
 
-    if not es_client.indices.exists(index=index_name):
-        es_client.indices.create(index=index_name, body=mapping)
-        logger.info(f"Индекс {index_name} создан с маппингом")
+def promote_index(es_client: Elasticsearch, alias: str, index_name: str) -> None:
+    """Атомарное переключение alias на полностью загруженный индекс и удаление старых версий."""
+    current = live_index(es_client, alias)
+    if current == index_name:
+        return
+
+    if current == alias:
+        # Индекс старого формата занимает имя alias: удаляем его в том же атомарном действии
+        actions = [{"remove_index": {"index": alias}}]
+    elif current is not None:
+        actions = [{"remove": {"index": current, "alias": alias}}]
     else:
-        # Получаем текущий маппинг
-        current_mapping = es_client.indices.get_mapping(index=index_name)
-
-        # Извлекаем релевантные части для сравнения
-        current_mapping_mappings = current_mapping[index_name]['mappings']
-
-        # Сравниваем только настройки и маппинг
-        if current_mapping_mappings == mapping['mappings']:
-            logger.info(f"Индекс {index_name} уже существует и имеет тот же маппинг.")
-        else:
-            print(current_mapping)
-            print(current_mapping[index_name])
-            logger.warning(
-                f"Индекс {index_name} существует, но маппинги отличаются.")
-
-            # Удаление старого индекса
-            es_client.indices.delete(index=index_name)
-            logger.info(f"Старый индекс {index_name} удален")
-
-            # Создание нового индекса с обновленным маппингом
-            es_client.indices.create(index=index_name, body=mapping)
-            logger.info(f"Новый индекс {index_name} создан с обновленным маппингом")
-            new_mapping = es_client.indices.get_mapping(index=index_name)
-            print(new_mapping)
-            print(new_mapping[index_name])
+        actions = []
+    actions.append({"add": {"index": index_name, "alias": alias}})
+    es_client.indices.update_aliases(actions=actions)
+    logger.info(f"Алиас {alias} переключён с {current} на {index_name}")
+
+    versions = index_versions(es_client, alias)
+    for old_index in versions[:versions.index(index_name)]:
+        es_client.indices.delete(index=old_index)
+        logger.info(f"Старый индекс {old_index} удален")
+
+
+def can_enable_backfill_mode(es_client: Elasticsearch, alias: str, index_name: str) -> bool:
+    """Режим первичной загрузки допустим для версии, ещё не переключённой alias, или для пустого индекса.
+
+    Индекс, на который указывает alias, обслуживает поиск: без refresh и реплик
+    изменения в нём не видны, а отказ узла теряет данные.
+    """
+    if live_index(es_client, alias) != index_name:
+        return True
+    if es_client.count(index=index_name)["count"] == 0:
+        return True
+    logger.warning(f"Индекс {index_name} обслуживает поиск по {alias}: "
+                   f"загрузка с нуля идёт без режима первичной загрузки")
+    return False
+
+
+def enable_backfill_mode(es_client: Elasticsearch, index_name: str) -> str:
+    """Настройки индекса для первичной загрузки: без refresh и без реплик.
+
+    Возвращает исходное число реплик, чтобы восстановить его после загрузки.
+    """
+    index_settings = es_client.indices.get_settings(index=index_name, name="index.number_of_replicas")
+    number_of_replicas = index_settings[index_name]["settings"]["index"]["number_of_replicas"]
+    es_client.indices.put_settings(
+        index=index_name, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    logger.info(f"Индекс {index_name} переведён в режим первичной загрузки")
+    return number_of_replicas
+
 
+def disable_backfill_mode(es_client: Elasticsearch, index_name: str, number_of_replicas: str) -> None:
+    """Возврат настроек near-real-time после первичной загрузки индекса."""
+    es_client.indices.put_settings(
+        index=index_name,
+        settings={"index": {
+            "refresh_interval": INDEX_SETTINGS["refresh_interval"],
+            "number_of_replicas": number_of_replicas,
+        }})
+    es_client.indices.refresh(index=index_name)
+    if settings.es_force_merge_after_backfill:
+        # Слияние сегментов может идти долго, выполняем его фоновой задачей Elasticsearch
+        es_client.indices.forcemerge(index=index_name, max_num_segments=1, wait_for_completion=False)
+    logger.info(f"Первичная загрузка индекса {index_name} завершена, настройки восстановлены")
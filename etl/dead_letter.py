@@ -0,0 +1,243 @@
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from elastic_transport import JsonSerializer
+
+from state import *
+from get_connections import *
+from create_index import index_versions, live_index
+from load_data import LoadResult, load_data_to_es, merge_load_results
+from metrics import DEAD_LETTERS
+
+_serializer = JsonSerializer()
+
+QUEUE_KEY = "dead_letters"  # hash: документ -> запись с действием bulk и ошибкой
+DUE_KEY = "dead_letters:due"  # sorted set: документ -> время следующей попытки
+PARKED_KEY = "dead_letters:parked"  # hash: записи, исчерпавшие попытки, для разбора вручную
+
+# Взять запись в работу, если подошло время попытки: запись откладывается на время попытки,
+# чтобы после падения воркера вернуться в очередь.
+CLAIM_SCRIPT = """
+local due = redis.call('zscore', KEYS[1], ARGV[1])
+if due and tonumber(due) <= tonumber(ARGV[2]) then
+    redis.call('zadd', KEYS[1], ARGV[3], ARGV[1])
+    return redis.call('hget', KEYS[2], ARGV[1])
+end
+return false
+"""
+# Завершить попытку, только если запись не заменили новой ошибкой того же документа
+# и не удалили после его успешной загрузки основным ETL процессом.
+# ARGV[3] — новое время попытки; пусто — запись удаляется (и переносится в KEYS[3], если задан ARGV[4]).
+FINISH_SCRIPT = """
+if redis.call('hget', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] ~= '' then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[5])
+    redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+    return 1
+end
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('zrem', KEYS[2], ARGV[1])
+if ARGV[4] ~= '' then
+    redis.call('hset', KEYS[3], ARGV[1], ARGV[4])
+end
+return 1
+"""
+
+
+def document_key(action: dict) -> str:
+    """Поле записи очереди: индекс и _id документа."""
+    return json.dumps([action["_index"], str(action["_id"])])
+
+
+def index_layout(es_client: Elasticsearch) -> Dict[str, Tuple[List[str], Optional[str]]]:
+    """Версии индексов ETL и рабочая версия каждого: alias -> (index_versions, live_index)."""
+    aliases = (settings.filmwork_index_name, settings.persons_index_name, settings.genres_index_name)
+    return {alias: (index_versions(es_client, alias), live_index(es_client, alias)) for alias in aliases}
+
+
+def retry_target(action: dict, layout: Dict[str, Tuple[List[str], Optional[str]]]) -> Optional[dict]:
+    """Действие для повтора в существующую версию индекса; None — версия удалена или будет удалена.
+
+    Действие для рабочей версии отправляется через alias с require_alias (см. retry_due):
+    повтор не создаст индекс с динамическим маппингом на месте версии, удалённой promote_index.
+    """
+    if "script" in action:
+        # Scripted update из очереди прежних версий ETL не повторяются (см. DeadLetterQueue.push)
+        return None
+    index_name = action["_index"]
+    for alias, (versions, live) in layout.items():
+        if index_name not in versions:
+            continue
+        if index_name == live and live != alias:
+            return {**action, "_index": alias}
+        if live in versions and versions.index(index_name) < versions.index(live):
+            # Версия старше рабочей: promote_index её удаляет
+            return None
+        return action
+    return None
+
+
+class DeadLetterQueue:
+    """Очередь недоставленных документов (dead-letter queue) в Redis.
+
+    Документы, которые Elasticsearch не принял после повторов load_with_retries, сохраняются
+    вместе с ошибкой, и ETL процесс продолжает работу, не откатывая контрольную точку.
+    Очередь разбирает dead_letter_worker с экспоненциальной паузой между попытками;
+    после settings.dead_letter_max_attempts неудачных попыток запись переносится в dead_letters:parked.
+    На каждый документ хранится одна запись: новая ошибка заменяет старую, а успешная загрузка
+    документа основным процессом удаляет её, чтобы повтор не вернул устаревшую версию.
+    """
+
+    def __init__(self, redis_conn: Redis) -> None:
+        self.redis_conn = redis_conn
+        self.claim_script = redis_conn.register_script(CLAIM_SCRIPT)
+        self.finish_script = redis_conn.register_script(FINISH_SCRIPT)
+
+    def push(self, failed: List[Tuple[dict, dict]]) -> None:
+        """Поставить в очередь действия bulk с ответом Elasticsearch по каждому.
+
+        Scripted update не ставятся: повтор частичного изменения вне порядка последующих
+        изменений документа испортил бы его (см. etl.requeue_link_changes).
+        """
+        failed = [(action, info) for action, info in failed if "script" not in action]
+        if not failed:
+            return
+        entries = {
+            document_key(action): _serializer.dumps(
+                {"action": action, "error": info, "attempts": 0, "failed_at": time.time()}).decode("utf-8")
+            for action, info in failed
+        }
+        due = time.time() + settings.dead_letter_retry_delay
+        with self.redis_conn.pipeline() as pipe:
+            pipe.hset(QUEUE_KEY, mapping=entries)
+            pipe.zadd(DUE_KEY, {key: due for key in entries})
+            pipe.zcard(DUE_KEY)
+            DEAD_LETTERS.labels("queued").set(pipe.execute()[-1])
+        logger.warning(f"{len(entries)} документ(ов) поставлено в очередь недоставленных")
+
+    def discard(self, keys: Iterable[str]) -> None:
+        """Удалить записи документов, успешно загруженных основным процессом."""
+        keys = list(keys)
+        if keys:
+            with self.redis_conn.pipeline() as pipe:
+                pipe.hdel(QUEUE_KEY, *keys)
+                pipe.zrem(DUE_KEY, *keys)
+                pipe.execute()
+
+    def track(self, actions: List[dict], result: LoadResult) -> None:
+        """Учесть итог загрузки actions: ошибки — в очередь, загруженные документы — из очереди.
+
+        Если загрузка прервана исключением, неизвестно, какие документы дошли до Elasticsearch:
+        в очередь ставятся все, повторная отправка index/delete/update идемпотентна.
+        """
+        failed = {document_key(action): (action, info) for action, info in result.failed}
+        if result.success + len(result.failed) != len(actions):
+            interrupted = {"status": None, "error": "загрузка пачки прервана"}
+            self.push([failed.get(document_key(action), (action, interrupted)) for action in actions])
+            return
+        self.push(list(failed.values()))
+        self.discard(key for key in map(document_key, actions) if key not in failed)
+
+    def track_operations(self, operations: List[bytes], result: LoadResult) -> None:
+        """track для готовых NDJSON-операций index (см. load_ndjson_to_es)."""
+        actions = []
+        for operation in operations:
+            metadata, source = operation.split(b"\n", 2)[:2]
+            action = json.loads(metadata)["index"]
+            action["_source"] = source.decode("utf-8")
+            actions.append(action)
+        self.track(actions, result)
+
+    def depth(self) -> Dict[str, int]:
+        with self.redis_conn.pipeline() as pipe:
+            pipe.zcard(DUE_KEY)
+            pipe.hlen(PARKED_KEY)
+            queued, parked = pipe.execute()
+        DEAD_LETTERS.labels("queued").set(queued)
+        DEAD_LETTERS.labels("parked").set(parked)
+        return {"queued": queued, "parked": parked}
+
+    def claim_due(self, limit: int) -> List[Tuple[str, str]]:
+        """Записи, время попытки которых подошло: (поле, сохранённая запись)."""
+        now = time.time()
+        claimed = []
+        for key in self.redis_conn.zrangebyscore(DUE_KEY, "-inf", now, start=0, num=limit):
+            entry = self.claim_script(keys=[DUE_KEY, QUEUE_KEY], args=[key, now, now + settings.dead_letter_claim_ttl])
+            if entry is not None:
+                claimed.append((key, entry))
+        return claimed
+
+    def retry_due(self, es_client: Elasticsearch) -> int:
+        """Одна попытка повторной отправки записей, время которых подошло. Возвращает число записей.
+
+        Записи версий индекса, которых уже нет (или которые promote_index удаляет), отбрасываются:
+        рабочая версия загружена из PostgreSQL целиком. Действия для рабочей версии отправляются
+        через alias с require_alias, для строящейся — в существующую версию.
+        """
+        claimed = self.claim_due(settings.dead_letter_batch_size)
+        if not claimed:
+            return 0
+        layout = index_layout(es_client)
+        entries, targets, dropped = [], {}, 0
+        for key, raw in claimed:
+            entry = json.loads(raw)
+            target = retry_target(entry["action"], layout)
+            if target is None:
+                dropped += self.finish_script(keys=[QUEUE_KEY, DUE_KEY, PARKED_KEY], args=[key, raw, "", "", ""])
+                continue
+            entries.append((key, raw, entry))
+            targets[key] = target
+        if dropped:
+            logger.info(f"Очередь недоставленных: отброшено {dropped} записей удалённых версий индексов")
+
+        groups = {True: [], False: []}  # через alias -> записи
+        for key, _, entry in entries:
+            groups[targets[key]["_index"] != entry["action"]["_index"]].append(key)
+        results = [
+            load_data_to_es(es_client, [targets[key] for key in keys], ignore_missing=True, require_alias=via_alias)
+            for via_alias, keys in groups.items() if keys
+        ]
+        result = merge_load_results(results) if results else LoadResult(0, [], 0, 0.0)
+        if result.success + len(result.failed) != len(entries):
+            # Ответ не получен: записи вернутся в очередь по истечении dead_letter_claim_ttl
+            return len(claimed)
+
+        sent_keys = {document_key(targets[key]): key for key, _, _ in entries}
+        failed = {sent_keys[document_key(action)]: info for action, info in result.failed}
+        delivered = parked = 0
+        for key, raw, entry in entries:
+            if key not in failed:
+                delivered += self.finish_script(keys=[QUEUE_KEY, DUE_KEY, PARKED_KEY], args=[key, raw, "", "", ""])
+                continue
+            entry["attempts"] += 1
+            entry["error"] = failed[key]
+            updated = _serializer.dumps(entry).decode("utf-8")
+            if entry["attempts"] >= settings.dead_letter_max_attempts:
+                parked += self.finish_script(keys=[QUEUE_KEY, DUE_KEY, PARKED_KEY], args=[key, raw, "", updated, ""])
+                continue
+            delay = min(settings.dead_letter_retry_delay * 2 ** entry["attempts"], settings.dead_letter_max_delay)
+            self.finish_script(keys=[QUEUE_KEY, DUE_KEY, PARKED_KEY], args=[key, raw, time.time() + delay, "", updated])
+        logger.info(f"Очередь недоставленных: доставлено {delivered} из {len(entries)}, "
+                    f"исчерпали попытки {parked}")
+        return len(claimed)
+
+
+def dead_letter_worker() -> None:
+    """Фоновый повтор документов из очереди недоставленных (settings.dead_letter_queue)."""
+    es_client = get_shared_es_client()
+    with get_redis_connection() as redis_conn:
+        dead_letters = DeadLetterQueue(redis_conn)
+        while True:
+            try:
+                retried = dead_letters.retry_due(es_client)
+                depth = dead_letters.depth()
+                if not retried:
+                    if depth["queued"]:
+                        logger.debug(f"В очереди недоставленных {depth['queued']} документ(ов), "
+                                     f"исчерпали попытки {depth['parked']}")
+                    time.sleep(settings.default_sleep_time)
+            except Exception as e:
+                logger.error(f"Ошибка при повторе недоставленных документов: {str(e)}")
+                time.sleep(settings.default_sleep_time)
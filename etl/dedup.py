@@ -0,0 +1,97 @@
+import hashlib
+import json
+from typing import List, Tuple, Union
+
+from state import *
+from get_connections import get_json_serializer
+from load_data import LoadResult
+from metrics import DEDUP_SKIPPED
+
+_serializer = get_json_serializer()
+
+
+def source_digest(source: Union[bytes, str]) -> str:
+    """Хеш сериализованного _source. 64 бит достаточно: сравниваются только версии одного документа."""
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    return hashlib.blake2b(source, digest_size=8).hexdigest()
+
+
+class DocumentHashes:
+    """Хеши последних проиндексированных версий документов индекса в Redis.
+
+    Хранятся в хеше doc_hashes:{index_name} (поле — _id документа), поэтому у каждой
+    версии индекса свой набор. Документы, чей _source не изменился с прошлой
+    загрузки, отбрасываются до отправки в Elasticsearch.
+    """
+
+    def __init__(self, redis_conn: Redis, index_name: str) -> None:
+        self.redis_conn = redis_conn
+        self.index_name = index_name
+        self.key = f"doc_hashes:{index_name}"
+        self.seen = 0
+        self.skipped = 0
+
+    def clear(self) -> None:
+        """Забыть все хеши индекса, например, перед загрузкой индекса с нуля."""
+        self.redis_conn.delete(self.key)
+
+    def unchanged(self, ids: List[str], digests: List[str]) -> List[bool]:
+        """Для каждого документа: совпадает ли хеш с последним проиндексированным."""
+        if not ids:
+            return []
+        stored = self.redis_conn.hmget(self.key, ids)
+        result = [old == new for old, new in zip(stored, digests)]
+        self.seen += len(ids)
+        self.skipped += sum(result)
+        DEDUP_SKIPPED.labels(self.index_name).inc(sum(result))
+        return result
+
+    def skip_unchanged_actions(self, actions: List[dict]) -> Tuple[List[dict], List[str]]:
+        """Оставить действия bulk с изменённым _source и вернуть их хеши.
+
+        _source сериализуется здесь один раз и передаётся в bulk строкой, без повторной сериализации.
+        """
+        for action in actions:
+            if not isinstance(action["_source"], str):
+                action["_source"] = _serializer.dumps(action["_source"]).decode("utf-8")
+        digests = [source_digest(action["_source"]) for action in actions]
+        unchanged = self.unchanged([str(action["_id"]) for action in actions], digests)
+        kept = [(action, digest) for action, digest, same in zip(actions, digests, unchanged) if not same]
+        return [action for action, _ in kept], [digest for _, digest in kept]
+
+    def skip_unchanged_operations(self, operations: List[bytes]) -> Tuple[List[bytes], List[str], List[str]]:
+        """То же для готовых NDJSON-операций: возвращает операции, их _id и хеши."""
+        ids, digests = [], []
+        for operation in operations:
+            metadata, source = operation.split(b"\n", 2)[:2]
+            ids.append(str(json.loads(metadata)["index"]["_id"]))
+            digests.append(source_digest(source))
+        kept = [
+            (operation, document_id, digest)
+            for operation, document_id, digest, same in zip(operations, ids, digests, self.unchanged(ids, digests))
+            if not same
+        ]
+        return [item[0] for item in kept], [item[1] for item in kept], [item[2] for item in kept]
+
+    def remember(self, ids: List[str], digests: List[str], result: LoadResult) -> None:
+        """Запомнить хеши успешно проиндексированных документов; неудавшиеся будут отправлены снова."""
+        if result.success + len(result.failed) != len(ids):
+            # Загрузка прервана ошибкой, и неизвестно, какие документы дошли до Elasticsearch
+            return
+        failed = {str(action["_id"]) for action, _ in result.failed}
+        mapping = {document_id: digest for document_id, digest in zip(ids, digests) if document_id not in failed}
+        if mapping:
+            self.redis_conn.hset(self.key, mapping=mapping)
+
+    def forget(self, ids: List[str]) -> None:
+        """Забыть хеши удалённых документов, чтобы их повторное создание не было пропущено."""
+        if ids:
+            self.redis_conn.hdel(self.key, *ids)
+
+    def report(self, name: str) -> None:
+        """Логирование доли пропущенных неизменённых документов с момента последнего отчёта."""
+        if self.seen:
+            logger.info(f"Пропущено неизменённых документов {name}: {self.skipped} из {self.seen} "
+                        f"({self.skipped / self.seen:.0%})")
+        self.seen = self.skipped = 0
@@ -0,0 +1,124 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from extract_data import extract_data
+from metrics import DIMENSION_CACHE_LOOKUPS, DIMENSION_CACHE_SIZE
+from queries import GENRE_NAMES_BY_IDS_QUERY, PERSON_NAMES_BY_IDS_QUERY
+from state import *
+from get_connections import *
+
+
+class DimensionCache:
+    """Ограниченный LRU кеш имён справочника (id -> имя) в памяти процесса ETL.
+
+    Общий для потоков ETL: промахи дочитываются из PostgreSQL одним запросом на пачку,
+    при переполнении вытесняются давно не использованные записи.
+    Изменённые записи сбрасываются через invalidate. Имя, прочитанное из базы до сброса,
+    в кеш не попадает: иначе старое значение могло бы пережить изменение.
+    """
+
+    def __init__(self, name: str, query: str, max_size: int) -> None:
+        self.name = name
+        self.query = query
+        self.max_size = max_size
+        self.entries: OrderedDict[str, str] = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, ids: Iterable[str]) -> Tuple[Dict[str, str], List[str], int]:
+        """Найденные имена, id промахов и поколение кеша на момент поиска."""
+        found, missing = {}, []
+        with self.lock:
+            for record_id in ids:
+                name = self.entries.get(record_id)
+                if name is None:
+                    missing.append(record_id)
+                else:
+                    self.entries.move_to_end(record_id)
+                    found[record_id] = name
+            self.hits += len(found)
+            self.misses += len(missing)
+            generation = self.generation
+        DIMENSION_CACHE_LOOKUPS.labels(self.name, "hit").inc(len(found))
+        DIMENSION_CACHE_LOOKUPS.labels(self.name, "miss").inc(len(missing))
+        return found, missing, generation
+
+    def store(self, names: Dict[str, str], generation: int) -> None:
+        """Добавить прочитанные имена, если с момента поиска кеш не сбрасывался."""
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries.update(names)
+            for record_id in names:
+                self.entries.move_to_end(record_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            size = len(self.entries)
+        DIMENSION_CACHE_SIZE.labels(self.name).set(size)
+
+    def invalidate(self, ids: Iterable[str]) -> None:
+        """Сбросить записи изменённых id."""
+        with self.lock:
+            self.generation += 1
+            for record_id in ids:
+                self.entries.pop(str(record_id), None)
+            size = len(self.entries)
+        DIMENSION_CACHE_SIZE.labels(self.name).set(size)
+
+    def invalidate_records(self, records: List[dict]) -> None:
+        """Сбросить записи по пачке изменённых строк справочника (колонка id)."""
+        self.invalidate(record["id"] for record in records)
+
+    def resolve(self, conn: PGConnection, ids: Iterable[str]) -> Dict[str, str]:
+        """Имена для ids: из кеша, промахи — одним запросом к PostgreSQL."""
+        found, missing, generation = self.lookup(set(ids))
+        if missing:
+            fetched = {record["id"]: record["name"] for record in extract_data(conn, self.query, params=(missing,))}
+            self.store(fetched, generation)
+            found.update(fetched)
+        return found
+
+    def report(self) -> None:
+        """Логирование доли попаданий с момента последнего отчёта, чтобы подобрать размер кеша."""
+        with self.lock:
+            hits, misses, size = self.hits, self.misses, len(self.entries)
+            self.hits = self.misses = 0
+        if hits + misses:
+            logger.info(f"Кеш {self.name}: попаданий {hits} из {hits + misses} ({hits / (hits + misses):.0%}), "
+                        f"записей {size} из {self.max_size}")
+
+
+PERSON_NAMES = DimensionCache("person", PERSON_NAMES_BY_IDS_QUERY, settings.person_cache_size)
+GENRE_NAMES = DimensionCache("genre", GENRE_NAMES_BY_IDS_QUERY, settings.genre_cache_size)
+DIMENSION_CACHES = {"person": PERSON_NAMES, "genre": GENRE_NAMES}
+
+
+def resolve_filmwork_batch(conn: PGConnection, records: List[dict]) -> List[dict]:
+    """Пачка FILMWORK_NORMALIZED_SELECT, приведённая к формату FILMWORK_SELECT для transform_filmwork.
+
+    id персоналий и жанров заменяются именами из кешей. Связи с отсутствующими
+    в базе записями отбрасываются, как при соединении в FILMWORK_SELECT.
+    """
+    persons = PERSON_NAMES.resolve(conn, (person["person_id"] for record in records for person in record["persons"]))
+    genres = GENRE_NAMES.resolve(conn, (genre_id for record in records for genre_id in record["genres"]))
+    for record in records:
+        record["persons"] = [
+            {"person_role": person["person_role"], "person_id": person["person_id"],
+             "person_name": persons[person["person_id"]]}
+            for person in record["persons"] if person["person_id"] in persons
+        ]
+        record["genres"] = sorted({genres[genre_id] for genre_id in record["genres"] if genre_id in genres})
+    return records
+
+
+def resolve_filmwork_names(conn: PGConnection, stream: Iterator[List[dict]]) -> Iterator[List[dict]]:
+    """Поток пачек resolve_filmwork_batch; в конце потока — отчёт о попаданиях в кеши."""
+    try:
+        for records in stream:
+            yield resolve_filmwork_batch(conn, records)
+    finally:
+        PERSON_NAMES.report()
+        GENRE_NAMES.report()
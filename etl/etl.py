@@ -1,422 +1,725 @@
+import json
+import threading
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+
+from adaptive import AdaptiveBatchController
 from extract_data import *
 from transform_data import *
 from load_data import *
 from create_index import *
-from state import State, logger, RedisStorage
+from dead_letter import DeadLetterQueue
+from dedup import DocumentHashes
+from dimension_cache import (DIMENSION_CACHES, GENRE_NAMES, PERSON_NAMES, resolve_filmwork_batch,
+                             resolve_filmwork_names)
+from metrics import checkpoint_lag, observe_batch, observe_checkpoint
+from mappings import FILMWORK_MAPPING, GENRES_MAPPING, PERSONS_MAPPING
+from queries import *
+from scheduler import PipelineStep, pipeline, run_steps
+from sharding import all_partitions_caught_up, run_partitioned
+from transform_pool import transform_batches
+from state import State, logger, RedisStorage, format_log_position, parse_log_position
 
+PERSONS_MOVIES_POSITION_KEY = 'last_seq_persons_movies'
+DELETES_POSITION_KEY = 'last_seq_deletes'
+# Блокировка загрузки из снимка (snapshot.py): пока она идёт, надгробия не обрабатываются
+SNAPSHOT_LOCK_KEY = 'snapshot_backfill'
+# Позиция журнала связей, с которой etl_persons_movies повторит изменения после первичной загрузки persons
+PERSONS_MOVIES_REPLAY_KEY = 'replay_persons_movies'
 
-def etl_filmwork() -> None:
-    """Основной ETL процесс для filmwork."""
-    with (get_pg_connection() as pg_conn,
-          get_es_client() as es_client,
+
+def load_stream(es_client: Elasticsearch, stream: Iterator[List[dict]], transform: Callable, index_name: str,
+                parallel_transform: bool = False, doc_hashes: Optional[DocumentHashes] = None,
+                dead_letters: Optional[DeadLetterQueue] = None) -> Generator[Tuple[List[dict], float, float, LoadResult], None, None]:
+    """Пачки stream после transform и загрузки в Elasticsearch.
+
+    Для каждой пачки отдаётся (строки, время extract, время transform, LoadResult).
+    При parallel_transform и settings.transform_workers > 0 transform и сериализация
+    выполняются в пуле процессов (см. transform_batches) с сохранением порядка пачек.
+    С doc_hashes документы, не изменившиеся с прошлой загрузки, не отправляются.
+    С dead_letters недоставленные документы ставятся в очередь повторов.
+    """
+    if parallel_transform and settings.transform_workers:
+        for records, extract_time, transform_time, body in transform_batches(stream, transform, index_name):
+            started = time.perf_counter()
+            operations = split_ndjson(body)
+            if doc_hashes is not None:
+                operations, ids, digests = doc_hashes.skip_unchanged_operations(operations)
+            transform_time += time.perf_counter() - started
+            result = load_ndjson_to_es(es_client, operations)
+            if doc_hashes is not None:
+                doc_hashes.remember(ids, digests, result)
+            if dead_letters is not None:
+                dead_letters.track_operations(operations, result)
+            yield records, extract_time, transform_time, result
+        return
+
+    while True:
+        started = time.perf_counter()
+        records = next(stream, None)
+        extract_time = time.perf_counter() - started
+        if records is None:
+            return
+        started = time.perf_counter()
+        transformed_data = list(transform(records, index_name))
+        if doc_hashes is not None:
+            transformed_data, digests = doc_hashes.skip_unchanged_actions(transformed_data)
+        transform_time = time.perf_counter() - started
+        result = load_data_to_es(es_client, transformed_data)
+        if doc_hashes is not None:
+            doc_hashes.remember([str(action["_id"]) for action in transformed_data], digests, result)
+        if dead_letters is not None:
+            dead_letters.track(transformed_data, result)
+        yield records, extract_time, transform_time, result
+
+
+# Проверка после загрузки пачки сущности: запрос существующих строк и колонка с _id документа
+REMOVED_ROWS_CHECKS = {
+    'filmwork': (FILMWORK_EXISTING_IDS_QUERY, "id"),
+    'persons': (PERSONS_EXISTING_IDS_QUERY, "id"),
+    'genres': (GENRES_EXISTING_IDS_QUERY, "name"),
+}
+
+
+def delete_removed_documents(es_client: Elasticsearch, pg_conn: PGConnection, existing_query: str,
+                             doc_ids: Dict[str, str], index_name: str,
+                             doc_hashes: Optional[DocumentHashes] = None,
+                             dead_letters: Optional[DeadLetterQueue] = None) -> None:
+    """Удалить из index_name только что загруженные документы строк, которых уже нет в PostgreSQL.
+
+    doc_ids: id строки -> _id документа. Пачка могла быть прочитана из снимка курсора, открытого
+    до удаления строки, уже после обработки её надгробия, и документ вернулся бы навсегда.
+    Проверка выполняется после загрузки: надгробие строки, удалённой позже, etl_deletes
+    прочитает только после фиксации удаления, то есть уже после этой загрузки.
+    """
+    if not doc_ids:
+        return
+    existing = {record["id"] for record in extract_data(pg_conn, existing_query, params=(list(doc_ids),))}
+    removed = [doc_id for row_id, doc_id in doc_ids.items() if row_id not in existing]
+    if not removed:
+        return
+    actions = list(transform_deletes(removed, index_name))
+    result = load_data_to_es(es_client, actions, ignore_missing=True)
+    if dead_letters:
+        dead_letters.track(actions, result)
+    if doc_hashes:
+        doc_hashes.forget(removed)
+    logger.info(f"Удалено {len(removed)} документов {index_name}, строки которых удалены после чтения пачки")
+
+
+def etl_steps(entity: str, mapping: dict, alias: str, query: str,
+              transform: Callable[[List[dict]], Generator[dict, None, None]],
+              partition: Optional[Tuple[int, int]] = None,
+              stop_event: Optional[threading.Event] = None,
+              parallel_transform: bool = False,
+              incremental: Optional[Tuple[str, Callable]] = None,
+              resolve: Optional[Callable[[PGConnection, Iterator], Iterator]] = None,
+              after_load: Optional[Callable[[List[dict]], None]] = None,
+              before_full_load: Optional[Callable[[PGConnection, State], None]] = None
+              ) -> Generator[PipelineStep, None, None]:
+    """Основной ETL процесс сущности по шагам: шаг отдаётся после каждой пачки и при простое.
+
+    Изменённые записи читаются одним запросом через серверный курсор и пачками
+    проходят transform и загрузку в Elasticsearch. Размер пачки и пауза простоя
+    подбираются AdaptiveBatchController.
+    После каждой загруженной пачки сохраняется контрольная точка (modified, id)
+    последней записи, поэтому записи с одинаковым modified не теряются на границе пачки.
+
+    При изменении маппинга данные загружаются в новую версию индекса,
+    и alias переключается на неё только после полной загрузки.
+    Загрузка с нуля выполняется в режиме backfill (см. enable_backfill_mode),
+    если индекс не обслуживает поиск (см. can_enable_backfill_mode).
+
+    В шардированном режиме partition = (номер, всего): query дополнительно
+    фильтрует партицию, контрольная точка у партиции своя (при смене числа партиций
+    переносится из прежней раскладки, см. seed_checkpoint), а режимом backfill
+    и переключением alias управляет партиция 0, когда все партиции догнали источник.
+    Процесс завершается после установки stop_event.
+
+    parallel_transform разрешает transform в пуле процессов: только для transform,
+    обращающихся к колонкам строки по индексу (см. transform_batches).
+    incremental — (query, transform) после завершения первичной загрузки версии индекса
+    (см. initial_load_key), например, частичные обновления вместо полных документов;
+    до этого, в том числе после потери состояния, загрузка идёт через query и transform.
+    resolve(pg_conn, stream) дополняет пачки query перед transform (см. resolve_filmwork_names),
+    after_load вызывается с каждой загруженной пачкой, например, для сброса кеша справочника.
+    before_full_load(pg_conn, state) вызывается перед чтением через query, если задан incremental.
+    После каждой пачки документы строк, удалённых с момента чтения, удаляются (см. delete_removed_documents).
+
+    Шаги выполняет run_steps на отдельном потоке или планировщик scheduler.py.
+    """
+    name = entity if partition is None else f"{entity}:p{partition[0]}"
+    leader = partition is None or partition[0] == 0
+    partition_params = () if partition is None else (partition[1], partition[0])
+
+    es_client = get_shared_es_client()
+    with (pg_connection() as pg_conn,
           get_redis_connection() as redis_conn):
 
-        mapping = {
-            "settings": {
-                "refresh_interval": "1s",
-                "analysis": {
-                    "filter": {
-                        "english_stop": {
-                            "type": "stop",
-                            "stopwords": "_english_"
-                        },
-                        "english_stemmer": {
-                            "type": "stemmer",
-                            "language": "english"
-                        },
-                        "english_possessive_stemmer": {
-                            "type": "stemmer",
-                            "language": "possessive_english"
-                        },
-                        "russian_stop": {
-                            "type": "stop",
-                            "stopwords": "_russian_"
-                        },
-                        "russian_stemmer": {
-                            "type": "stemmer",
-                            "language": "russian"
-                        }
-                    },
-                    "analyzer": {
-                        "ru_en": {
-                            "tokenizer": "standard",
-                            "filter": [
-                                "lowercase",
-                                "english_stop",
-                                "english_stemmer",
-                                "english_possessive_stemmer",
-                                "russian_stop",
-                                "russian_stemmer"
-                            ]
-                        }
-                    }
-                }
-            },
-            "mappings": {
-                "dynamic": "strict",
-                "properties": {
-                    "id": {
-                        "type": "keyword"
-                    },
-                    "imdb_rating": {
-                        "type": "float"
-                    },
-                    "genres": {
-                        "type": "text"
-                    },
-                    "title": {
-                        "type": "text",
-                        "analyzer": "ru_en",
-                        "fields": {
-                            "raw": {
-                                "type": "keyword"
-                            }
-                        }
-                    },
-                    "description": {
-                        "type": "text",
-                        "analyzer": "ru_en"
-                    },
-                    "directors_names": {
-                        "type": "text",
-                        "analyzer": "ru_en"
-                    },
-                    "actors_names": {
-                        "type": "text",
-                        "analyzer": "ru_en"
-                    },
-                    "writers_names": {
-                        "type": "text",
-                        "analyzer": "ru_en"
-                    },
-                    "directors": {
-                        "type": "nested",
-                        "dynamic": "strict",
-                        "properties": {
-                            "id": {
-                                "type": "keyword"
-                            },
-                            "name": {
-                                "type": "text",
-                                "analyzer": "ru_en"
-                            }
-                        }
-                    },
-                    "actors": {
-                        "type": "nested",
-                        "dynamic": "strict",
-                        "properties": {
-                            "id": {
-                                "type": "keyword"
-                            },
-                            "name": {
-                                "type": "text",
-                                "analyzer": "ru_en"
-                            }
-                        }
-                    },
-                    "writers": {
-                        "type": "nested",
-                        "dynamic": "strict",
-                        "properties": {
-                            "id": {
-                                "type": "keyword"
-                            },
-                            "name": {
-                                "type": "text",
-                                "analyzer": "ru_en"
-                            }
-                        }
-                    }
-                }
-            }
-        }
-        create_index_with_mapping(es_client, mapping, settings.filmwork_index_name)
+        index_name = prepare_index(es_client, mapping, alias)
+        promoted = live_index(es_client, alias) == index_name
 
         storage = RedisStorage(redis_adapter=redis_conn)
-        state = State(storage)
+        state = State(storage, settings.checkpoint_flush_batches, settings.checkpoint_flush_interval)
         try:
-            sleep_time = settings.default_sleep_time
-            sync_time_key = 'last_synced_time_filmwork'
-            while True:
+            controller = AdaptiveBatchController(name)
+            sync_time_key = checkpoint_key(entity, alias, index_name, partition)
+            # Загрузка с нуля идёт в режиме backfill: без refresh и реплик до момента, когда ETL догонит источник
+            number_of_replicas = state.get_state(backfill_key(index_name))
+            checkpoint = seed_checkpoint(state, entity, alias, index_name, partition)
+            doc_hashes = DocumentHashes(redis_conn, index_name) if settings.dedup_documents else None
+            dead_letters = DeadLetterQueue(redis_conn) if settings.dead_letter_queue else None
+            if leader and not number_of_replicas and (
+                    checkpoint is None or checkpoint[0] == settings.default_sync_time) and (
+                    can_enable_backfill_mode(es_client, alias, index_name)):
+                number_of_replicas = enable_backfill_mode(es_client, index_name)
+                state.set_state(backfill_key(index_name), number_of_replicas)
+                if doc_hashes:
+                    # Индекс загружается с нуля: хеши прежних загрузок недействительны
+                    doc_hashes.clear()
 
-                last_synced_time = state.get_state(sync_time_key)
-                if last_synced_time is None:
-                    last_synced_time = settings.default_sync_time
+            # Полные документы или incremental выбираются по признаку завершённой первичной загрузки,
+            # а не по режиму backfill: его может не быть (см. can_enable_backfill_mode)
+            loaded = state.get_state(initial_load_key(index_name))
+            caught_up = None
+            while not (stop_event and stop_event.is_set()):
+                checkpoint = state.get_checkpoint(sync_time_key)
+                if checkpoint is None:
+                    checkpoint = (settings.default_sync_time, None)
                     logger.debug(
-                        f"Ключ состояния {sync_time_key} для фильмов не найден, использовано значение по умолчанию: {last_synced_time}")
+                        f"Ключ состояния {sync_time_key} для {name} не найден, использовано значение по умолчанию: {checkpoint[0]}")
+                last_synced_time, last_id = checkpoint
+
+                processed = 0
+                if not loaded:
+                    loaded = state.get_state(initial_load_key(index_name), cached=False)
+                if incremental and loaded:
+                    (current_query, current_transform), current_hashes = incremental, None
                 else:
-                    # logger.debug(f"Последняя дата обновления фильмов (ключ {sync_time_key}): {last_synced_time}")
-                    pass
-
-                query = """
-                        SELECT
-                           fw.id AS id,
-                           fw.title AS title,
-                           fw.description AS description,
-                           fw.rating AS imdb_rating,
-                           fw.type AS type,
-                           fw.created AS created,
-                           fw.modified AS modified,
-                           COALESCE (
-                               json_agg(
-                                   DISTINCT jsonb_build_object(
-                                       'person_role', pfw.role,
-                                       'person_id', p.id,
-                                       'person_name', p.full_name
-                                   )
-                               ) FILTER (WHERE p.id is not null),
-                               '[]'
-                           ) as persons,
-                           array_agg(DISTINCT g.name) as genres
-                        FROM content.film_work fw
-                        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-                        LEFT JOIN content.person p ON p.id = pfw.person_id
-                        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-                        LEFT JOIN content.genre g ON g.id = gfw.genre_id
-                        WHERE fw.modified > %s
-                        GROUP BY fw.id
-                        ORDER BY fw.modified
-                        LIMIT %s;
-                    """
-                records = extract_data(pg_conn, query, last_synced_time)
+                    current_query, current_transform, current_hashes = query, transform, doc_hashes
+                    if incremental and before_full_load:
+                        before_full_load(pg_conn, state)
+                source = extract_data_stream(
+                    pg_conn, current_query, (last_synced_time, last_id or MIN_UUID) + partition_params,
+                    lambda: controller.batch_size)
+                stream = resolve(pg_conn, source) if resolve else source
+                batches = load_stream(
+                    es_client, stream, current_transform, index_name, parallel_transform, current_hashes,
+                    dead_letters)
+                for records, extract_time, transform_time, result in batches:
+                    controller.record_batch(
+                        len(records), extract_time + transform_time, result.duration, result.rejected)
+                    observe_batch(name, len(records), extract_time, transform_time, result)
+                    if after_load:
+                        after_load(records)
+                    if entity in REMOVED_ROWS_CHECKS:
+                        existing_query, doc_id = REMOVED_ROWS_CHECKS[entity]
+                        delete_removed_documents(
+                            es_client, pg_conn, existing_query,
+                            {str(record["id"]): str(record[doc_id]) for record in records},
+                            index_name, doc_hashes, dead_letters)
+
+                    new_last_synced_time = records[-1]["modified"].isoformat()
+                    state.set_checkpoint(sync_time_key, new_last_synced_time, records[-1]["id"])
+                    lag = observe_checkpoint(name, records[-1]["modified"])
+                    processed += len(records)
+                    logger.debug(
+                        f"Обработано и загружено {len(records)} записей {name}. "
+                        f"Последняя дата: {new_last_synced_time}, id: {records[-1]['id']}")
+                    yield PipelineStep(len(records), lag=lag, position=(records[-1]["modified"], records[-1]["id"]))
+                    if stop_event and stop_event.is_set():
+                        break
+                batches.close()
+                stream.close()
+                source.close()
+                # Поток дочитан (или остановлен): сохраняем накопленную контрольную точку
+                state.flush()
+                if doc_hashes:
+                    doc_hashes.report(name)
+
+                if partition is not None and caught_up != (not processed):
+                    caught_up = not processed
+                    state.set_state(caught_up_key(index_name, partition), "1" if caught_up else "")
+
+                if not processed:
+                    observe_checkpoint(name, None)
+                    if leader and (number_of_replicas or not promoted or not loaded) and all_partitions_caught_up(
+                            state, index_name, partition):
+                        if not loaded:
+                            state.set_state(initial_load_key(index_name), "1")
+                            loaded = "1"
+                        if number_of_replicas:
+                            disable_backfill_mode(es_client, index_name, number_of_replicas)
+                            state.set_state(backfill_key(index_name), "")
+                            number_of_replicas = None
+                        if not promoted:
+                            # Новая версия индекса догнала источник: переключаем на неё поиск
+                            old_versions = index_versions(es_client, alias)
+                            promote_index(es_client, alias, index_name)
+                            promoted = True
+                            if doc_hashes:
+                                for old_index in old_versions[:old_versions.index(index_name)]:
+                                    DocumentHashes(redis_conn, old_index).clear()
+                            continue
+                    sleep_time = controller.next_idle_sleep()
+                    if stop_event:
+                        # Партиция должна успеть освободиться до истечения аренды
+                        sleep_time = min(sleep_time, settings.lease_ttl / 3)
+                    yield PipelineStep(sleep=sleep_time)
+
+        except Exception as e:
+            logger.error(f"Ошибка во время ETL процесса {name}: {str(e)}")
+
+
+def etl_process(entity: str, mapping: dict, alias: str, query: str,
+                transform: Callable[[List[dict]], Generator[dict, None, None]],
+                partition: Optional[Tuple[int, int]] = None, **options) -> None:
+    """Основной ETL процесс сущности на текущем потоке, параметры — как у etl_steps."""
+    name = entity if partition is None else f"{entity}:p{partition[0]}"
+    run_steps(name, etl_steps(entity, mapping, alias, query, transform, partition, **options))
+
+
+@pipeline('filmwork', backlog_query=FILMWORK_BACKLOG_QUERY, enabled=lambda: settings.filmwork_partitions <= 1)
+def filmwork_steps() -> Generator[PipelineStep, None, None]:
+    if settings.filmwork_source_mode == "postgres":
+        return etl_steps('filmwork', FILMWORK_MAPPING, settings.filmwork_index_name, FILMWORK_DOCUMENT_QUERY,
+                         transform_filmwork_documents, parallel_transform=True)
+    if settings.filmwork_source_mode == "normalized":
+        return etl_steps('filmwork', FILMWORK_MAPPING, settings.filmwork_index_name, FILMWORK_NORMALIZED_QUERY,
+                         transform_filmwork, parallel_transform=True, resolve=resolve_filmwork_names)
+    return etl_steps('filmwork', FILMWORK_MAPPING, settings.filmwork_index_name, FILMWORK_QUERY, transform_filmwork,
+                     parallel_transform=True)
+
+
+def etl_filmwork() -> None:
+    """Основной ETL процесс для filmwork."""
+    run_steps('filmwork', filmwork_steps())
+
+
+def etl_filmwork_partition(partition: int, stop_event: threading.Event) -> None:
+    """ETL процесс одной партиции filmwork в шардированном режиме."""
+    resolve = None
+    if settings.filmwork_source_mode == "postgres":
+        query, transform = FILMWORK_DOCUMENT_PARTITION_QUERY, transform_filmwork_documents
+    elif settings.filmwork_source_mode == "normalized":
+        query, transform, resolve = FILMWORK_NORMALIZED_PARTITION_QUERY, transform_filmwork, resolve_filmwork_names
+    else:
+        query, transform = FILMWORK_PARTITION_QUERY, transform_filmwork
+    etl_process('filmwork', FILMWORK_MAPPING, settings.filmwork_index_name, query, transform,
+                partition=(partition, settings.filmwork_partitions), stop_event=stop_event, parallel_transform=True,
+                resolve=resolve)
+
+
+def etl_filmwork_sharded() -> None:
+    """Шардированный ETL filmwork: воркер обрабатывает партиции, взятые в аренду в Redis."""
+    run_partitioned('filmwork', settings.filmwork_partitions, etl_filmwork_partition)
+
+
+@pipeline('genres', backlog_query=GENRES_BACKLOG_QUERY)
+def genres_steps() -> Generator[PipelineStep, None, None]:
+    """Основной ETL процесс для genres.
+
+    В режиме filmwork_source_mode = "normalized" изменённые жанры сбрасываются из кеша имён.
+    """
+    after_load = GENRE_NAMES.invalidate_records if settings.filmwork_source_mode == "normalized" else None
+    return etl_steps('genres', GENRES_MAPPING, settings.genres_index_name, GENRES_QUERY, transform_genres,
+                     after_load=after_load)
+
+
+def etl_genres() -> None:
+    run_steps('genres', genres_steps())
+
+
+@pipeline('persons', backlog_query=PERSONS_BACKLOG_QUERY)
+def persons_steps() -> Generator[PipelineStep, None, None]:
+    """Основной ETL процесс для persons.
+
+    В режиме persons_movies_mode = "incremental" после первичной загрузки обновляется
+    только имя, а movies ведёт etl_persons_movies.
+    В режиме filmwork_source_mode = "normalized" изменённые персоналии сбрасываются из кеша имён.
+    """
+    incremental = before_full_load = None
+    if settings.persons_movies_mode == "incremental":
+        incremental = (PERSONS_NAME_QUERY, transform_persons_names)
+        before_full_load = persons_movies_replay
+    after_load = PERSON_NAMES.invalidate_records if settings.filmwork_source_mode == "normalized" else None
+    return etl_steps('persons', PERSONS_MAPPING, settings.persons_index_name, PERSONS_QUERY, transform_persons,
+                     incremental=incremental, after_load=after_load, before_full_load=before_full_load)
+
+
+def etl_persons() -> None:
+    run_steps('persons', persons_steps())
+
+
+@pipeline('persons_movies', backlog_query=PERSON_FILM_WORK_CHANGES_BACKLOG_QUERY,
+          enabled=lambda: settings.persons_movies_mode == "incremental")
+def persons_movies_steps() -> Generator[PipelineStep, None, None]:
+    """Инкрементальное обновление movies в документах persons по журналу связей person_film_work.
+
+    Каждая пачка журнала превращается в scripted update, добавляющие и удаляющие
+    отдельные id фильмов, поэтому фильмография персоналии не пересчитывается целиком.
+    Позиция в журнале хранится в состоянии; обработанные записи удаляются, когда журнал прочитан.
+
+    Изменения, scripted update которых Elasticsearch не принял, не ставятся в очередь недоставленных:
+    повтор дельты вне порядка журнала вернул бы отменённое позже изменение. Вместо этого их связи
+    снова записываются в журнал (см. requeue_link_changes).
+
+    Полные документы persons (первичная загрузка, см. persons_movies_replay) читаются из снимка,
+    который может быть старше уже применённых изменений, и затирают их. Поэтому после загрузки
+    позиция возвращается к началу загрузки и изменения применяются повторно,
+    а до этого обработанные записи журнала не удаляются.
+    """
+    es_client = get_shared_es_client()
+    with (pg_connection() as pg_conn,
+          get_redis_connection() as redis_conn):
+
+        # Индекс персоналий создаёт etl_persons
+        while not es_client.indices.exists(index=settings.persons_index_name):
+            yield PipelineStep(sleep=settings.default_sleep_time)
+
+        state = State(RedisStorage(redis_adapter=redis_conn))
+        dead_letters = DeadLetterQueue(redis_conn) if settings.dead_letter_queue else None
+        try:
+            controller = AdaptiveBatchController('persons_movies')
+            while True:
+                replay = state.get_state(PERSONS_MOVIES_REPLAY_KEY, cached=False)
+                if replay and all(state.get_state(initial_load_key(index_name), cached=False)
+                                  for index_name in index_versions(es_client, settings.persons_index_name)):
+                    # Первичная загрузка persons завершена: применяем изменения с её начала повторно
+                    current = parse_log_position(state.get_state(PERSONS_MOVIES_POSITION_KEY))
+                    replay_xid, replay_seq = parse_log_position(replay)
+                    if (int(replay_xid), replay_seq) < (int(current[0]), current[1]):
+                        state.set_state(PERSONS_MOVIES_POSITION_KEY, replay)
+                    state.set_state(PERSONS_MOVIES_REPLAY_KEY, "")
+                    logger.info(f"Изменения связей персоналий применяются повторно с позиции {replay}")
+                    replay = None
+
+                last_xid, last_seq = parse_log_position(state.get_state(PERSONS_MOVIES_POSITION_KEY))
+                started = time.perf_counter()
+                records = extract_data(
+                    pg_conn, PERSON_FILM_WORK_CHANGES_QUERY, params=(last_xid, last_seq, controller.batch_size))
+                extract_time = time.perf_counter() - started
                 if not records:
-                    # logger.debug(f"Нет новых записей фильмов для обработки. Ожидание {sleep_time} секунд...")
-                    time.sleep(sleep_time)
+                    if last_seq and not replay:
+                        with pg_conn.cursor() as cursor:
+                            cursor.execute(PERSON_FILM_WORK_CHANGES_PRUNE_QUERY, (last_xid, last_seq))
+                        pg_conn.commit()
+                    yield PipelineStep(sleep=controller.next_idle_sleep())
                     continue
 
-                sleep_time = settings.default_sleep_time
-                transformed_data = list(transform_filmwork(records))
-                load_data_to_es(es_client, transformed_data)
+                # Пишем во все версии индекса, чтобы строящаяся версия не отстала от рабочей
+                results = []
+                failed_links = set()
+                upserted = {str(record["person_id"]): str(record["person_id"]) for record in records if record["linked"]}
+                for index_name in index_versions(es_client, settings.persons_index_name):
+                    actions = list(transform_person_movies(records, index_name))
+                    results.append(load_data_to_es(es_client, actions, ignore_missing=True))
+                    failed_links |= failed_link_changes(actions, results[-1])
+                    # upsert не должен вернуть документ персоналии, удалённой после чтения журнала
+                    delete_removed_documents(
+                        es_client, pg_conn, PERSONS_EXISTING_IDS_QUERY, upserted, index_name,
+                        DocumentHashes(redis_conn, index_name) if settings.dedup_documents else None, dead_letters)
+                requeue_link_changes(pg_conn, failed_links)
+                result = merge_load_results(results)
+                controller.record_batch(len(records), extract_time, result.duration, result.rejected)
+                observe_batch('persons_movies', len(records), extract_time, 0.0, result)
 
-                new_last_synced_time = records[-1][6].isoformat()
-                state.set_state(sync_time_key, new_last_synced_time)
-                logger.debug(f"Обработано и загружено {len(records)} фильмов. Последняя дата: {new_last_synced_time}")
+                position = format_log_position(records[0]["last_xid"], records[0]["last_seq"])
+                state.set_state(PERSONS_MOVIES_POSITION_KEY, position)
+                logger.debug(f"Обработано {len(records)} изменений связей персоналий. Позиция журнала: {position}")
+                yield PipelineStep(len(records), position=(records[0]["last_xid"], records[0]["last_seq"]))
 
         except Exception as e:
-            logger.error(f"Ошибка во время ETL процесса фильмов: {str(e)}")
+            logger.error(f"Ошибка во время ETL процесса фильмографий персоналий: {str(e)}")
 
 
-def etl_genres()-> None:
-    """Основной ETL процесс для genres."""
-    with (get_pg_connection() as pg_conn,
-          get_es_client() as es_client,
-          get_redis_connection() as redis_conn):
+def etl_persons_movies() -> None:
+    run_steps('persons_movies', persons_movies_steps())
 
-        mapping = {
-            "settings": {
-                "refresh_interval": "1s",
-                "analysis": {
-                    "filter": {
-                        "english_stop": {
-                            "type": "stop",
-                            "stopwords": "_english_"
-                        },
-                        "english_stemmer": {
-                            "type": "stemmer",
-                            "language": "english"
-                        },
-                        "english_possessive_stemmer": {
-                            "type": "stemmer",
-                            "language": "possessive_english"
-                        },
-                        "russian_stop": {
-                            "type": "stop",
-                            "stopwords": "_russian_"
-                        },
-                        "russian_stemmer": {
-                            "type": "stemmer",
-                            "language": "russian"
-                        }
-                    },
-                    "analyzer": {
-                        "ru_en": {
-                            "tokenizer": "standard",
-                            "filter": [
-                                "lowercase",
-                                "english_stop",
-                                "english_stemmer",
-                                "english_possessive_stemmer",
-                                "russian_stop",
-                                "russian_stemmer"
-                            ]
-                        }
-                    }
-                }
-            },
-            "mappings": {
-                "dynamic": "strict",
-                "properties": {
-                    "id": {
-                        "type": "keyword"
-
-                    },
-                    "name": {
-                        "type": "keyword"
-                    }
-                }
-            }
-        }
-        create_index_with_mapping(es_client, mapping, settings.genres_index_name)
 
-        storage = RedisStorage(redis_adapter=redis_conn)
-        state = State(storage)
+def failed_link_changes(actions: List[dict], result: LoadResult) -> Set[Tuple[str, str]]:
+    """Связи (person_id, film_work_id) из scripted update, не принятых Elasticsearch.
+
+    Если загрузка прервана исключением, неизвестно, какие обновления применены: возвращаются все.
+    """
+    failed = [action for action, _ in result.failed]
+    if result.success + len(result.failed) != len(actions):
+        failed = actions
+    return {
+        (str(action["_id"]), str(film_work_id))
+        for action in failed
+        for film_work_id in action["script"]["params"]["add"] + action["script"]["params"]["remove"]
+    }
+
+
+def requeue_link_changes(pg_conn: PGConnection, links: Set[Tuple[str, str]]) -> None:
+    """Снова записать связи в журнал person_film_work_changes, чтобы порядок журнала решил итог."""
+    if not links:
+        return
+    person_ids, film_work_ids = zip(*links)
+    with pg_conn.cursor() as cursor:
+        cursor.execute(PERSON_FILM_WORK_CHANGES_REQUEUE_QUERY, (list(person_ids), list(film_work_ids)))
+    pg_conn.commit()
+    logger.warning(f"{len(links)} изменений связей персоналий не применено, они повторно записаны в журнал")
+
+
+def log_position(pg_conn: PGConnection) -> str:
+    """Позиция журналов изменений, с которой видны изменения всех транзакций, не завершённых к этому моменту."""
+    return format_log_position(extract_data(pg_conn, LOG_POSITION_QUERY, params=())[0]["xmin"], 0)
+
+
+def persons_movies_replay(pg_conn: PGConnection, state: State) -> None:
+    """Запомнить позицию журнала связей перед чтением полных документов persons.
+
+    Сохраняется самая ранняя позиция: с неё etl_persons_movies повторит изменения после загрузки.
+    """
+    if not state.get_state(PERSONS_MOVIES_REPLAY_KEY, cached=False):
+        state.set_state(PERSONS_MOVIES_REPLAY_KEY, log_position(pg_conn))
+
+
+@pipeline('deletes', backlog_query=TOMBSTONES_BACKLOG_QUERY, enabled=lambda: settings.propagate_deletes)
+def deletes_steps() -> Generator[PipelineStep, None, None]:
+    """ETL процесс удаления из Elasticsearch документов строк, удалённых в PostgreSQL.
+
+    Надгробия из content.tombstone читаются пачками по позиции (xid, seq) и превращаются
+    в bulk delete для всех версий индекса соответствующей таблицы. Обработанные
+    надгробия удаляются, когда ETL догнал источник.
+
+    Фильмы удалённых персоналий и жанров (film_work_ids надгробия) пересобираются через reindex_filmworks.
+
+    Читаются только удаления, зафиксированные не меньше settings.tombstone_delay секунд назад:
+    граница — xmin снимка, сделанного не раньше этого срока. Пока идёт загрузка из снимка,
+    надгробия не обрабатываются: её документы читаются из снимка до этих удалений.
+    """
+    table_indices = {
+        "film_work": settings.filmwork_index_name,
+        "person": settings.persons_index_name,
+        "genre": settings.genres_index_name,
+    }
+    es_client = get_shared_es_client()
+    with (pg_connection() as pg_conn,
+          get_redis_connection() as redis_conn):
+
+        state = State(RedisStorage(redis_adapter=redis_conn))
+        dead_letters = DeadLetterQueue(redis_conn) if settings.dead_letter_queue else None
         try:
-            sleep_time = settings.default_sleep_time
-            sync_time_key = 'last_synced_time_genres'
+            controller = AdaptiveBatchController('deletes')
+            # (время, xmin) снимков, ещё не достигших возраста tombstone_delay, и граница чтения надгробий
+            observed, visible_xid = deque(), None
             while True:
-                last_synced_time = state.get_state(sync_time_key)
-                if last_synced_time is None:
-                    last_synced_time = settings.default_sync_time
-                    logger.debug(
-                        f"Ключ состояния {sync_time_key} для жанров не найден, использовано значение по умолчанию: {last_synced_time}")
-                else:
-                    # logger.debug(f"Последняя дата обновления жанров (ключ {sync_time_key}): {last_synced_time}")
-                    pass
-
-                query = """
-                    SELECT
-                        g.id AS id,
-                        g.name AS name,
-                        g.modified 
-                    FROM content.genre g
-
-                    WHERE g.modified > %s
-                    GROUP BY g.id
-                    ORDER BY g.modified
-                    LIMIT %s;
-                """
-                records = extract_data(pg_conn, query, last_synced_time)
+                now = time.monotonic()
+                observed.append((now, extract_data(pg_conn, LOG_POSITION_QUERY, params=())[0]["xmin"]))
+                while observed and observed[0][0] <= now - settings.tombstone_delay:
+                    visible_xid = observed.popleft()[1]
+                if visible_xid is None or redis_conn.exists(SNAPSHOT_LOCK_KEY):
+                    yield PipelineStep(sleep=settings.tombstone_delay)
+                    continue
+
+                last_xid, last_seq = parse_log_position(state.get_state(DELETES_POSITION_KEY))
+                started = time.perf_counter()
+                records = extract_data(
+                    pg_conn, TOMBSTONES_QUERY, params=(last_xid, last_seq, visible_xid, controller.batch_size))
+                extract_time = time.perf_counter() - started
                 if not records:
-                    # logger.debug(f"Нет новых записей жанров для обработки. Ожидание {sleep_time} секунд...")
-                    time.sleep(sleep_time)
+                    if last_seq:
+                        with pg_conn.cursor() as cursor:
+                            cursor.execute(TOMBSTONES_PRUNE_QUERY, (last_xid, last_seq))
+                        pg_conn.commit()
+                    yield PipelineStep(sleep=controller.next_idle_sleep())
                     continue
 
-                sleep_time = settings.default_sleep_time
-                transformed_data = list(transform_genres(records))
-                load_data_to_es(es_client, transformed_data)
+                doc_ids = defaultdict(list)
+                for record in records:
+                    doc_ids[table_indices[record["table_name"]]].append(record["doc_id"])
 
-                new_last_synced_time = records[-1][2].isoformat()
-                state.set_state(sync_time_key, new_last_synced_time)
-                logger.debug(f"Обработано и загружено {len(records)} жанров. Последняя дата: {new_last_synced_time}")
+                results = []
+                for alias, ids in doc_ids.items():
+                    for index_name in index_versions(es_client, alias):
+                        actions = list(transform_deletes(ids, index_name))
+                        results.append(load_data_to_es(es_client, actions, ignore_missing=True))
+                        if dead_letters:
+                            dead_letters.track(actions, results[-1])
+                        if settings.dedup_documents:
+                            DocumentHashes(redis_conn, index_name).forget(ids)
+
+                # Фильмы удалённых персоналий и жанров: связи удалены каскадом, документы пересобираются
+                film_work_ids = sorted({
+                    film_work_id for record in records for film_work_id in record["film_work_ids"] or []})
+                for start in range(0, len(film_work_ids), settings.batch_size):
+                    _, _, reindexed = reindex_filmworks(
+                        es_client, pg_conn, redis_conn, film_work_ids[start:start + settings.batch_size], 'deletes',
+                        dead_letters)
+                    results.append(reindexed)
+                if film_work_ids:
+                    logger.debug(f"Переиндексировано {len(film_work_ids)} фильмов удалённых персоналий и жанров")
+                result = merge_load_results(results)
+                controller.record_batch(len(records), extract_time, result.duration, result.rejected)
+                observe_batch('deletes', len(records), extract_time, 0.0, result)
+
+                position = format_log_position(records[-1]["xid"], records[-1]["seq"])
+                state.set_state(DELETES_POSITION_KEY, position)
+                logger.debug(f"Удалено {len(records)} документов. Позиция надгробий: {position}")
+                yield PipelineStep(len(records), position=(records[-1]["xid"], records[-1]["seq"]))
 
         except Exception as e:
-            logger.error(f"Ошибка во время ETL процесса жанров: {str(e)}")
+            logger.error(f"Ошибка во время ETL процесса удалений: {str(e)}")
+
 
+def etl_deletes() -> None:
+    run_steps('deletes', deletes_steps())
 
-def etl_persons()-> None:
-    """Основной ETL процесс для persons."""
-    with (get_pg_connection() as pg_conn,
-          get_es_client() as es_client,
+
+def reindex_filmworks(es_client: Elasticsearch, pg_conn: PGConnection, redis_conn: Redis, film_work_ids: List[str],
+                      name: str, dead_letters: Optional[DeadLetterQueue] = None) -> Tuple[List[dict], float, LoadResult]:
+    """merger: сборка документов фильмов film_work_ids и загрузка во все версии индекса.
+
+    Возвращает (строки фильмов, время extract, LoadResult по всем версиям).
+    """
+    started = time.perf_counter()
+    if settings.filmwork_source_mode == "postgres":
+        records = extract_data(pg_conn, FILMWORK_DOCUMENT_BY_IDS_QUERY, params=(film_work_ids,))
+        transform = transform_filmwork_documents
+    elif settings.filmwork_source_mode == "normalized":
+        records = resolve_filmwork_batch(
+            pg_conn, extract_data(pg_conn, FILMWORK_NORMALIZED_BY_IDS_QUERY, params=(film_work_ids,)))
+        transform = transform_filmwork
+    else:
+        records = extract_data(pg_conn, FILMWORK_BY_IDS_QUERY, params=(film_work_ids,))
+        transform = transform_filmwork
+    extract_time = time.perf_counter() - started
+
+    # Пишем во все версии индекса, чтобы строящаяся версия не отстала от рабочей
+    results = []
+    for index_name in index_versions(es_client, settings.filmwork_index_name):
+        transformed_data = list(transform(records, index_name))
+        doc_hashes = DocumentHashes(redis_conn, index_name) if settings.dedup_documents else None
+        if doc_hashes:
+            transformed_data, digests = doc_hashes.skip_unchanged_actions(transformed_data)
+            result = load_data_to_es(es_client, transformed_data)
+            doc_hashes.remember([str(action["_id"]) for action in transformed_data], digests, result)
+            doc_hashes.report(name)
+        else:
+            result = load_data_to_es(es_client, transformed_data)
+        if dead_letters:
+            dead_letters.track(transformed_data, result)
+        delete_removed_documents(
+            es_client, pg_conn, FILMWORK_EXISTING_IDS_QUERY,
+            {str(record["id"]): str(record["id"]) for record in records}, index_name, doc_hashes, dead_letters)
+        results.append(result)
+    return records, extract_time, merge_load_results(results)
+
+
+def filmwork_related_steps(relation: str) -> Generator[PipelineStep, None, None]:
+    """ETL процесс переиндексации фильмов при изменении персоналий или жанров.
+
+    producer находит изменённые записи связанной таблицы, enricher пачками
+    находит id затронутых фильмов через таблицу связей, merger собирает
+    и загружает документы этих фильмов. Каждый этап хранит свою контрольную точку.
+    """
+    producer_query = FILMWORK_RELATIONS[relation]["producer_query"]
+    enricher_query = FILMWORK_RELATIONS[relation]["enricher_query"]
+    normalized = settings.filmwork_source_mode == "normalized"
+
+    es_client = get_shared_es_client()
+    with (pg_connection() as pg_conn,
           get_redis_connection() as redis_conn):
 
-        mapping = {
-            "settings": {
-                "refresh_interval": "1s",
-                "analysis": {
-                    "filter": {
-                        "english_stop": {
-                            "type": "stop",
-                            "stopwords": "_english_"
-                        },
-                        "english_stemmer": {
-                            "type": "stemmer",
-                            "language": "english"
-                        },
-                        "english_possessive_stemmer": {
-                            "type": "stemmer",
-                            "language": "possessive_english"
-                        },
-                        "russian_stop": {
-                            "type": "stop",
-                            "stopwords": "_russian_"
-                        },
-                        "russian_stemmer": {
-                            "type": "stemmer",
-                            "language": "russian"
-                        }
-                    },
-                    "analyzer": {
-                        "ru_en": {
-                            "tokenizer": "standard",
-                            "filter": [
-                                "lowercase",
-                                "english_stop",
-                                "english_stemmer",
-                                "english_possessive_stemmer",
-                                "russian_stop",
-                                "russian_stemmer"
-                            ]
-                        }
-                    }
-                }
-            },
-            "mappings": {
-                "dynamic": "strict",
-                "properties": {
-                    "id": {
-                        "type": "keyword"
-                    },
-                    "full_name": {
-                        "type": "text",
-                        "analyzer": "standard"
-                    },
-                    "movies": {
-                        "type": "keyword",
-                    }
-                }
-            }
-        }
-        create_index_with_mapping(es_client, mapping, settings.persons_index_name)
+        # Индекс фильмов создаёт etl_filmwork, дожидаемся его, чтобы не получить динамический маппинг
+        while not es_client.indices.exists(index=settings.filmwork_index_name):
+            yield PipelineStep(sleep=settings.default_sleep_time)
 
         storage = RedisStorage(redis_adapter=redis_conn)
         state = State(storage)
+        dead_letters = DeadLetterQueue(redis_conn) if settings.dead_letter_queue else None
         try:
-            sleep_time = settings.default_sleep_time
-            sync_time_key = 'last_synced_time_persons'
-
+            controller = AdaptiveBatchController(f'filmwork_{relation}')
+            producer_key = f'last_synced_time_filmwork_{relation}'
+            enricher_key = f'enricher_filmwork_{relation}'
             while True:
-                last_synced_time = state.get_state(sync_time_key)
-                if last_synced_time is None:
-                    last_synced_time = settings.default_sync_time
-                    logger.debug(
-                        f"Ключ состояния {sync_time_key} для персоналий не найден, использовано значение по умолчанию: {last_synced_time}")
+                # Незавершённая пачка producer'а после перезапуска дочитывается с места остановки
+                pending = state.get_state(enricher_key)
+                if pending:
+                    pending = json.loads(pending)
                 else:
-                    # logger.debug(f"Последняя дата обновления персоналий (ключ {sync_time_key}): {last_synced_time}")
-                    pass
-
-                query = """
-                        SELECT
-                            p.id AS person_id,
-                            p.full_name,
-                            json_agg(DISTINCT fw.id) AS movies,
-                            p.modified 
-                        FROM content.person p
-                        LEFT JOIN content.person_film_work pfw ON p.id = pfw.person_id
-                        LEFT JOIN content.film_work fw ON pfw.film_work_id = fw.id
-                        WHERE p.modified > %s
-                        GROUP BY p.id
-                        ORDER BY p.modified
-                        LIMIT %s;
-                        
-                    """
-                records = extract_data(pg_conn, query, last_synced_time)
-                if not records:
-                    # logger.debug(f"Нет новых записей персоналий для обработки. Ожидание {sleep_time} секунд...")
-                    time.sleep(sleep_time)
-                    continue
+                    last_synced_time, last_id = (
+                        state.get_checkpoint(producer_key) or (settings.default_sync_time, None))
+
+                    records = extract_data(
+                        pg_conn, producer_query, params=(last_synced_time, last_id or MIN_UUID, controller.batch_size))
+                    if not records:
+                        yield PipelineStep(sleep=controller.next_idle_sleep())
+                        continue
+                    if normalized:
+                        # Фильмы должны получить новые имена, даже если etl_persons/etl_genres ещё не сбросили кеш
+                        DIMENSION_CACHES[relation].invalidate_records(records)
+
+                    pending = {
+                        "ids": [record["id"] for record in records],
+                        "modified": records[-1]["modified"].isoformat(),
+                        "id": records[-1]["id"],
+                        "last_film_work_id": MIN_UUID,
+                    }
+                    state.set_state(enricher_key, json.dumps(pending))
+
+                started = time.perf_counter()
+                film_work_ids = [
+                    record["film_work_id"]
+                    for record in extract_data(
+                        pg_conn, enricher_query,
+                        params=(pending["ids"], pending["last_film_work_id"], controller.batch_size)
+                    )
+                ]
+                enrich_time = time.perf_counter() - started
+                if film_work_ids:
+                    records, extract_time, result = reindex_filmworks(
+                        es_client, pg_conn, redis_conn, film_work_ids, f'filmwork_{relation}', dead_letters)
+                    extract_time += enrich_time
+                    controller.record_batch(len(records), extract_time, result.duration, result.rejected)
+                    observe_batch(f'filmwork_{relation}', len(records), extract_time, 0.0, result)
 
-                sleep_time = settings.default_sleep_time
-                transformed_data = list(transform_persons(records))
-                load_data_to_es(es_client, transformed_data)
+                    pending["last_film_work_id"] = film_work_ids[-1]
+                    state.set_state(enricher_key, json.dumps(pending))
+                    logger.debug(
+                        f"Переиндексировано {len(records)} фильмов по изменениям {relation}. "
+                        f"Последний id фильма: {film_work_ids[-1]}")
+                    yield PipelineStep(len(records), lag=checkpoint_lag(datetime.fromisoformat(pending["modified"])),
+                                       position=(pending["modified"], pending.get("id") or MIN_UUID))
+                    continue
 
-                new_last_synced_time = records[-1][3].isoformat()
-                state.set_state(sync_time_key, new_last_synced_time)
+                # Все фильмы пачки producer'а обработаны
+                state.set_checkpoint(producer_key, pending["modified"], pending.get("id"))
+                state.set_state(enricher_key, "")
                 logger.debug(
-                    f"Обработано и загружено {len(records)} персоналий. Последняя дата: {new_last_synced_time}")
+                    f"Обработано {len(pending['ids'])} изменений {relation}. Последняя дата: {pending['modified']}")
 
         except Exception as e:
-            logger.error(f"Ошибка во время ETL процесса персоналий: {str(e)}")
+            logger.error(f"Ошибка во время ETL процесса связанных фильмов ({relation}): {str(e)}")
+
+
+def etl_filmwork_related(relation: str) -> None:
+    run_steps(f'filmwork_{relation}', filmwork_related_steps(relation))
+
+
+@pipeline('filmwork_person', backlog_query=PERSONS_BACKLOG_QUERY)
+def filmwork_persons_steps() -> Generator[PipelineStep, None, None]:
+    """Переиндексация фильмов при изменении персоналий."""
+    return filmwork_related_steps("person")
+
+
+@pipeline('filmwork_genre', backlog_query=GENRES_BACKLOG_QUERY)
+def filmwork_genres_steps() -> Generator[PipelineStep, None, None]:
+    """Переиндексация фильмов при изменении жанров."""
+    return filmwork_related_steps("genre")
+
+
+def etl_filmwork_persons() -> None:
+    etl_filmwork_related("person")
+
+
+def etl_filmwork_genres() -> None:
+    etl_filmwork_related("genre")
+
 
 
 
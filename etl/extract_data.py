@@ -1,19 +1,52 @@
 from psycopg2.extras import DictCursor
 from typing import Optional
-from typing import Generator, List
+from typing import Callable, Generator, List, Union
+import uuid
 
 from state import *
 from get_connections import *
 
 
-def extract_data(conn: PGConnection, query, last_synced_time: Optional[str] = None, batch_size: int = 100) -> List[dict]:
-    """Извлечение данных из PostgreSQL."""
+def extract_data(conn: PGConnection, query, last_synced_time: Optional[str] = None, batch_size: int = 100,
+                 params: Optional[tuple] = None) -> List[dict]:
+    """Извлечение данных из PostgreSQL.
+
+    По умолчанию запрос получает параметры (last_synced_time, batch_size),
+    для остальных запросов параметры передаются явно через params.
+    """
     # logger.debug(f"Последняя дата обновления: {last_synced_time}")
+    if params is None:
+        params = (last_synced_time, batch_size)
     try:
         with conn.cursor(cursor_factory=DictCursor) as cursor:
 
-            cursor.execute(query, (last_synced_time, batch_size))
+            cursor.execute(query, params)
             return cursor.fetchall()
     except Exception as e:
         logger.error(f"Ошибка при извлечении данных: {e}")
         raise
+
+
+def extract_data_stream(conn: PGConnection, query, params: tuple,
+                        chunk_size: Union[int, Callable[[], int]] = 100) -> Generator[List[dict], None, None]:
+    """Потоковое извлечение данных из PostgreSQL через серверный (именованный) курсор.
+
+    Запрос выполняется один раз, результат отдаётся пачками по chunk_size строк,
+    поэтому в памяти находится только текущая пачка.
+    chunk_size может быть функцией: тогда размер определяется перед каждой пачкой.
+    """
+    try:
+        with conn.cursor(name=f"etl_{uuid.uuid4().hex}", cursor_factory=DictCursor) as cursor:
+            cursor.execute(query, params)
+            while True:
+                records = cursor.fetchmany(chunk_size() if callable(chunk_size) else chunk_size)
+                if not records:
+                    break
+                yield records
+    except Exception as e:
+        logger.error(f"Ошибка при потоковом извлечении данных: {e}")
+        raise
+    finally:
+        # Серверный курсор живёт внутри транзакции: завершаем её, чтобы не держать снимок данных
+        if not conn.closed:
+            conn.rollback()
@@ -1,15 +1,57 @@
+import asyncio
+import json
+import threading
 import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import asyncpg
 import backoff
 import psycopg2
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import AsyncElasticsearch, Elasticsearch, helpers
+from elasticsearch.serializer import JsonSerializer, NdjsonSerializer
 from psycopg2.extensions import connection as PGConnection
+from psycopg2.pool import ThreadedConnectionPool
 
 import redis
 import elasticsearch
 from redis.client import Redis
+from redis.asyncio import Redis as AsyncRedis
 
 
 from settings import *
+from state import logger
+
+try:
+    from elasticsearch.serializer import OrjsonSerializer
+except ImportError:  # orjson не установлен
+    OrjsonSerializer = None
+
+if OrjsonSerializer is not None:
+    class OrjsonNdjsonSerializer(NdjsonSerializer, OrjsonSerializer):
+        """NDJSON (тело bulk) с кодированием строк через orjson."""
+
+
+def get_serializers() -> dict:
+    """Сериализаторы клиента Elasticsearch по settings.es_serializer (json | orjson).
+
+    orjson кодирует документы в несколько раз быстрее стандартного json и даёт тот же компактный
+    UTF-8 JSON; типы, которые он не знает (Decimal), сериализуются так же, как в JsonSerializer.
+    """
+    if settings.es_serializer == "orjson":
+        if OrjsonSerializer is None:
+            raise RuntimeError("es_serializer = orjson требует пакет orjson")
+        return {OrjsonSerializer.mimetype: OrjsonSerializer(), NdjsonSerializer.mimetype: OrjsonNdjsonSerializer()}
+    return {JsonSerializer.mimetype: JsonSerializer(), NdjsonSerializer.mimetype: NdjsonSerializer()}
+
+
+def get_json_serializer() -> JsonSerializer:
+    """Сериализатор JSON, которым клиент Elasticsearch кодирует документы bulk."""
+    return get_serializers()[JsonSerializer.mimetype]
+
+
+def es_client_options() -> dict:
+    """Общие параметры клиентов Elasticsearch: сериализаторы и сжатие тел запросов gzip (settings.es_http_compress)."""
+    return {"serializers": get_serializers(), "http_compress": settings.es_http_compress}
 
 
 @backoff.on_exception(
@@ -45,7 +87,234 @@ def get_es_client() -> Elasticsearch:
             'port': settings.elasticsearch_port,
             'scheme': 'http'
         }],
+        **es_client_options(),
+    )
+
+
+@backoff.on_exception(
+    backoff.expo,
+    exception=(redis.exceptions.BusyLoadingError, redis.exceptions.ConnectionError, redis.exceptions.TimeoutError),
+    jitter=backoff.full_jitter,
+    max_value=5,
+)
+def get_redis_connection() -> Redis:
+    """Клиент Redis поверх общего пула соединений с проверкой доступности."""
+    redis_conn = Redis(connection_pool=get_redis_pool())
+    redis_conn.ping()
+    return redis_conn
+
+
+# Интервал повторного предупреждения об ожидании соединения исчерпанного пула, секунды
+PG_POOL_WAIT_LOG_INTERVAL = 5.0
+
+# Общие для всех ETL процессов пулы соединений, создаются при первом обращении
+_pools_lock = threading.Lock()
+_pg_pool: Optional[ThreadedConnectionPool] = None
+_pg_pool_slots: Optional[threading.BoundedSemaphore] = None
+_pg_pool_reserved = 0
+_es_client: Optional[Elasticsearch] = None
+_redis_pool: Optional[redis.ConnectionPool] = None
+_redis_pool_reserved = 0
+
+
+@backoff.on_exception(
+    wait_gen=backoff.expo,
+    exception=psycopg2.OperationalError,
+    jitter=backoff.full_jitter,
+    max_value=5,
+)
+def get_pg_pool() -> ThreadedConnectionPool:
+    """Общий пул соединений PostgreSQL размером settings.pg_pool_min_size..pg_pool_size()."""
+    global _pg_pool, _pg_pool_slots
+    with _pools_lock:
+        if _pg_pool is None:
+            _pg_pool_slots = threading.BoundedSemaphore(pg_pool_size())
+            _pg_pool = ThreadedConnectionPool(
+                minconn=settings.pg_pool_min_size,
+                maxconn=pg_pool_size(),
+                host=settings.postgres_host,
+                port=settings.postgres_port,
+                user=settings.postgres_user,
+                password=settings.postgres_password,
+                database=settings.postgres_db
+            )
+        return _pg_pool
+
+
+def pg_pool_size() -> int:
+    """Размер пула: settings.pg_pool_max_size, но не меньше зарезервированного процессами."""
+    return max(settings.pg_pool_max_size, _pg_pool_reserved)
+
+
+def reserve_pool_connections(count: int) -> None:
+    """Зарезервировать count соединений в пулах PostgreSQL и Redis до их создания.
+
+    Процессы ETL держат соединение PostgreSQL всё время работы, поэтому пул меньше их числа
+    оставил бы часть процессов ждать соединения бесконечно; пул Redis общий для тех же процессов.
+    """
+    global _pg_pool_reserved, _redis_pool_reserved
+    with _pools_lock:
+        for name, pool, size in (("PostgreSQL", _pg_pool, settings.pg_pool_max_size),
+                                 ("Redis", _redis_pool, settings.redis_pool_size)):
+            if pool is not None:
+                logger.warning(f"Пул соединений {name} уже создан, резерв {count} соединений не учтён")
+            elif count > size:
+                logger.warning(f"Размер пула {name} {size} меньше числа процессов ETL; пул увеличен до {count}")
+        if _pg_pool is None:
+            _pg_pool_reserved = max(_pg_pool_reserved, count)
+        if _redis_pool is None:
+            _redis_pool_reserved = max(_redis_pool_reserved, count)
+
+
+def acquire_pg_pool_slot() -> None:
+    """Дождаться свободного соединения пула: ThreadedConnectionPool.getconn при исчерпании не ждёт, а падает."""
+    get_pg_pool()
+    while not _pg_pool_slots.acquire(timeout=PG_POOL_WAIT_LOG_INTERVAL):
+        logger.warning(f"Пул соединений PostgreSQL исчерпан (размер {pg_pool_size()}), "
+                       f"ожидание свободного соединения; увеличьте pg_pool_max_size")
+
+
+@backoff.on_exception(
+    wait_gen=backoff.expo,
+    exception=(psycopg2.OperationalError, psycopg2.InterfaceError),
+    jitter=backoff.full_jitter,
+    max_value=5,
+)
+def checkout_pg_connection() -> PGConnection:
+    """Выдача соединения из пула с проверкой: разорванное соединение закрывается и запрашивается новое.
+
+    При исчерпании пула ждёт возврата соединения; вернуть соединение нужно через release_pg_connection.
+    """
+    pool = get_pg_pool()
+    acquire_pg_pool_slot()
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _pg_pool_slots.release()
+        raise
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        conn.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        release_pg_connection(conn, close=True)
+        raise
+    return conn
+
+
+def release_pg_connection(conn: PGConnection, close: bool = False) -> None:
+    """Возврат соединения в пул и освобождение места для ждущих checkout_pg_connection."""
+    try:
+        get_pg_pool().putconn(conn, close=close)
+    finally:
+        _pg_pool_slots.release()
+
+
+@contextmanager
+def pg_connection() -> Iterator[PGConnection]:
+    """Соединение PostgreSQL из общего пула на время блока with."""
+    conn = checkout_pg_connection()
+    try:
+        yield conn
+    finally:
+        try:
+            if not conn.closed:
+                conn.rollback()
+        finally:
+            release_pg_connection(conn, close=bool(conn.closed))
+
+
+@backoff.on_exception(
+    wait_gen=backoff.expo,
+    exception=(elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout),
+    jitter=backoff.full_jitter,
+    max_value=5,
+)
+def get_shared_es_client() -> Elasticsearch:
+    """Общий для всех ETL процессов клиент Elasticsearch (один транспорт и пул HTTP соединений).
+
+    Клиент потокобезопасен; закрывать его в ETL процессах не нужно.
+    """
+    global _es_client
+    with _pools_lock:
+        if _es_client is None:
+            _es_client = Elasticsearch(
+                hosts=[{
+                    'host': settings.elasticsearch_host,
+                    'port': settings.elasticsearch_port,
+                    'scheme': 'http'
+                }],
+                connections_per_node=settings.es_connections_per_node,
+                **es_client_options(),
+            )
+    _es_client.info()
+    return _es_client
+
+
+def get_redis_pool() -> redis.ConnectionPool:
+    """Общий пул соединений Redis размером settings.redis_pool_size (не меньше зарезервированного).
+
+    При исчерпании пула команда ждёт свободного соединения до settings.redis_pool_timeout секунд,
+    а не падает с ConnectionError("Too many connections").
+    """
+    global _redis_pool
+    with _pools_lock:
+        if _redis_pool is None:
+            _redis_pool = redis.BlockingConnectionPool(
+                host=settings.redis_host,
+                port=settings.redis_port,
+                max_connections=max(settings.redis_pool_size, _redis_pool_reserved),
+                timeout=settings.redis_pool_timeout,
+                decode_responses=True,
+            )
+        return _redis_pool
+
+
+@backoff.on_exception(
+    wait_gen=backoff.expo,
+    exception=(OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError),
+    jitter=backoff.full_jitter,
+    max_value=5,
+)
+async def get_async_pg_connection() -> asyncpg.Connection:
+    """Асинхронное подключение к PostgreSQL.
+
+    json и uuid декодируются так же, как в psycopg2: в объекты Python и строки.
+    """
+    conn = await asyncpg.connect(
+        host=settings.postgres_host,
+        port=settings.postgres_port,
+        user=settings.postgres_user,
+        password=settings.postgres_password,
+        database=settings.postgres_db
+    )
+    await conn.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+    await conn.set_type_codec('uuid', encoder=str, decoder=str, schema='pg_catalog', format='text')
+    return conn
+
+
+@backoff.on_exception(
+    wait_gen=backoff.expo,
+    exception=(elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout),
+    jitter=backoff.full_jitter,
+    max_value=5,
+)
+async def get_async_es_client() -> AsyncElasticsearch:
+    """Асинхронное подключение к Elasticsearch с попытками повторного подключения."""
+    es_client = AsyncElasticsearch(
+        hosts=[{
+            'host': settings.elasticsearch_host,
+            'port': settings.elasticsearch_port,
+            'scheme': 'http'
+        }],
+        **es_client_options(),
     )
+    try:
+        await es_client.info()
+    except Exception:
+        await es_client.close()
+        raise
+    return es_client
 
 
 @backoff.on_exception(
@@ -54,5 +323,7 @@ def get_es_client() -> Elasticsearch:
     jitter=backoff.full_jitter,
     max_value=5,
 )
-def get_redis_connection():
-    return Redis(host=settings.redis_host, port=settings.redis_port, decode_responses=True)
\ No newline at end of file
+async def get_async_redis_connection() -> AsyncRedis:
+    redis_conn = AsyncRedis(host=settings.redis_host, port=settings.redis_port, decode_responses=True)
+    await redis_conn.ping()
+    return redis_conn
@@ -1,15 +1,216 @@
-from typing import Generator, List
+import asyncio
+import json
+from functools import partial
+from typing import Callable, Generator, Iterator, List, NamedTuple, Tuple
 
 from state import *
 from get_connections import *
 
+# Статусы, при которых документ имеет смысл отправить повторно:
+# перегрузка очереди индексации (429) и временная недоступность узлов.
+RETRYABLE_STATUSES = {429, 502, 503, 504}
 
-def load_data_to_es(es_client: Elasticsearch, transformed_data: List[dict]) -> None:
-    """ Загрузка данных в Elasticsearch с использованием bulk API """
+
+class LoadResult(NamedTuple):
+    """Итог загрузки пачки документов в Elasticsearch."""
+    success: int
+    failed: List[Tuple[dict, dict]]  # (действие bulk, ответ Elasticsearch по документу)
+    rejected: int  # сколько раз документы отклонялись с 429
+    duration: float
+
+
+def report_load_result(result: LoadResult) -> LoadResult:
+    """Логирование ошибок по каждому документу и пропускной способности загрузки."""
+    for action, info in result.failed:
+        logger.error(f"Документ {action.get('_id')} не удалось проиндексировать: "
+                     f"{info.get('status')} {info.get('error')}")
+    logger.debug(f"Успешно проиндексировано {result.success} документ(ов) за {result.duration:.2f} с "
+                 f"({result.success / result.duration if result.duration else 0:.0f} док/с).")
+    return result
+
+
+def merge_load_results(results: List[LoadResult]) -> LoadResult:
+    """Суммарный итог нескольких загрузок, например, в разные версии индекса."""
+    return LoadResult(
+        sum(result.success for result in results),
+        [failure for result in results for failure in result.failed],
+        sum(result.rejected for result in results),
+        sum(result.duration for result in results),
+    )
+
+
+def bulk_results(es_client: Elasticsearch, actions: List[dict],
+                 require_alias: bool = False) -> Generator[Tuple[bool, dict], None, None]:
+    """Результаты bulk по каждому документу в порядке actions.
+
+    В режиме parallel чанки отправляются пулом потоков parallel_bulk,
+    иначе последовательно через streaming_bulk.
+    С require_alias _index должен быть alias: отсутствующий индекс не создаётся.
+    """
+    options = dict(
+        chunk_size=settings.es_bulk_chunk_size,
+        max_chunk_bytes=settings.es_bulk_max_chunk_bytes,
+        raise_on_error=False,
+        raise_on_exception=False,
+    )
+    if require_alias:
+        options["require_alias"] = True
+    if settings.es_bulk_mode == "parallel":
+        return helpers.parallel_bulk(es_client, actions, thread_count=settings.es_bulk_thread_count, **options)
+    return helpers.streaming_bulk(es_client, actions, **options)
+
+
+def ndjson_bulk_results(es_client: Elasticsearch,
+                        operations: List[bytes]) -> Generator[Tuple[bool, dict], None, None]:
+    """Результаты bulk по каждой готовой NDJSON-операции в порядке operations.
+
+    Операции отправляются чанками по settings.es_bulk_chunk_size без повторной сериализации.
+    """
+    for start in range(0, len(operations), settings.es_bulk_chunk_size):
+        chunk = operations[start:start + settings.es_bulk_chunk_size]
+        response = es_client.bulk(operations=b"".join(chunk))
+        for item in response["items"]:
+            info = next(iter(item.values()))
+            yield 200 <= info.get("status", 500) < 300, item
+
+
+def load_with_retries(es_client: Elasticsearch, actions: list,
+                      results: Callable[[Elasticsearch, list], Iterator[Tuple[bool, dict]]],
+                      ignore_missing: bool = False) -> LoadResult:
+    """Загрузка actions через results (bulk_results или ndjson_bulk_results) с повтором временных ошибок.
+
+    Документы, отклонённые с временной ошибкой (см. RETRYABLE_STATUSES),
+    отправляются повторно до settings.es_bulk_max_retries раз, остальные
+    ошибки логируются по каждому документу и возвращаются в LoadResult.failed.
+    С ignore_missing обновление отсутствующего документа (404) не считается ошибкой.
+    """
+    started = time.perf_counter()
+    success = 0
+    rejected = 0
+    failed = []
+    try:
+        for attempt in range(settings.es_bulk_max_retries + 1):
+            retry = []
+            for action, (ok, item) in zip(actions, results(es_client, actions)):
+                info = next(iter(item.values()))
+                if ok or (ignore_missing and info.get("status") == 404):
+                    success += 1
+                    continue
+                if info.get("status") == 429:
+                    rejected += 1
+                if info.get("status") in RETRYABLE_STATUSES and attempt < settings.es_bulk_max_retries:
+                    retry.append(action)
+                else:
+                    failed.append((action, info))
+            if not retry:
+                break
+            logger.warning(f"Повторная отправка {len(retry)} документ(ов), попытка {attempt + 1}.")
+            time.sleep(min(2 ** attempt, settings.default_sleep_time))
+            actions = retry
+    except Exception as e:
+        logger.error(f"Ошибка: {e}")
+
+    return LoadResult(success, failed, rejected, time.perf_counter() - started)
+
+
+def load_data_to_es(es_client: Elasticsearch, transformed_data: List[dict],
+                    ignore_missing: bool = False, require_alias: bool = False) -> LoadResult:
+    """ Загрузка данных в Elasticsearch с использованием bulk API
+
+    Временные ошибки повторяются, см. load_with_retries; require_alias — см. bulk_results.
+    """
+    results = partial(bulk_results, require_alias=require_alias)
+    return report_load_result(load_with_retries(es_client, transformed_data, results, ignore_missing))
+
+
+def split_ndjson(body: bytes) -> List[bytes]:
+    """Разбиение NDJSON-тела bulk на операции: строка метаданных и строка _source."""
+    lines = body.split(b"\n")
+    return [lines[i] + b"\n" + lines[i + 1] + b"\n" for i in range(0, len(lines) - 1, 2)]
+
+
+def load_ndjson_to_es(es_client: Elasticsearch, operations: List[bytes]) -> LoadResult:
+    """Загрузка готовых NDJSON-операций bulk (см. transform_pool, split_ndjson) в Elasticsearch.
+
+    Неудавшиеся документы возвращаются в LoadResult.failed как действия bulk
+    с _source-строкой, пригодные для повторной отправки через load_data_to_es.
+    """
+    result = load_with_retries(es_client, operations, ndjson_bulk_results)
+    failed = []
+    for operation, info in result.failed:
+        metadata, source = operation.split(b"\n", 2)[:2]
+        action = json.loads(metadata)["index"]
+        action["_source"] = source.decode("utf-8")
+        failed.append((action, info))
+    return report_load_result(result._replace(failed=failed))
+
+
+async def async_bulk_results(es_client: AsyncElasticsearch, actions: List[dict]) -> List[Tuple[bool, dict]]:
+    """Результаты bulk по каждому документу в порядке actions для asyncio-движка.
+
+    В режиме parallel чанки отправляются одновременно, не больше settings.es_bulk_thread_count
+    запросов сразу (как потоки parallel_bulk), иначе последовательно через async_streaming_bulk.
+    """
+    options = dict(
+        chunk_size=settings.es_bulk_chunk_size,
+        max_chunk_bytes=settings.es_bulk_max_chunk_bytes,
+        raise_on_error=False,
+        raise_on_exception=False,
+    )
+
+    async def send(chunk: List[dict]) -> List[Tuple[bool, dict]]:
+        return [result async for result in helpers.async_streaming_bulk(es_client, chunk, **options)]
+
+    if settings.es_bulk_mode != "parallel":
+        return await send(actions)
+
+    requests = asyncio.Semaphore(settings.es_bulk_thread_count)
+
+    async def send_chunk(chunk: List[dict]) -> List[Tuple[bool, dict]]:
+        async with requests:
+            return await send(chunk)
+
+    chunks = [actions[start:start + settings.es_bulk_chunk_size]
+              for start in range(0, len(actions), settings.es_bulk_chunk_size)]
+    return [result for results in await asyncio.gather(*map(send_chunk, chunks)) for result in results]
+
+
+async def async_load_with_retries(es_client: AsyncElasticsearch, actions: List[dict],
+                                  ignore_missing: bool = False) -> LoadResult:
+    """Асинхронный вариант load_with_retries: те же статусы повтора, паузы и учёт LoadResult.failed."""
+    started = time.perf_counter()
+    success = 0
+    rejected = 0
+    failed = []
     try:
-        success, failed = helpers.bulk(es_client, transformed_data, raise_on_error=False)
-        if failed:
-            logger.error(f"{failed} документ(ов) не удалось проиндексировать.")
-        logger.debug(f"Успешно проиндексировано {success} документ(ов).")
+        for attempt in range(settings.es_bulk_max_retries + 1):
+            retry = []
+            for action, (ok, item) in zip(actions, await async_bulk_results(es_client, actions)):
+                info = next(iter(item.values()))
+                if ok or (ignore_missing and info.get("status") == 404):
+                    success += 1
+                    continue
+                if info.get("status") == 429:
+                    rejected += 1
+                if info.get("status") in RETRYABLE_STATUSES and attempt < settings.es_bulk_max_retries:
+                    retry.append(action)
+                else:
+                    failed.append((action, info))
+            if not retry:
+                break
+            logger.warning(f"Повторная отправка {len(retry)} документ(ов), попытка {attempt + 1}.")
+            await asyncio.sleep(min(2 ** attempt, settings.default_sleep_time))
+            actions = retry
     except Exception as e:
         logger.error(f"Ошибка: {e}")
+
+    return LoadResult(success, failed, rejected, time.perf_counter() - started)
+
+
+async def async_load_data_to_es(es_client: AsyncElasticsearch, transformed_data: List[dict],
+                                ignore_missing: bool = False) -> LoadResult:
+    """ Асинхронная загрузка данных в Elasticsearch с использованием bulk API
+
+    Временные ошибки повторяются, см. async_load_with_retries.
+    """
+    return report_load_result(await async_load_with_retries(es_client, transformed_data, ignore_missing))
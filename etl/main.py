@@ -1,9 +1,43 @@
+import asyncio
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from etl import *
+from async_etl import ASYNC_PIPELINES, async_main
+from dead_letter import dead_letter_worker
+from metrics import start_metrics_server
+from notify import start_change_listener
+from scheduler import enabled_pipelines, run_scheduler, run_steps
+from snapshot import snapshot_backfill
+
+def dedicated_tasks() -> list:
+    """Задачи на отдельных потоках вне зарегистрированных процессов (scheduler.pipeline)."""
+    tasks = []
+    if settings.filmwork_partitions > 1:
+        tasks.append(etl_filmwork_sharded)
+    if settings.dead_letter_queue:
+        tasks.append(dead_letter_worker)
+    return tasks
+
+
+def reserve_connections() -> None:
+    """Резерв соединений пулов PostgreSQL и Redis: по одному на процесс, партицию filmwork и задачу, плюс одно."""
+    partitions = settings.filmwork_partitions if settings.filmwork_partitions > 1 else 0
+    reserve_pool_connections(len(enabled_pipelines()) + partitions + len(dedicated_tasks()) + 1)
+
 
 def main():
-    with ThreadPoolExecutor(max_workers=3) as pool:  # Устанавливаем max_workers на 3 для выполнения всех задач параллельно
-        tasks = [etl_filmwork, etl_genres, etl_persons]
+    reserve_connections()
+    if settings.etl_engine == "asyncio":
+        # Процессы сущностей выполняет цикл событий, остальные зарегистрированные процессы — общий пул потоков
+        pipelines = [registered for registered in enabled_pipelines() if registered.name not in ASYNC_PIPELINES]
+        tasks = [partial(asyncio.run, async_main()), partial(run_scheduler, pipelines)] + dedicated_tasks()
+    elif settings.etl_engine == "scheduler":
+        # Зарегистрированные процессы делят общий пул потоков, остальные задачи — по потоку
+        tasks = [partial(run_scheduler, enabled_pipelines())] + dedicated_tasks()
+    else:
+        tasks = [partial(run_steps, registered.name, registered.steps()) for registered in enabled_pipelines()]
+        tasks += dedicated_tasks()
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:  # По потоку на каждую задачу для параллельного выполнения
         futures = [pool.submit(task) for task in tasks]
 
         for future in futures:
@@ -15,6 +49,10 @@ def main():
     logger.info("Все ETL процессы завершены.")
 
 if __name__ == "__main__":
+    start_metrics_server()
+    start_change_listener()
+    if settings.snapshot_backfill:
+        snapshot_backfill()
     main()
 
 
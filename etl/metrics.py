@@ -0,0 +1,82 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from state import *
+from settings import *
+
+# Метки pipeline — имя ETL процесса (filmwork, filmwork:p0, persons, filmwork_person, deletes, ...)
+STAGE_SECONDS = Histogram(
+    "etl_stage_seconds", "Длительность этапа обработки пачки", ["pipeline", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+BATCH_ROWS = Histogram(
+    "etl_batch_rows", "Число строк в пачке", ["pipeline"],
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+ROWS = Counter("etl_rows_total", "Строки, извлечённые из PostgreSQL", ["pipeline"])
+DOCS = Counter("etl_docs_total", "Документы, отправленные в Elasticsearch, по результату", ["pipeline", "result"])
+BULK_FAILURES = Counter("etl_bulk_failures_total", "Ошибки bulk по документам", ["pipeline", "status"])
+BULK_REJECTED = Counter("etl_bulk_rejected_total", "Отказы Elasticsearch с 429, включая повторённые", ["pipeline"])
+LOAD_DOCS_PER_SECOND = Gauge("etl_load_docs_per_second", "Скорость загрузки последней пачки", ["pipeline"])
+ROWS_PER_SECOND = Gauge("etl_rows_per_second", "Скорость обработки последней пачки целиком", ["pipeline"])
+BATCH_SIZE = Gauge("etl_batch_size", "Текущий размер пачки AdaptiveBatchController", ["pipeline"])
+ADAPTIVE_DECISIONS = Counter(
+    "etl_adaptive_decisions_total", "Решения AdaptiveBatchController", ["pipeline", "decision"])
+CHECKPOINT_LAG = Gauge(
+    "etl_checkpoint_lag_seconds", "Отставание контрольной точки: now - last_synced_time, 0 когда источник прочитан",
+    ["pipeline"])
+DEDUP_SKIPPED = Counter("etl_dedup_skipped_total", "Неизменённые документы, не отправленные в bulk", ["index"])
+DIMENSION_CACHE_LOOKUPS = Counter(
+    "etl_dimension_cache_lookups_total", "Поиск имён в кеше справочника по результату (hit, miss)", ["cache", "result"])
+DEAD_LETTERS = Gauge("etl_dead_letters", "Документы в очереди недоставленных (queued) и исчерпавшие попытки (parked)",
+                     ["state"])
+DIMENSION_CACHE_SIZE = Gauge("etl_dimension_cache_size", "Число записей в кеше справочника", ["cache"])
+PIPELINE_BACKLOG = Gauge(
+    "etl_pipeline_backlog", "Оценка необработанных строк источника по данным планировщика (не больше scheduler_backlog_limit)",
+    ["pipeline"])
+PIPELINE_PRIORITY = Gauge("etl_pipeline_priority", "Приоритет процесса при последнем выборе планировщиком", ["pipeline"])
+
+
+def start_metrics_server() -> None:
+    """HTTP endpoint /metrics для Prometheus на settings.metrics_port (0 — выключен)."""
+    if settings.metrics_port:
+        start_http_server(settings.metrics_port, addr=settings.metrics_host)
+        logger.info(f"Метрики Prometheus доступны на {settings.metrics_host}:{settings.metrics_port}/metrics")
+
+
+def observe_batch(pipeline: str, rows: int, extract_time: float, transform_time: float, result) -> None:
+    """Учесть обработанную пачку: длительности этапов, объёмы и ошибки загрузки (LoadResult)."""
+    STAGE_SECONDS.labels(pipeline, "extract").observe(extract_time)
+    STAGE_SECONDS.labels(pipeline, "transform").observe(transform_time)
+    STAGE_SECONDS.labels(pipeline, "load").observe(result.duration)
+    BATCH_ROWS.labels(pipeline).observe(rows)
+    ROWS.labels(pipeline).inc(rows)
+    DOCS.labels(pipeline, "success").inc(result.success)
+    DOCS.labels(pipeline, "failed").inc(len(result.failed))
+    for _, info in result.failed:
+        BULK_FAILURES.labels(pipeline, str(info.get("status"))).inc()
+    BULK_REJECTED.labels(pipeline).inc(result.rejected)
+    if result.duration:
+        LOAD_DOCS_PER_SECOND.labels(pipeline).set(result.success / result.duration)
+    total_time = extract_time + transform_time + result.duration
+    if total_time:
+        ROWS_PER_SECOND.labels(pipeline).set(rows / total_time)
+
+
+def checkpoint_lag(modified: datetime) -> float:
+    """Отставание modified от текущего времени в секундах."""
+    # Колонки modified без часового пояса хранят UTC
+    now = datetime.now(timezone.utc) if modified.tzinfo else datetime.now(timezone.utc).replace(tzinfo=None)
+    return max((now - modified).total_seconds(), 0)
+
+
+def observe_checkpoint(pipeline: str, modified: Optional[datetime]) -> float:
+    """Отставание контрольной точки от текущего времени; None — источник прочитан полностью.
+
+    Возвращает отставание в секундах.
+    """
+    lag = 0.0 if modified is None else checkpoint_lag(modified)
+    CHECKPOINT_LAG.labels(pipeline).set(lag)
+    return lag
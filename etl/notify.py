@@ -0,0 +1,109 @@
+import select
+import threading
+from collections import defaultdict
+from typing import Callable
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from state import *
+from get_connections import *
+
+# Канал, в который триггеры content.* отправляют имя изменённой таблицы
+CHANNEL = "etl_changes"
+
+# Какие ETL процессы будить при изменении таблицы
+TABLE_SUBSCRIBERS = {
+    "film_work": ["filmwork", "deletes"],
+    "person": ["persons", "filmwork_person", "deletes"],
+    "genre": ["genres", "filmwork_genre", "deletes"],
+    "person_film_work": ["filmwork", "persons", "persons_movies"],
+    "genre_film_work": ["filmwork"],
+}
+
+
+class ChangeListener:
+    """Слушатель LISTEN/NOTIFY, будящий ETL процессы при изменениях в PostgreSQL."""
+
+    def __init__(self) -> None:
+        self.events = defaultdict(threading.Event)
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def event(self, pipeline: str) -> threading.Event:
+        with self.lock:
+            return self.events[pipeline]
+
+    def wait(self, pipeline: str, timeout: float) -> bool:
+        """Ждать изменений для pipeline не дольше timeout секунд.
+
+        Возвращает True, если процесс разбужен уведомлением.
+        """
+        event = self.event(pipeline)
+        woken = event.wait(timeout)
+        event.clear()
+        return woken
+
+    def subscribe(self, callback: Callable[[str], None]) -> None:
+        """Вызывать callback(pipeline) при уведомлении для процесса, например, в планировщике scheduler.py."""
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def notify(self, table: str) -> None:
+        """Разбудить подписчиков таблицы, включая партиции процесса (pipeline:pN)."""
+        with self.lock:
+            for pipeline in TABLE_SUBSCRIBERS.get(table, []):
+                self.events[pipeline].set()
+                for name, event in self.events.items():
+                    if name.startswith(f"{pipeline}:"):
+                        event.set()
+            callbacks = list(self.callbacks)
+        for pipeline in TABLE_SUBSCRIBERS.get(table, []):
+            for callback in callbacks:
+                callback(pipeline)
+
+    def listen(self) -> None:
+        """Получение уведомлений из канала CHANNEL на отдельном соединении."""
+        conn = get_pg_connection()
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL};")
+            logger.info(f"Подписка на уведомления PostgreSQL ({CHANNEL}) включена")
+
+            while True:
+                if select.select([conn], [], [], settings.default_sleep_time) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self.notify(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def run(self) -> None:
+        """Бесконечное прослушивание с переподключением.
+
+        Пока слушатель не работает, ETL процессы продолжают опрос с интервалом default_sleep_time.
+        """
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                logger.error(f"Ошибка слушателя уведомлений PostgreSQL: {str(e)}")
+                time.sleep(settings.default_sleep_time)
+
+
+change_listener = ChangeListener()
+
+
+def start_change_listener() -> None:
+    """Запуск слушателя уведомлений в фоновом потоке, если включён settings.use_pg_notify."""
+    if settings.use_pg_notify:
+        threading.Thread(target=change_listener.run, name="pg-notify", daemon=True).start()
+
+
+def wait_for_changes(pipeline: str, timeout: float) -> None:
+    """Ожидание новых данных: до уведомления LISTEN/NOTIFY или, как запасной вариант, timeout секунд."""
+    if settings.use_pg_notify:
+        change_listener.wait(pipeline, timeout)
+    else:
+        time.sleep(timeout)
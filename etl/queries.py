@@ -0,0 +1,398 @@
+"""SQL-запросы ETL процессов."""
+
+FILMWORK_SELECT = """
+    SELECT
+       fw.id AS id,
+       fw.title AS title,
+       fw.description AS description,
+       fw.rating AS imdb_rating,
+       fw.type AS type,
+       fw.created AS created,
+       fw.modified AS modified,
+       COALESCE (
+           json_agg(
+               DISTINCT jsonb_build_object(
+                   'person_role', pfw.role,
+                   'person_id', p.id,
+                   'person_name', p.full_name
+               )
+           ) FILTER (WHERE p.id is not null),
+           '[]'
+       ) as persons,
+       array_agg(DISTINCT g.name) as genres
+    FROM content.film_work fw
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+"""
+
+# Запросы основных ETL процессов читаются потоково через серверный курсор, поэтому без LIMIT.
+# Фильтр по составному keyset-курсору (modified, id) не теряет записи с одинаковым modified.
+FILMWORK_QUERY = FILMWORK_SELECT + """
+    WHERE (fw.modified, fw.id) > (%s, %s::uuid)
+    GROUP BY fw.id
+    ORDER BY fw.modified, fw.id;
+"""
+
+# Партиция фильмов по хешу id для шардированного режима (settings.filmwork_partitions > 1).
+# Маска вместо abs(): abs(hashtext) переполняется на минимальном int4.
+FILMWORK_PARTITION_FILTER = "mod(hashtext(fw.id::text) & 2147483647, %s) = %s"
+
+FILMWORK_PARTITION_QUERY = FILMWORK_SELECT + f"""
+    WHERE (fw.modified, fw.id) > (%s, %s::uuid)
+      AND {FILMWORK_PARTITION_FILTER}
+    GROUP BY fw.id
+    ORDER BY fw.modified, fw.id;
+"""
+
+# Фильмы по списку id: последний шаг (merger) переиндексации связанных фильмов.
+FILMWORK_BY_IDS_QUERY = FILMWORK_SELECT + """
+    WHERE fw.id = ANY(%s::uuid[])
+    GROUP BY fw.id;
+"""
+
+# Готовый _source документа movies, собранный в PostgreSQL (settings.filmwork_source_mode = "postgres").
+# Документ передаётся в bulk как текст, без разбора и повторной сериализации в Python.
+# Персоналии и жанры агрегируются в LATERAL-подзапросах, поэтому DISTINCT не нужен.
+FILMWORK_DOCUMENT_SELECT = """
+    SELECT
+       fw.id AS id,
+       fw.modified AS modified,
+       json_build_object(
+               'id', fw.id,
+               'imdb_rating', fw.rating,
+               'genres', COALESCE(genres.names, '{}'),
+               'title', fw.title,
+               'description', fw.description,
+               'directors_names', COALESCE(persons.directors_names, '[]'),
+               'actors_names', COALESCE(persons.actors_names, '[]'),
+               'writers_names', COALESCE(persons.writers_names, '[]'),
+               'directors', COALESCE(persons.directors, '[]'),
+               'actors', COALESCE(persons.actors, '[]'),
+               'writers', COALESCE(persons.writers, '[]')
+       )::text AS document
+    FROM content.film_work fw
+    LEFT JOIN LATERAL (
+        SELECT
+            json_agg(p.full_name ORDER BY p.full_name, p.id) FILTER (WHERE pfw.role = 'director') AS directors_names,
+            json_agg(p.full_name ORDER BY p.full_name, p.id) FILTER (WHERE pfw.role = 'actor') AS actors_names,
+            json_agg(p.full_name ORDER BY p.full_name, p.id) FILTER (WHERE pfw.role = 'writer') AS writers_names,
+            json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                FILTER (WHERE pfw.role = 'director') AS directors,
+            json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                FILTER (WHERE pfw.role = 'actor') AS actors,
+            json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                FILTER (WHERE pfw.role = 'writer') AS writers
+        FROM content.person_film_work pfw
+        JOIN content.person p ON p.id = pfw.person_id
+        WHERE pfw.film_work_id = fw.id
+    ) persons ON true
+    LEFT JOIN LATERAL (
+        SELECT array_agg(g.name ORDER BY g.name) AS names
+        FROM content.genre_film_work gfw
+        JOIN content.genre g ON g.id = gfw.genre_id
+        WHERE gfw.film_work_id = fw.id
+    ) genres ON true
+"""
+
+FILMWORK_DOCUMENT_QUERY = FILMWORK_DOCUMENT_SELECT + """
+    WHERE (fw.modified, fw.id) > (%s, %s::uuid)
+    ORDER BY fw.modified, fw.id;
+"""
+
+FILMWORK_DOCUMENT_PARTITION_QUERY = FILMWORK_DOCUMENT_SELECT + f"""
+    WHERE (fw.modified, fw.id) > (%s, %s::uuid)
+      AND {FILMWORK_PARTITION_FILTER}
+    ORDER BY fw.modified, fw.id;
+"""
+
+FILMWORK_DOCUMENT_BY_IDS_QUERY = FILMWORK_DOCUMENT_SELECT + """
+    WHERE fw.id = ANY(%s::uuid[]);
+"""
+
+# Фильмы без соединения с person и genre (settings.filmwork_source_mode = "normalized"): только id связанных
+# персоналий с ролями и id жанров. Имена подставляются из кеша справочников (dimension_cache.py).
+FILMWORK_NORMALIZED_SELECT = """
+    SELECT
+       fw.id AS id,
+       fw.title AS title,
+       fw.description AS description,
+       fw.rating AS imdb_rating,
+       fw.type AS type,
+       fw.created AS created,
+       fw.modified AS modified,
+       COALESCE(persons.links, '[]') AS persons,
+       COALESCE(genres.ids, '{}') AS genres
+    FROM content.film_work fw
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object('person_id', pfw.person_id, 'person_role', pfw.role)) AS links
+        FROM content.person_film_work pfw
+        WHERE pfw.film_work_id = fw.id
+    ) persons ON true
+    LEFT JOIN LATERAL (
+        SELECT array_agg(gfw.genre_id::text) AS ids
+        FROM content.genre_film_work gfw
+        WHERE gfw.film_work_id = fw.id
+    ) genres ON true
+"""
+
+FILMWORK_NORMALIZED_QUERY = FILMWORK_NORMALIZED_SELECT + """
+    WHERE (fw.modified, fw.id) > (%s, %s::uuid)
+    ORDER BY fw.modified, fw.id;
+"""
+
+FILMWORK_NORMALIZED_PARTITION_QUERY = FILMWORK_NORMALIZED_SELECT + f"""
+    WHERE (fw.modified, fw.id) > (%s, %s::uuid)
+      AND {FILMWORK_PARTITION_FILTER}
+    ORDER BY fw.modified, fw.id;
+"""
+
+FILMWORK_NORMALIZED_BY_IDS_QUERY = FILMWORK_NORMALIZED_SELECT + """
+    WHERE fw.id = ANY(%s::uuid[]);
+"""
+
+# Имена справочников по списку id: промахи кеша режима normalized.
+PERSON_NAMES_BY_IDS_QUERY = """
+    SELECT id::text AS id, full_name AS name FROM content.person WHERE id = ANY(%s::uuid[]);
+"""
+
+GENRE_NAMES_BY_IDS_QUERY = """
+    SELECT id::text AS id, name FROM content.genre WHERE id = ANY(%s::uuid[]);
+"""
+
+GENRES_QUERY = """
+    SELECT
+        g.id AS id,
+        g.name AS name,
+        g.modified
+    FROM content.genre g
+
+    WHERE (g.modified, g.id) > (%s, %s::uuid)
+    GROUP BY g.id
+    ORDER BY g.modified, g.id;
+"""
+
+PERSONS_QUERY = """
+    SELECT
+        p.id AS id,
+        p.full_name,
+        json_agg(DISTINCT fw.id) AS movies,
+        p.modified
+    FROM content.person p
+    LEFT JOIN content.person_film_work pfw ON p.id = pfw.person_id
+    LEFT JOIN content.film_work fw ON pfw.film_work_id = fw.id
+    WHERE (p.modified, p.id) > (%s, %s::uuid)
+    GROUP BY p.id
+    ORDER BY p.modified, p.id;
+"""
+
+# Только имя персоналии: обновление документа persons без пересчёта фильмографии
+# (settings.persons_movies_mode = "incremental").
+PERSONS_NAME_QUERY = """
+    SELECT
+        p.id AS id,
+        p.full_name,
+        p.modified
+    FROM content.person p
+    WHERE (p.modified, p.id) > (%s, %s::uuid)
+    ORDER BY p.modified, p.id;
+"""
+
+# Изменения связей персоналия-фильм из журнала content.person_film_work_changes (заполняется триггером).
+# Для каждой затронутой пары возвращается текущее состояние связи, поэтому порядок
+# и повторная обработка изменений не важны.
+# Журнал читается keyset-курсором по (xid, seq) и только до xmin текущего снимка: транзакции
+# с меньшим xid завершены, а все будущие записи получат xid не меньше него. Позиция по одному seq
+# пропустила бы запись транзакции, зафиксированной позже записи с большим seq.
+# last_xid, last_seq — позиция последней прочитанной записи журнала.
+PERSON_FILM_WORK_CHANGES_QUERY = """
+    WITH changes AS (
+        SELECT xid, seq, person_id, film_work_id
+        FROM content.person_film_work_changes
+        WHERE (xid, seq) > (%s::xid8, %s)
+          AND xid < pg_snapshot_xmin(pg_current_snapshot())
+        ORDER BY xid, seq
+        LIMIT %s
+    ), last AS (
+        SELECT xid::text AS last_xid, seq AS last_seq
+        FROM changes
+        ORDER BY xid DESC, seq DESC
+        LIMIT 1
+    )
+    SELECT
+        c.person_id,
+        c.film_work_id,
+        EXISTS (
+            SELECT 1
+            FROM content.person_film_work pfw
+            WHERE pfw.person_id = c.person_id AND pfw.film_work_id = c.film_work_id
+        ) AS linked,
+        last.last_xid,
+        last.last_seq
+    FROM (SELECT DISTINCT person_id, film_work_id FROM changes) c
+    CROSS JOIN last;
+"""
+
+# Повтор изменений связей, scripted update которых Elasticsearch не принял. Новые записи журнала
+# читаются после более поздних изменений тех же связей, и linked вычисляется заново по person_film_work.
+PERSON_FILM_WORK_CHANGES_REQUEUE_QUERY = """
+    INSERT INTO content.person_film_work_changes (person_id, film_work_id)
+    SELECT * FROM unnest(%s::uuid[], %s::uuid[]);
+"""
+
+# Обработанные записи журнала связей удаляются, когда ETL догнал источник.
+PERSON_FILM_WORK_CHANGES_PRUNE_QUERY = """
+    DELETE FROM content.person_film_work_changes WHERE (xid, seq) <= (%s::xid8, %s);
+"""
+
+# Позиция журналов, с которой видны все изменения транзакций, не завершённых к текущему снимку.
+LOG_POSITION_QUERY = """
+    SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS xmin;
+"""
+
+# Удалённые строки из content.tombstone (заполняется триггерами при DELETE).
+# Надгробия читаются keyset-курсором по (xid, seq), как журнал связей (см. PERSON_FILM_WORK_CHANGES_QUERY),
+# но только транзакций с xid меньше xmin снимка, сделанного не меньше settings.tombstone_delay секунд
+# назад: такие удаления зафиксированы не позже этого момента.
+# film_work_ids — фильмы удалённой персоналии или жанра, документы которых нужно пересобрать.
+TOMBSTONES_QUERY = """
+    SELECT xid::text AS xid, seq, table_name, doc_id, film_work_ids::text[] AS film_work_ids
+    FROM content.tombstone
+    WHERE (xid, seq) > (%s::xid8, %s)
+      AND xid < %s::xid8
+    ORDER BY xid, seq
+    LIMIT %s;
+"""
+
+TOMBSTONES_PRUNE_QUERY = """
+    DELETE FROM content.tombstone WHERE (xid, seq) <= (%s::xid8, %s);
+"""
+
+# Строки загруженной пачки, которые ещё существуют (см. etl.delete_removed_documents)
+FILMWORK_EXISTING_IDS_QUERY = """
+    SELECT id::text AS id FROM content.film_work WHERE id = ANY(%s::uuid[]);
+"""
+
+PERSONS_EXISTING_IDS_QUERY = """
+    SELECT id::text AS id FROM content.person WHERE id = ANY(%s::uuid[]);
+"""
+
+GENRES_EXISTING_IDS_QUERY = """
+    SELECT id::text AS id FROM content.genre WHERE id = ANY(%s::uuid[]);
+"""
+
+# Переиндексация фильмов при изменении персоналий и жанров.
+# producer: изменённые записи связанной таблицы,
+# enricher: id затронутых фильмов через таблицу связей (keyset по film_work_id).
+FILMWORK_RELATIONS = {
+    "person": {
+        "producer_query": """
+            SELECT id, modified
+            FROM content.person
+            WHERE (modified, id) > (%s, %s::uuid)
+            ORDER BY modified, id
+            LIMIT %s;
+        """,
+        "enricher_query": """
+            SELECT DISTINCT pfw.film_work_id
+            FROM content.person_film_work pfw
+            WHERE pfw.person_id = ANY(%s::uuid[])
+              AND pfw.film_work_id > %s::uuid
+            ORDER BY pfw.film_work_id
+            LIMIT %s;
+        """,
+    },
+    "genre": {
+        "producer_query": """
+            SELECT id, modified
+            FROM content.genre
+            WHERE (modified, id) > (%s, %s::uuid)
+            ORDER BY modified, id
+            LIMIT %s;
+        """,
+        "enricher_query": """
+            SELECT DISTINCT gfw.film_work_id
+            FROM content.genre_film_work gfw
+            WHERE gfw.genre_id = ANY(%s::uuid[])
+              AND gfw.film_work_id > %s::uuid
+            ORDER BY gfw.film_work_id
+            LIMIT %s;
+        """,
+    },
+}
+
+# Оценка отставания для планировщика (scheduler.py): число строк за позицией процесса,
+# подсчёт ограничен последним параметром, чтобы на большом отставании не читать всю таблицу.
+FILMWORK_BACKLOG_QUERY = """
+    SELECT count(*) AS backlog FROM (
+        SELECT 1 FROM content.film_work WHERE (modified, id) > (%s, %s::uuid) LIMIT %s
+    ) AS pending;
+"""
+
+GENRES_BACKLOG_QUERY = """
+    SELECT count(*) AS backlog FROM (
+        SELECT 1 FROM content.genre WHERE (modified, id) > (%s, %s::uuid) LIMIT %s
+    ) AS pending;
+"""
+
+PERSONS_BACKLOG_QUERY = """
+    SELECT count(*) AS backlog FROM (
+        SELECT 1 FROM content.person WHERE (modified, id) > (%s, %s::uuid) LIMIT %s
+    ) AS pending;
+"""
+
+PERSON_FILM_WORK_CHANGES_BACKLOG_QUERY = """
+    SELECT count(*) AS backlog FROM (
+        SELECT 1 FROM content.person_film_work_changes WHERE (xid, seq) > (%s::xid8, %s) LIMIT %s
+    ) AS pending;
+"""
+
+TOMBSTONES_BACKLOG_QUERY = """
+    SELECT count(*) AS backlog FROM (
+        SELECT 1 FROM content.tombstone WHERE (xid, seq) > (%s::xid8, %s) LIMIT %s
+    ) AS pending;
+"""
+
+# Нижняя граница keyset-курсора по uuid, используется и для контрольных точек старого формата.
+MIN_UUID = "00000000-0000-0000-0000-000000000000"
+
+# Снимок для первичной загрузки (snapshot.py): таблицы выгружаются через COPY ... TO STDOUT
+# без соединений, документы собираются в Python. Связи отсортированы по ключу соединения
+# с основной таблицей, поэтому фильмы и персоналии собираются слиянием отсортированных потоков.
+SNAPSHOT_COPY_QUERIES = {
+    "genre": "COPY (SELECT id, name FROM content.genre) TO STDOUT",
+    "person": "COPY (SELECT id, full_name FROM content.person ORDER BY id) TO STDOUT",
+    "film_work": """
+        COPY (SELECT id, title, description, rating, type, created, modified
+              FROM content.film_work ORDER BY id) TO STDOUT
+    """,
+    "person_film_work_by_film": """
+        COPY (SELECT film_work_id, person_id, role
+              FROM content.person_film_work ORDER BY film_work_id) TO STDOUT
+    """,
+    "genre_film_work_by_film": """
+        COPY (SELECT film_work_id, genre_id
+              FROM content.genre_film_work ORDER BY film_work_id) TO STDOUT
+    """,
+    "person_film_work_by_person": """
+        COPY (SELECT DISTINCT person_id, film_work_id
+              FROM content.person_film_work ORDER BY person_id, film_work_id) TO STDOUT
+    """,
+}
+
+# Время снимка для контрольных точек: не позже начала незавершённых транзакций, иначе строки,
+# которые они зафиксируют с более ранним modified, не попадут ни в снимок, ни в инкрементальную загрузку.
+# Время переводится в UTC явно: ::timestamp перевёл бы его в часовой пояс сессии (TimeZone),
+# а контрольные точки без пояса сравниваются с modified как UTC.
+SNAPSHOT_TIME_QUERY = """
+    SELECT pg_export_snapshot(),
+           least(now(), (SELECT min(xact_start) FROM pg_stat_activity
+                         WHERE xact_start IS NOT NULL AND pid <> pg_backend_pid())) AT TIME ZONE 'UTC';
+"""
+
+# Позиции журналов изменений на момент снимка: записанное до снимка в него уже вошло.
+# Журналы читаются с xmin снимка (см. PERSON_FILM_WORK_CHANGES_QUERY).
+SNAPSHOT_LOG_POSITIONS_QUERY = """
+    SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS xmin;
+"""
@@ -0,0 +1,194 @@
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, NamedTuple, Optional
+
+from extract_data import extract_data
+from metrics import PIPELINE_BACKLOG, PIPELINE_PRIORITY
+from notify import change_listener, wait_for_changes
+from state import *
+from get_connections import *
+
+
+class PipelineStep(NamedTuple):
+    """Итог одного шага процесса ETL: пачка или простой.
+
+    processed — число обработанных строк; sleep > 0 — источник прочитан, следующий шаг
+    не раньше чем через sleep секунд или по уведомлению LISTEN/NOTIFY;
+    lag — отставание контрольной точки в секундах, если процесс его знает;
+    position — позиция процесса, параметры backlog_query без последнего (предела подсчёта).
+    """
+    processed: int = 0
+    sleep: float = 0.0
+    lag: Optional[float] = None
+    position: tuple = ()
+
+
+class Pipeline(NamedTuple):
+    """Процесс ETL: steps() создаёт генератор шагов, name совпадает с именем в notify.TABLE_SUBSCRIBERS."""
+    name: str
+    steps: Callable[[], Iterator[PipelineStep]]
+    backlog_query: Optional[str] = None
+    enabled: Callable[[], bool] = lambda: True
+
+
+PIPELINES: List[Pipeline] = []
+
+
+def pipeline(name: str, backlog_query: Optional[str] = None,
+             enabled: Optional[Callable[[], bool]] = None) -> Callable:
+    """Декоратор регистрации процесса ETL: функция без аргументов, возвращающая генератор шагов.
+
+    Зарегистрированные процессы запускает main.py; в движке asyncio — кроме async_etl.ASYNC_PIPELINES;
+    enabled проверяется при запуске, например, по флагу настроек.
+    """
+    def register(steps: Callable[[], Iterator[PipelineStep]]) -> Callable[[], Iterator[PipelineStep]]:
+        PIPELINES.append(Pipeline(name, steps, backlog_query, enabled or (lambda: True)))
+        return steps
+    return register
+
+
+def enabled_pipelines() -> List[Pipeline]:
+    return [registered for registered in PIPELINES if registered.enabled()]
+
+
+def run_steps(name: str, steps: Iterator[PipelineStep]) -> None:
+    """Выполнение шагов процесса подряд на текущем потоке (движок threads)."""
+    for step in steps:
+        if step.sleep:
+            wait_for_changes(name, step.sleep)
+
+
+class ScheduledPipeline:
+    """Состояние процесса в планировщике."""
+
+    def __init__(self, pipeline: Pipeline) -> None:
+        self.pipeline = pipeline
+        self.steps: Optional[Iterator[PipelineStep]] = None
+        self.ready_at = 0.0
+        self.running = False
+        self.woken = False
+        self.lag = 0.0
+        self.backlog = 0
+        self.backlog_checked = float("-inf")
+
+
+class PipelineScheduler:
+    """Выполнение процессов ETL по шагам на общем пуле из settings.scheduler_workers потоков.
+
+    Шаг — одна пачка или проверка источника. Процесс выполняет не больше одного потока
+    одновременно, между шагами генератор процесса хранит соединения и позицию потока строк.
+    Из готовых к шагу процессов выбирается процесс с наибольшим приоритетом:
+    время ожидания в очереди × (1 + ln(1 + отставание контрольной точки) + ln(1 + отставание в пачках)).
+    Отставание в строках оценивается backlog_query не чаще settings.scheduler_backlog_interval.
+    Отставание лишь умножает время ожидания: процесс, только что выполнивший шаг, уступает
+    любому ждущему, и загрузка с нуля (вес около 27) получает больше шагов, но не все.
+    Процесс, ждущий дольше settings.scheduler_max_wait, выбирается раньше всех
+    (дольше ждавший — первым).
+    Процесс, прочитавший источник, ждёт паузу простоя или уведомление LISTEN/NOTIFY.
+    Завершившийся процесс (например, после ошибки) перезапускается через settings.default_sleep_time.
+    """
+
+    def __init__(self, pipelines: List[Pipeline], workers: int) -> None:
+        self.entries = [ScheduledPipeline(registered) for registered in pipelines]
+        self.workers = max(workers, 1)
+        self.condition = threading.Condition()
+
+    def wake(self, name: str) -> None:
+        """Сделать процесс готовым к шагу по уведомлению об изменениях."""
+        with self.condition:
+            for entry in self.entries:
+                if entry.pipeline.name != name:
+                    continue
+                if entry.running:
+                    entry.woken = True
+                else:
+                    entry.ready_at = min(entry.ready_at, time.monotonic())
+            self.condition.notify_all()
+
+    def priority(self, entry: ScheduledPipeline, now: float) -> float:
+        weight = 1 + math.log1p(entry.lag) + math.log1p(entry.backlog / settings.batch_size)
+        return weight * (now - entry.ready_at)
+
+    def order(self, entry: ScheduledPipeline, now: float) -> tuple:
+        """Ключ выбора: сначала процессы, ждущие дольше scheduler_max_wait, по времени ожидания, затем по приоритету."""
+        waited = now - entry.ready_at
+        if waited >= settings.scheduler_max_wait:
+            return True, waited
+        return False, self.priority(entry, now)
+
+    def take(self) -> ScheduledPipeline:
+        """Дождаться готового процесса с наибольшим приоритетом и занять его."""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                ready = [entry for entry in self.entries if not entry.running and entry.ready_at <= now]
+                if ready:
+                    entry = max(ready, key=lambda entry: self.order(entry, now))
+                    PIPELINE_PRIORITY.labels(entry.pipeline.name).set(self.priority(entry, now))
+                    entry.running = True
+                    return entry
+                waiting = [entry.ready_at for entry in self.entries if not entry.running]
+                self.condition.wait(min(waiting) - now if waiting else None)
+
+    def release(self, entry: ScheduledPipeline, step: PipelineStep) -> None:
+        with self.condition:
+            entry.running = False
+            entry.ready_at = time.monotonic()
+            if step.sleep and not entry.woken:
+                entry.ready_at += step.sleep
+            entry.woken = False
+            self.condition.notify_all()
+
+    def advance(self, entry: ScheduledPipeline) -> PipelineStep:
+        """Один шаг процесса; завершившийся процесс перезапускается после паузы."""
+        name = entry.pipeline.name
+        try:
+            if entry.steps is None:
+                entry.steps = entry.pipeline.steps()
+            return next(entry.steps)
+        except StopIteration:
+            logger.warning(f"Процесс {name} завершился, перезапуск через {settings.default_sleep_time} с")
+        except Exception as e:
+            logger.error(f"Ошибка во время ETL процесса {name}: {str(e)}")
+        entry.steps = None
+        return PipelineStep(sleep=settings.default_sleep_time)
+
+    def estimate_backlog(self, entry: ScheduledPipeline, step: PipelineStep) -> None:
+        """Обновить отставание процесса по итогу шага."""
+        if step.lag is not None:
+            entry.lag = step.lag
+        if not step.processed:
+            # Источник прочитан
+            entry.lag, entry.backlog = 0.0, 0
+        elif (entry.pipeline.backlog_query and step.position
+              and time.monotonic() - entry.backlog_checked >= settings.scheduler_backlog_interval):
+            entry.backlog_checked = time.monotonic()
+            try:
+                with pg_connection() as pg_conn:
+                    entry.backlog = extract_data(pg_conn, entry.pipeline.backlog_query,
+                                                 params=step.position + (settings.scheduler_backlog_limit,))[0]["backlog"]
+            except Exception as e:
+                logger.warning(f"Не удалось оценить отставание {entry.pipeline.name}: {str(e)}")
+        PIPELINE_BACKLOG.labels(entry.pipeline.name).set(entry.backlog)
+
+    def work(self) -> None:
+        while True:
+            entry = self.take()
+            step = self.advance(entry)
+            self.estimate_backlog(entry, step)
+            self.release(entry, step)
+
+    def run(self) -> None:
+        names = ", ".join(entry.pipeline.name for entry in self.entries)
+        logger.info(f"Планировщик ETL: {len(self.entries)} процесс(ов) ({names}) на {self.workers} поток(ах)")
+        change_listener.subscribe(self.wake)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="etl-scheduler") as pool:
+            for future in [pool.submit(self.work) for _ in range(self.workers)]:
+                future.result()
+
+
+def run_scheduler(pipelines: List[Pipeline]) -> None:
+    """Запуск процессов на общем пуле потоков (движок scheduler)."""
+    if pipelines:
+        PipelineScheduler(pipelines, settings.scheduler_workers).run()
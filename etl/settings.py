@@ -1,3 +1,4 @@
+import socket
 from datetime import datetime, timezone
 from pydantic_settings import BaseSettings
 
@@ -16,12 +17,64 @@ class Settings(BaseSettings):
     redis_host: str
     redis_port: int
 
+    pg_pool_min_size: int = 1
+    pg_pool_max_size: int = 10
+    es_connections_per_node: int = 10
+    redis_pool_size: int = 10
+    redis_pool_timeout: float = 30.0  # секунды ожидания свободного соединения Redis
+
     filmwork_index_name: str = "movies"
     genres_index_name: str = "genres"
     persons_index_name: str = "persons"
     state_file_path: str = "sync_state.json"
     default_sync_time: str = datetime(1970, 1, 1, tzinfo=timezone.utc).isoformat()
     default_sleep_time: int = 5
+    batch_size: int = 100
+    filmwork_source_mode: str = "python"  # python | postgres | normalized (только движок threads)
+    person_cache_size: int = 10000  # кеш имён персоналий режима normalized
+    genre_cache_size: int = 1000
+    adaptive_batching: bool = False
+    min_batch_size: int = 50
+    max_batch_size: int = 5000
+    target_batch_latency: float = 1.0
+    max_idle_sleep_time: int = 60
+    etl_engine: str = "threads"  # threads | asyncio | scheduler
+    scheduler_workers: int = 2  # общий пул потоков процессов ETL в движке scheduler
+    scheduler_backlog_interval: float = 30.0  # секунды между оценками отставания процесса
+    scheduler_backlog_limit: int = 100000
+    scheduler_max_wait: float = 1.0  # секунды ожидания готового процесса, после которых он выбирается первым
+    async_queue_size: int = 2
+    use_pg_notify: bool = False
+    metrics_host: str = "0.0.0.0"
+    metrics_port: int = 0  # 0 — endpoint метрик выключен
+    filmwork_partitions: int = 1  # > 1 включает шардированный режим etl_filmwork
+    worker_id: str = socket.gethostname()
+    lease_ttl: int = 30
+    checkpoint_flush_batches: int = 1
+    checkpoint_flush_interval: float = 0  # секунды, 0 — только по числу пачек
+    dedup_documents: bool = False
+    persons_movies_mode: str = "full"  # full | incremental
+    propagate_deletes: bool = False
+    tombstone_delay: float = 10.0  # секунды от фиксации удаления до обработки надгробия
+    transform_workers: int = 0  # > 0: transform filmwork в пуле процессов
+    dead_letter_queue: bool = False  # недоставленные документы в Redis и их фоновый повтор
+    dead_letter_retry_delay: float = 5.0
+    dead_letter_max_delay: float = 3600.0
+    dead_letter_max_attempts: int = 10
+    dead_letter_batch_size: int = 500
+    dead_letter_claim_ttl: int = 300
+    snapshot_backfill: bool = False  # первичная загрузка из снимка COPY (snapshot.py)
+    snapshot_batch_size: int = 1000
+    snapshot_lock_ttl: int = 300
+
+    es_serializer: str = "json"  # json | orjson
+    es_http_compress: bool = False  # gzip тел запросов к Elasticsearch
+    es_bulk_mode: str = "bulk"  # bulk | parallel
+    es_bulk_thread_count: int = 4
+    es_bulk_chunk_size: int = 500
+    es_bulk_max_chunk_bytes: int = 100 * 1024 * 1024
+    es_bulk_max_retries: int = 3
+    es_force_merge_after_backfill: bool = False
 
     class Config:
         env_file = ".env"
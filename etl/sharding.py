@@ -0,0 +1,130 @@
+import math
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from state import *
+from get_connections import *
+
+# Продление и освобождение аренды только её владельцем
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class PartitionLeases:
+    """Распределение партиций между ETL воркерами через аренды в Redis.
+
+    Воркер отмечается в sorted set живых воркеров и берёт в аренду
+    не больше своей доли партиций: ceil(partitions / число живых воркеров).
+    Аренда с TTL settings.lease_ttl продлевается координатором; партиции
+    упавшего воркера освобождаются по истечении TTL и достаются остальным.
+    """
+
+    def __init__(self, redis_conn: Redis, name: str, partitions: int, worker_id: str) -> None:
+        self.redis_conn = redis_conn
+        self.name = name
+        self.partitions = partitions
+        self.worker_id = worker_id
+        self.ttl_ms = settings.lease_ttl * 1000
+        self.workers_key = f"workers:{name}"
+        self.renew_script = redis_conn.register_script(RENEW_SCRIPT)
+        self.release_script = redis_conn.register_script(RELEASE_SCRIPT)
+
+    def lease_key(self, partition: int) -> str:
+        return f"lease:{self.name}:{partition}"
+
+    def heartbeat(self) -> int:
+        """Отметить воркер живым и вернуть число живых воркеров."""
+        now = time.time()
+        with self.redis_conn.pipeline() as pipe:
+            pipe.zadd(self.workers_key, {self.worker_id: now})
+            pipe.zremrangebyscore(self.workers_key, "-inf", now - settings.lease_ttl)
+            pipe.zcard(self.workers_key)
+            return pipe.execute()[-1]
+
+    def fair_share(self, workers: int) -> int:
+        return math.ceil(self.partitions / max(workers, 1))
+
+    def acquire(self, partition: int) -> bool:
+        return bool(self.redis_conn.set(self.lease_key(partition), self.worker_id, nx=True, px=self.ttl_ms))
+
+    def renew(self, partition: int) -> bool:
+        return bool(self.renew_script(keys=[self.lease_key(partition)], args=[self.worker_id, self.ttl_ms]))
+
+    def release(self, partition: int) -> None:
+        self.release_script(keys=[self.lease_key(partition)], args=[self.worker_id])
+
+
+def all_partitions_caught_up(state: State, index_name: str, partition: Optional[Tuple[int, int]]) -> bool:
+    """Все ли партиции индекса догнали источник. Без шардирования партиция одна — текущая."""
+    if partition is None:
+        return True
+    return all(
+        state.get_state(caught_up_key(index_name, (number, partition[1])), cached=False) == "1"
+        for number in range(partition[1])
+    )
+
+
+def run_partitioned(name: str, partitions: int, run_partition: Callable[[int, threading.Event], None]) -> None:
+    """Координатор воркера: держит аренды своей доли партиций и запускает по потоку на каждую.
+
+    run_partition(partition, stop_event) должен завершиться после установки stop_event.
+    """
+    owned: Dict[int, Tuple[threading.Thread, threading.Event]] = {}
+
+    def start(partition: int) -> None:
+        stop_event = threading.Event()
+        thread = threading.Thread(
+            target=run_partition, args=(partition, stop_event), name=f"{name}-p{partition}", daemon=True)
+        thread.start()
+        owned[partition] = (thread, stop_event)
+        logger.info(f"Воркер {settings.worker_id} взял партицию {partition}/{partitions} {name}")
+
+    def stop(partition: int) -> None:
+        thread, stop_event = owned.pop(partition)
+        stop_event.set()
+        thread.join()
+        logger.info(f"Воркер {settings.worker_id} отдал партицию {partition}/{partitions} {name}")
+
+    with get_redis_connection() as redis_conn:
+        leases = PartitionLeases(redis_conn, name, partitions, settings.worker_id)
+        try:
+            while True:
+                share = leases.fair_share(leases.heartbeat())
+
+                for partition in list(owned):
+                    thread, _ = owned[partition]
+                    if not leases.renew(partition):
+                        logger.warning(f"Аренда партиции {partition} {name} потеряна")
+                        stop(partition)
+                    elif not thread.is_alive():
+                        # Процесс партиции завершился с ошибкой: отдаём партицию, её подхватит любой воркер
+                        owned.pop(partition)
+                        leases.release(partition)
+
+                for partition in range(partitions):
+                    if len(owned) >= share:
+                        break
+                    if partition not in owned and leases.acquire(partition):
+                        start(partition)
+
+                # Появились новые воркеры: отдаём лишние партиции
+                while len(owned) > share:
+                    partition = max(owned)
+                    stop(partition)
+                    leases.release(partition)
+
+                time.sleep(settings.lease_ttl / 3)
+        finally:
+            for partition in list(owned):
+                stop(partition)
+                leases.release(partition)
@@ -0,0 +1,307 @@
+import itertools
+import queue
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import psycopg2.extensions
+
+from create_index import *
+from dead_letter import DeadLetterQueue
+from dedup import DocumentHashes
+from etl import SNAPSHOT_LOCK_KEY, load_stream
+from mappings import FILMWORK_MAPPING, GENRES_MAPPING, PERSONS_MAPPING
+from metrics import observe_batch
+from queries import *
+from transform_data import *
+from state import State, logger, RedisStorage, format_log_position
+
+# Экранирование текстового формата COPY, которое PostgreSQL использует при выгрузке
+COPY_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "v": "\v", "\\": "\\"}
+_copy_escape = re.compile(r"\\(.)")
+
+
+def parse_copy_line(line: str) -> List[Optional[str]]:
+    """Колонки строки текстового формата COPY: разделены табуляцией, \\N — NULL."""
+    values = line.split("\t")
+    for index, value in enumerate(values):
+        if value == "\\N":
+            values[index] = None
+        elif "\\" in value:
+            values[index] = _copy_escape.sub(lambda match: COPY_ESCAPES.get(match.group(1), match.group(1)), value)
+    return values
+
+
+class CopyStream:
+    """Строки COPY ... TO STDOUT, читаемые потоком.
+
+    copy_expert выполняется в отдельном потоке и пишет данные в ограниченную очередь,
+    поэтому в памяти находится только несколько строк, а несколько таблиц можно читать одновременно.
+    """
+
+    def __init__(self, conn: PGConnection, query: str, queue_size: int = 1024) -> None:
+        self.encoding = psycopg2.extensions.encodings[conn.encoding]
+        self.queue = queue.Queue(queue_size)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._copy, args=(conn, query), name="snapshot-copy", daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, data: bytes) -> int:
+        """Приём данных от copy_expert; после close() прерывает COPY."""
+        if not self._put(data):
+            raise InterruptedError("Чтение COPY прервано")
+        return len(data)
+
+    def _copy(self, conn: PGConnection, query: str) -> None:
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(query, self)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self) -> Iterator[List[Optional[str]]]:
+        tail = b""
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            lines = (tail + data).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                yield parse_copy_line(line.decode(self.encoding))
+
+    def close(self) -> None:
+        self.closed.set()
+
+
+@contextmanager
+def open_snapshot(connections: int) -> Iterator[Tuple[List[PGConnection], datetime]]:
+    """Соединения, читающие один согласованный снимок базы, и время снимка.
+
+    Первое соединение экспортирует снимок (pg_export_snapshot), остальные переходят в него
+    через SET TRANSACTION SNAPSHOT, поэтому таблицы, выгружаемые параллельно, согласованы между собой.
+    """
+    conns = []
+    try:
+        conn = get_pg_connection()
+        conns.append(conn)
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor() as cursor:
+            cursor.execute(SNAPSHOT_TIME_QUERY)
+            snapshot_id, snapshot_time = cursor.fetchone()
+        for _ in range(connections - 1):
+            conn = get_pg_connection()
+            conns.append(conn)
+            conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+            with conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot_id,))
+        yield conns, snapshot_time
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def grouped(rows: Iterator[list]) -> Iterator[Tuple[str, List[list]]]:
+    """Строки, отсортированные по первой колонке, сгруппированные по ней."""
+    return ((key, list(group)) for key, group in itertools.groupby(rows, key=lambda row: row[0]))
+
+
+def join_sorted(rows: Iterator[list], *links: Iterator[Tuple[str, List[list]]]
+                ) -> Iterator[Tuple[list, List[List[list]]]]:
+    """Слияние потоков, отсортированных по ключу: строка rows и связанные с ней группы каждого из links.
+
+    uuid в текстовом виде сравниваются так же, как в ORDER BY PostgreSQL.
+    """
+    heads = [next(link, None) for link in links]
+    for row in rows:
+        key = row[0]
+        related = []
+        for number, link in enumerate(links):
+            while heads[number] is not None and heads[number][0] < key:
+                heads[number] = next(link, None)
+            if heads[number] is not None and heads[number][0] == key:
+                related.append(heads[number][1])
+                heads[number] = next(link, None)
+            else:
+                related.append([])
+        yield row, related
+
+
+def batched(records: Iterator, size: int) -> Iterator[list]:
+    while batch := list(itertools.islice(records, size)):
+        yield batch
+
+
+def load_dimension(conn: PGConnection, query: str) -> Dict[str, str]:
+    """Индекс id -> имя для персоналий и жанров; порядок ключей — порядок выгрузки."""
+    stream = CopyStream(conn, query)
+    try:
+        return {row[0]: row[1] for row in stream}
+    finally:
+        stream.close()
+
+
+def filmwork_records(conns: List[PGConnection], persons: Dict[str, str],
+                     genres: Dict[str, str]) -> Iterator[tuple]:
+    """Строки в формате FILMWORK_SELECT, собранные слиянием выгрузок film_work и таблиц связей."""
+    streams = [
+        CopyStream(conns[0], SNAPSHOT_COPY_QUERIES["film_work"]),
+        CopyStream(conns[1], SNAPSHOT_COPY_QUERIES["person_film_work_by_film"]),
+        CopyStream(conns[2], SNAPSHOT_COPY_QUERIES["genre_film_work_by_film"]),
+    ]
+    try:
+        films, film_persons, film_genres = (iter(stream) for stream in streams)
+        for film, (links, genre_links) in join_sorted(films, grouped(film_persons), grouped(film_genres)):
+            film_work_id, title, description, rating, film_type, created, modified = film
+            cast = {}
+            for _, person_id, role in links:
+                if person_id in persons:
+                    cast[(role, person_id)] = {
+                        "person_role": role, "person_id": person_id, "person_name": persons[person_id]}
+            yield (
+                film_work_id, title, description, float(rating) if rating is not None else None, film_type,
+                created, modified, list(cast.values()),
+                sorted({genres[genre_id] for _, genre_id in genre_links if genre_id in genres}),
+            )
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+def persons_records(conn: PGConnection, persons: Dict[str, str]) -> Iterator[dict]:
+    """Персоналии с фильмографией: слияние индекса персоналий с выгрузкой связей по person_id."""
+    stream = CopyStream(conn, SNAPSHOT_COPY_QUERIES["person_film_work_by_person"])
+    try:
+        for (person_id, full_name), (links,) in join_sorted(iter(persons.items()), grouped(iter(stream))):
+            yield {"id": person_id, "full_name": full_name, "movies": [film_work_id for _, film_work_id in links]}
+    finally:
+        stream.close()
+
+
+def genres_records(genres: Dict[str, str]) -> Iterator[dict]:
+    for genre_id, name in genres.items():
+        yield {"id": genre_id, "name": name}
+
+
+def is_initial_load(state: State, keys: List[str]) -> bool:
+    """Индекс ещё не загружался: контрольных точек нет или они в начальном значении."""
+    return all(
+        checkpoint is None or checkpoint[0] == settings.default_sync_time
+        for checkpoint in (state.get_checkpoint(key) for key in keys))
+
+
+def snapshot_backfill() -> None:
+    """Первичная загрузка индексов из снимка PostgreSQL (settings.snapshot_backfill).
+
+    Вместо постраничного запроса с пятью LEFT JOIN и агрегатами DISTINCT таблицы выгружаются
+    через COPY в одном согласованном снимке. Персоналии и жанры держатся в памяти в индексах
+    id -> имя, а документы movies и persons собираются за один проход слиянием
+    выгрузок, отсортированных по ключу соединения.
+
+    Загружаются только индексы (или их новые версии), которые ещё не загружались. После загрузки
+    их контрольные точки устанавливаются на время снимка, и ETL процессы продолжают инкрементально.
+    Режим backfill индексов и переключение alias завершают ETL процессы, когда догонят источник.
+    Воркеры шардированного режима выполняют загрузку по очереди под блокировкой в Redis.
+    """
+    partitions = settings.filmwork_partitions
+    targets = {
+        "filmwork": (FILMWORK_MAPPING, settings.filmwork_index_name, transform_filmwork,
+                     [None] if partitions == 1 else [(number, partitions) for number in range(partitions)]),
+        "genres": (GENRES_MAPPING, settings.genres_index_name, transform_genres, [None]),
+        "persons": (PERSONS_MAPPING, settings.persons_index_name, transform_persons, [None]),
+    }
+    es_client = get_shared_es_client()
+    with get_redis_connection() as redis_conn:
+        # Блокировка продлевается после каждой пачки и истекает, если воркер упал
+        lock = redis_conn.lock(SNAPSHOT_LOCK_KEY, timeout=settings.snapshot_lock_ttl, thread_local=False)
+        lock.acquire()
+        try:
+            state = State(RedisStorage(redis_adapter=redis_conn))
+            pending = {}
+            for entity, (mapping, alias, transform, entity_partitions) in targets.items():
+                index_name = prepare_index(es_client, mapping, alias)
+                keys = [checkpoint_key(entity, alias, index_name, partition) for partition in entity_partitions]
+                for partition in entity_partitions:
+                    seed_checkpoint(state, entity, alias, index_name, partition)
+                if is_initial_load(state, keys):
+                    pending[entity] = (index_name, transform, keys)
+            if not pending:
+                return
+
+            with open_snapshot(3) as (conns, snapshot_time):
+                with conns[0].cursor() as cursor:
+                    cursor.execute(SNAPSHOT_LOG_POSITIONS_QUERY)
+                    log_position = format_log_position(cursor.fetchone()[0], 0)
+                genres = load_dimension(conns[0], SNAPSHOT_COPY_QUERIES["genre"])
+                persons = load_dimension(conns[0], SNAPSHOT_COPY_QUERIES["person"])
+                logger.info(
+                    f"Снимок PostgreSQL на {snapshot_time.isoformat()}: {len(persons)} персоналий, "
+                    f"{len(genres)} жанров, загружаются индексы {', '.join(pending)}")
+
+                sources: Dict[str, Callable[[], Iterator]] = {
+                    "filmwork": lambda: filmwork_records(conns, persons, genres),
+                    "genres": lambda: genres_records(genres),
+                    "persons": lambda: persons_records(conns[1], persons),
+                }
+                for entity, (index_name, transform, _) in pending.items():
+                    number_of_replicas = state.get_state(backfill_key(index_name))
+                    if not number_of_replicas and can_enable_backfill_mode(es_client, targets[entity][1], index_name):
+                        number_of_replicas = enable_backfill_mode(es_client, index_name)
+                        state.set_state(backfill_key(index_name), number_of_replicas)
+                    doc_hashes = DocumentHashes(redis_conn, index_name) if settings.dedup_documents else None
+                    dead_letters = DeadLetterQueue(redis_conn) if settings.dead_letter_queue else None
+                    if doc_hashes:
+                        doc_hashes.clear()
+
+                    loaded = 0
+                    records_source = sources[entity]()
+                    try:
+                        stream = batched(records_source, settings.snapshot_batch_size)
+                        for records, extract_time, transform_time, result in load_stream(
+                                es_client, stream, transform, index_name, entity == "filmwork", doc_hashes,
+                                dead_letters):
+                            observe_batch(f"snapshot:{entity}", len(records), extract_time, transform_time, result)
+                            loaded += len(records)
+                            lock.reacquire()
+                    finally:
+                        # Останавливает потоки COPY до закрытия соединений снимка
+                        records_source.close()
+                    logger.info(f"Из снимка загружено {loaded} документов {entity} в {index_name}")
+
+            # Дальше ETL процессы читают только изменения после снимка
+            for entity, (_, _, keys) in pending.items():
+                for key in keys:
+                    state.set_checkpoint(key, snapshot_time.isoformat(), MIN_UUID)
+            if "filmwork" in pending:
+                for relation in FILMWORK_RELATIONS:
+                    if is_initial_load(state, [f'last_synced_time_filmwork_{relation}']):
+                        state.set_checkpoint(f'last_synced_time_filmwork_{relation}', snapshot_time.isoformat(),
+                                             MIN_UUID)
+            if "persons" in pending and not state.get_state('last_seq_persons_movies', cached=False):
+                state.set_state('last_seq_persons_movies', log_position)
+            if len(pending) == len(targets) and not state.get_state('last_seq_deletes', cached=False):
+                state.set_state('last_seq_deletes', log_position)
+            state.flush()
+            logger.info(f"Загрузка из снимка завершена, контрольные точки установлены на {snapshot_time.isoformat()}")
+
+        except Exception as e:
+            logger.error(f"Ошибка загрузки из снимка, индексы будут загружены ETL процессами: {str(e)}")
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                pass
@@ -3,8 +3,13 @@ import json
 import logging
 import sys
 import os
-from typing import Any, Dict
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
 from redis.client import Redis
+from redis.asyncio import Redis as AsyncRedis
 from redis.exceptions import BusyLoadingError, ConnectionError, TimeoutError
 
 
@@ -32,6 +37,10 @@ class BaseStorage(abc.ABC):
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
 
+    def retrieve_key(self, key: str) -> Any:
+        """Получить значение одного ключа состояния."""
+        return self.retrieve_state().get(key)
+
 
 class RedisStorage(BaseStorage):
 
@@ -40,7 +49,7 @@ class RedisStorage(BaseStorage):
         self.key = None
 
     def save_state(self, state: Dict[str, Any]) -> None:
-        """Сохранить состояние в хранилище."""
+        """Сохранить состояние в хранилище: все ключи одной командой HSET."""
         self.redis_adapter.hset(name="state", mapping=state)
 
     def retrieve_state(self) -> Dict[str, Any]:
@@ -49,11 +58,16 @@ class RedisStorage(BaseStorage):
         # logger.debug(state)
         return state
 
+    def retrieve_key(self, key: str) -> Any:
+        """Получить значение одного ключа состояния (HGET вместо HGETALL всего хеша)."""
+        return self.redis_adapter.hget(name="state", key=key)
+
 
 class JsonFileStorage(BaseStorage):
     """Реализация хранилища, использующего локальный файл.
 
-    Формат хранения: JSON
+    Формат хранения: JSON. Файл перезаписывается атомарно: новое состояние
+    пишется во временный файл рядом, сбрасывается на диск и заменяет старый через rename.
     """
 
     def __init__(self, file_path: str) -> None:
@@ -64,45 +78,265 @@ class JsonFileStorage(BaseStorage):
         data = self.retrieve_state()
 
         data.update(state)
-        with open(self.file_path, mode="w") as file:
-            json.dump(data, fp=file)
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        with tempfile.NamedTemporaryFile(mode="w", dir=directory, prefix=".state_", delete=False) as file:
+            try:
+                json.dump(data, fp=file)
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, self.file_path)
 
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
         if not os.path.exists(self.file_path):
-            with open(self.file_path, mode="w") as f:
-                json.dump({}, f)
-
             return {}
-        else:
-            with open(self.file_path) as file:
-                data: dict = json.load(file)
+        with open(self.file_path) as file:
+            data: dict = json.load(file)
 
-            return data
+        return data
 
 
 class State:
-    """Класс для работы с состояниями."""
+    """Класс для работы с состояниями.
 
-    def __init__(self, storage: BaseStorage) -> None:
+    Последние записанные значения кешируются в процессе, поэтому чтение своих
+    ключей не обращается к хранилищу. Контрольные точки можно копить и записывать
+    одной командой раз в flush_every пачек или flush_interval секунд (0 — без ограничения
+    по времени); до записи они теряются при падении процесса, и ETL повторит эти пачки.
+    Остальные ключи записываются сразу вместе с накопленными контрольными точками.
+    """
+
+    def __init__(self, storage: BaseStorage, flush_every: int = 1, flush_interval: float = 0) -> None:
         self.storage = storage
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.cache: Dict[str, Any] = {}
+        self.pending: Dict[str, Any] = {}
+        self.pending_checkpoints = 0
+        self.last_flush = time.monotonic()
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа."""
-        self.storage.save_state(state={key: value})
+        self.pending[key] = value
+        self.cache[key] = value
+        self.flush()
+
+    def get_state(self, key: str, cached: bool = True) -> Any:
+        """Получить состояние по определённому ключу.
+
+        cached=False читает ключ из хранилища, например, если его пишет другой воркер.
+        """
+        if cached and key in self.cache:
+            return self.cache[key]
+        value = self.storage.retrieve_key(key)
+        if key not in self.pending:
+            self.cache[key] = value
+        return self.cache.get(key, value)
+
+    def flush(self) -> None:
+        """Записать накопленные значения в хранилище."""
+        if self.pending:
+            self.storage.save_state(state=self.pending)
+            self.pending = {}
+        self.pending_checkpoints = 0
+        self.last_flush = time.monotonic()
+
+    def set_checkpoint(self, key: str, modified: str, record_id: str) -> None:
+        """Сохранить составную контрольную точку (modified, id) keyset-курсора."""
+        value = json.dumps({"modified": modified, "id": record_id})
+        self.pending[key] = value
+        self.cache[key] = value
+        self.pending_checkpoints += 1
+        if (self.pending_checkpoints >= self.flush_every
+                or (self.flush_interval and time.monotonic() - self.last_flush >= self.flush_interval)):
+            self.flush()
+
+    def get_checkpoint(self, key: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Получить контрольную точку (modified, id)."""
+        return parse_checkpoint(self.get_state(key))
+
+
+class AsyncRedisStorage:
+    """Асинхронное хранилище состояния в Redis для asyncio-движка ETL."""
+
+    def __init__(self, redis_adapter: AsyncRedis):
+        self.redis_adapter = redis_adapter
+
+    async def save_state(self, state: Dict[str, Any]) -> None:
+        """Сохранить состояние в хранилище."""
+        await self.redis_adapter.hset(name="state", mapping=state)
+
+    async def retrieve_state(self) -> Dict[str, Any]:
+        """Получить состояние из хранилища."""
+        return await self.redis_adapter.hgetall(name="state")
+
+    async def retrieve_key(self, key: str) -> Any:
+        """Получить значение одного ключа состояния."""
+        return await self.redis_adapter.hget(name="state", key=key)
+
+
+class AsyncState:
+    """Асинхронный вариант State для asyncio-движка ETL."""
+
+    def __init__(self, storage: AsyncRedisStorage, flush_every: int = 1, flush_interval: float = 0) -> None:
+        self.storage = storage
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.cache: Dict[str, Any] = {}
+        self.pending: Dict[str, Any] = {}
+        self.pending_checkpoints = 0
+        self.last_flush = time.monotonic()
+
+    async def set_state(self, key: str, value: Any) -> None:
+        """Установить состояние для определённого ключа."""
+        self.pending[key] = value
+        self.cache[key] = value
+        await self.flush()
 
-    def get_state(self, key: str) -> Any:
+    async def get_state(self, key: str, cached: bool = True) -> Any:
         """Получить состояние по определённому ключу."""
-        # state = self.storage.retrieve_state()
-        # if len(state) == 0:
-        #     return None
-        # state = state[key]
-        # return state
-        try:
-            state = self.storage.retrieve_state()
-            return state.get(key, None)  # Если ключа нет, возвращаем None
-        except KeyError:
-            return None
+        if cached and key in self.cache:
+            return self.cache[key]
+        value = await self.storage.retrieve_key(key)
+        if key not in self.pending:
+            self.cache[key] = value
+        return self.cache.get(key, value)
+
+    async def flush(self) -> None:
+        """Записать накопленные значения в хранилище."""
+        if self.pending:
+            await self.storage.save_state(state=self.pending)
+            self.pending = {}
+        self.pending_checkpoints = 0
+        self.last_flush = time.monotonic()
+
+    async def set_checkpoint(self, key: str, modified: str, record_id: str) -> None:
+        """Сохранить составную контрольную точку (modified, id) keyset-курсора."""
+        value = json.dumps({"modified": modified, "id": record_id})
+        self.pending[key] = value
+        self.cache[key] = value
+        self.pending_checkpoints += 1
+        if (self.pending_checkpoints >= self.flush_every
+                or (self.flush_interval and time.monotonic() - self.last_flush >= self.flush_interval)):
+            await self.flush()
+
+    async def get_checkpoint(self, key: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Получить контрольную точку (modified, id)."""
+        return parse_checkpoint(await self.get_state(key))
+
+
+def checkpoint_key(entity: str, alias: str, index_name: str, partition: Optional[Tuple[int, int]] = None) -> str:
+    """Ключ контрольной точки ETL процесса.
+
+    Для версионированных индексов ключ свой у каждой версии, поэтому
+    недостроенная версия продолжает загрузку после перезапуска.
+    В шардированном режиме у каждой партиции (номер, всего) своя контрольная точка.
+    """
+    key = f'last_synced_time_{entity}'
+    if index_name != alias:
+        key = f'{key}:{index_name}'
+    if partition is not None:
+        key = f'{key}:p{partition[0]}of{partition[1]}'
+    return key
+
+
+def backfill_key(index_name: str) -> str:
+    """Ключ состояния режима первичной загрузки индекса: хранит исходное число реплик."""
+    return f'backfill_{index_name}'
+
+
+def initial_load_key(index_name: str) -> str:
+    """Ключ признака, что первичная загрузка версии индекса завершена (все партиции догнали источник)."""
+    return f'loaded_{index_name}'
+
+
+def caught_up_key(index_name: str, partition: Tuple[int, int]) -> str:
+    """Ключ признака, что партиция догнала источник при загрузке индекса."""
+    return f'caught_up_{index_name}:p{partition[0]}of{partition[1]}'
+
+
+def previous_layout_checkpoint(stored: Dict[str, Any], entity: str, alias: str, index_name: str,
+                               partitions: int) -> Optional[Tuple[str, Optional[str]]]:
+    """Контрольная точка, с которой безопасно продолжить загрузку при смене числа партиций.
+
+    Для каждой прежней раскладки (без партиций или с другим числом партиций), у которой
+    сохранены контрольные точки всех партиций, берётся наименьшая из них: все строки до неё
+    загружены. Из нескольких раскладок выбирается самая поздняя такая точка; None — раскладок нет.
+    """
+    base = checkpoint_key(entity, alias, index_name)
+    layouts: Dict[int, Dict[int, Tuple[str, Optional[str]]]] = {}
+    for key, value in stored.items():
+        if key == base:
+            layouts.setdefault(1, {})[0] = parse_checkpoint(value)
+            continue
+        match = re.fullmatch(rf"{re.escape(base)}:p(\d+)of(\d+)", key)
+        if match:
+            layouts.setdefault(int(match.group(2)), {})[int(match.group(1))] = parse_checkpoint(value)
+
+    def order(checkpoint: Tuple[str, Optional[str]]) -> tuple:
+        modified = datetime.fromisoformat(checkpoint[0])
+        if modified.tzinfo is None:
+            modified = modified.replace(tzinfo=timezone.utc)
+        return modified, checkpoint[1] or ""
+
+    candidates = [
+        min(checkpoints.values(), key=order)
+        for total, checkpoints in layouts.items()
+        if total != partitions and len(checkpoints) == total
+    ]
+    return max(candidates, key=order, default=None)
+
+
+def seed_checkpoint(state: State, entity: str, alias: str, index_name: str,
+                    partition: Optional[Tuple[int, int]] = None) -> Optional[Tuple[str, Optional[str]]]:
+    """Контрольная точка процесса; при её отсутствии — перенесённая из прежней раскладки партиций.
+
+    Без переноса смена settings.filmwork_partitions начинала бы все партиции с default_sync_time
+    и перезагружала индекс целиком.
+    """
+    key = checkpoint_key(entity, alias, index_name, partition)
+    checkpoint = state.get_checkpoint(key)
+    if checkpoint is not None:
+        return checkpoint
+    checkpoint = previous_layout_checkpoint(
+        state.storage.retrieve_state(), entity, alias, index_name, partition[1] if partition else 1)
+    if checkpoint is not None:
+        state.set_state(key, json.dumps({"modified": checkpoint[0], "id": checkpoint[1]}))
+        logger.info(f"Контрольная точка {key} перенесена из прежней раскладки партиций: {checkpoint[0]}")
+    return checkpoint
+
+
+def parse_checkpoint(value: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+    """Разобрать сохранённую контрольную точку (modified, id).
+
+    Для ключей старого формата, где хранилась только дата, id равен None.
+    """
+    if value is None:
+        return None
+    try:
+        checkpoint = json.loads(value)
+    except ValueError:
+        return value, None
+    return checkpoint["modified"], checkpoint["id"]
+
+
+def parse_log_position(value: Optional[str]) -> Tuple[str, int]:
+    """Разобрать позицию в журнале изменений (xid, seq).
+
+    Ключи старого формата хранили только seq: журнал читается с начала,
+    повторная обработка его записей безопасна.
+    """
+    if not value or ":" not in str(value):
+        return "0", 0
+    xid, seq = str(value).split(":")
+    return xid, int(seq)
+
+
+def format_log_position(xid: str, seq: int) -> str:
+    return f"{xid}:{seq}"
 
 
 
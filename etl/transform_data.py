@@ -1,63 +1,88 @@
-from typing import Generator, List
+from typing import Generator, List, Optional
 
 from state import *
 from get_connections import *
 
 
-def transform_filmwork(records: List[dict]) -> Generator[dict, None, None]:
-    """Преобразование данных в формат для Elasticsearch."""
+# Добавление и удаление id фильмов в movies документа persons без пересчёта всей фильмографии
+PERSON_MOVIES_SCRIPT = """
+if (ctx._source.movies == null) { ctx._source.movies = []; }
+ctx._source.movies.removeIf(id -> params.remove.contains(id));
+for (id in params.add) { if (!ctx._source.movies.contains(id)) { ctx._source.movies.add(id); } }
+"""
+
+# Позиции колонок FILMWORK_SELECT. transform_filmwork обращается к строке только по индексу,
+# поэтому принимает DictRow, asyncpg.Record, tuple и namedtuple.
+FW_ID, FW_TITLE, FW_DESCRIPTION, FW_IMDB_RATING, FW_TYPE, FW_CREATED, FW_MODIFIED, FW_PERSONS, FW_GENRES = range(9)
+
+
+def transform_filmwork(records: List[dict],
+                       index_name: Optional[str] = None) -> Generator[dict, None, None]:
+    """Преобразование данных в формат для Elasticsearch.
+
+    Персоналии раскладываются по ролям за один проход по record[FW_PERSONS].
+    index_name задаёт версию индекса для записи, по умолчанию используется алиас из настроек.
+    """
+    index_name = index_name or settings.filmwork_index_name
     for record in records:
         try:
+            directors_names, actors_names, writers_names = [], [], []
+            directors, actors, writers = [], [], []
+            roles = {
+                "director": (directors_names, directors),
+                "actor": (actors_names, actors),
+                "writer": (writers_names, writers),
+            }
+            for person in record[FW_PERSONS]:
+                role = roles.get(person["person_role"])
+                if role is not None:
+                    name = person["person_name"]
+                    role[0].append(name)
+                    role[1].append({"id": person["person_id"], "name": name})
+
+            film_work_id = record[FW_ID]
             yield {
-                "_index": settings.filmwork_index_name,
-                "_id": record["id"],
+                "_index": index_name,
+                "_id": film_work_id,
                 "_source": {
-                    "id": record["id"],
-                    "imdb_rating": record["imdb_rating"],
-                    "genres": record["genres"],
-                    "title": record["title"],
-                    "description": record["description"],
-                    "directors_names": [
-                        person["person_name"]
-                        for person in record["persons"]
-                        if person["person_role"] == "director"
-                    ],
-                    "actors_names": [
-                        person["person_name"]
-                        for person in record["persons"]
-                        if person["person_role"] == "actor"
-                    ],
-                    "writers_names": [
-                        person["person_name"]
-                        for person in record["persons"]
-                        if person["person_role"] == "writer"
-                    ],
-                    "directors": [
-                        {"id": person["person_id"], "name": person["person_name"]}
-                        for person in record["persons"]
-                        if person["person_role"] == "director"
-                    ],
-                    "actors": [
-                        {"id": person["person_id"], "name": person["person_name"]}
-                        for person in record["persons"]
-                        if person["person_role"] == "actor"
-                    ],
-                    "writers": [
-                        {"id": person["person_id"], "name": person["person_name"]}
-                        for person in record[7]
-                        if person["person_role"] == "writer"
-                    ],
+                    "id": film_work_id,
+                    "imdb_rating": record[FW_IMDB_RATING],
+                    # array_agg по LEFT JOIN даёт [NULL] для фильма без жанров, снимок и PostgreSQL — []
+                    "genres": [genre for genre in record[FW_GENRES] if genre is not None],
+                    "title": record[FW_TITLE],
+                    "description": record[FW_DESCRIPTION],
+                    "directors_names": directors_names,
+                    "actors_names": actors_names,
+                    "writers_names": writers_names,
+                    "directors": directors,
+                    "actors": actors,
+                    "writers": writers,
                 },
             }
         except IndexError as e:
             logger.error(f"Ошибка обработки записи: {record} - {str(e)}")
 
 
-def transform_genres(records: List[dict]) -> Generator[dict, None, None]:
+def transform_filmwork_documents(records: List[dict],
+                                 index_name: Optional[str] = None) -> Generator[dict, None, None]:
+    """Действия bulk для документов фильмов, собранных в PostgreSQL (FILMWORK_DOCUMENT_SELECT).
+
+    _source передаётся строкой JSON: helpers.bulk отправляет её как есть, без повторной сериализации.
+    """
+    index_name = index_name or settings.filmwork_index_name
+    for record in records:
+        yield {
+            "_index": index_name,
+            "_id": record[0],
+            "_source": record[2],
+        }
+
+
+def transform_genres(records: List[dict], index_name: Optional[str] = None) -> Generator[dict, None, None]:
     """Преобразование данных жанров в формат для Elasticsearch."""
     for record in records:
         yield {
-            "_index": settings.genres_index_name,
+            "_index": index_name or settings.genres_index_name,
             "_id": record["name"],
             "_source": {
                 "id": record["id"],
@@ -66,15 +91,70 @@ def transform_genres(records: List[dict]) -> Generator[dict, None, None]:
         }
 
 
-def transform_persons(records: List[Dict[str, Any]]) -> Generator[Dict[str, Any], None, None]:
+def transform_persons(records: List[Dict[str, Any]],
+                      index_name: Optional[str] = None) -> Generator[Dict[str, Any], None, None]:
     """Преобразование данных персоналий в формат для Elasticsearch."""
     for record in records:
         yield {
-            "_index": settings.persons_index_name,
-            "_id": record["person_id"],
+            "_index": index_name or settings.persons_index_name,
+            "_id": record["id"],
             "_source": {
-                "id": record["person_id"],
+                "id": record["id"],
                 "full_name": record["full_name"],
                 "movies": record["movies"]
             }
-        }
\ No newline at end of file
+        }
+
+
+def transform_persons_names(records: List[Dict[str, Any]],
+                            index_name: Optional[str] = None) -> Generator[Dict[str, Any], None, None]:
+    """Частичное обновление имени персоналии; movies ведёт transform_person_movies."""
+    for record in records:
+        yield {
+            "_op_type": "update",
+            "_index": index_name or settings.persons_index_name,
+            "_id": record["id"],
+            "doc": {
+                "id": record["id"],
+                "full_name": record["full_name"],
+            },
+            "doc_as_upsert": True,
+        }
+
+
+def transform_person_movies(records: List[Dict[str, Any]],
+                            index_name: Optional[str] = None) -> Generator[Dict[str, Any], None, None]:
+    """Scripted update movies персоналий по изменениям связей (PERSON_FILM_WORK_CHANGES_QUERY).
+
+    Изменения группируются по персоналии. Если фильмы только удаляются, документ не создаётся:
+    отсутствующая персоналия удалена или ещё не загружена целиком.
+    """
+    changes = {}
+    for record in records:
+        add, remove = changes.setdefault(record["person_id"], ([], []))
+        (add if record["linked"] else remove).append(record["film_work_id"])
+
+    for person_id, (add, remove) in changes.items():
+        action = {
+            "_op_type": "update",
+            "_index": index_name or settings.persons_index_name,
+            "_id": person_id,
+            "script": {
+                "source": PERSON_MOVIES_SCRIPT,
+                "lang": "painless",
+                "params": {"add": add, "remove": remove},
+            },
+        }
+        if add:
+            action["upsert"] = {"id": person_id, "movies": add}
+        yield action
+
+
+def transform_deletes(doc_ids: List[str], index_name: str) -> Generator[Dict[str, Any], None, None]:
+    """Действия bulk delete для документов удалённых строк."""
+    for doc_id in doc_ids:
+        yield {
+            "_op_type": "delete",
+            "_index": index_name,
+            "_id": doc_id,
+        }
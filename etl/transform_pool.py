@@ -0,0 +1,82 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Generator, Iterator, List, Optional, Tuple
+
+from state import *
+from settings import *
+from get_connections import get_json_serializer
+
+_serializer = get_json_serializer()
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def serialize_actions(actions: Iterator[dict]) -> bytes:
+    """Тело bulk-запроса в формате NDJSON: строка метаданных index и строка _source на документ.
+
+    Кодирование то же, что у клиента Elasticsearch (settings.es_serializer); _source-строка (готовый JSON) передаётся как есть.
+    """
+    buffer = bytearray()
+    for action in actions:
+        buffer += _serializer.dumps({"index": {"_index": action["_index"], "_id": action["_id"]}})
+        buffer += b"\n"
+        source = action["_source"]
+        buffer += source.encode("utf-8") if isinstance(source, str) else _serializer.dumps(source)
+        buffer += b"\n"
+    return bytes(buffer)
+
+
+def transform_to_ndjson(transform: Callable, records: List[tuple], index_name: str) -> bytes:
+    """Задача процесса пула: transform пачки строк и сериализация результата в NDJSON."""
+    return serialize_actions(transform(records, index_name))
+
+
+def get_transform_pool() -> ProcessPoolExecutor:
+    """Общий для процесса ETL пул процессов transform (settings.transform_workers процессов).
+
+    Процессы запускаются через spawn: fork процесса с потоками ETL может унаследовать захваченные блокировки.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.transform_workers, mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"Пул transform из {settings.transform_workers} процессов запущен")
+        return _pool
+
+
+def transform_batches(stream: Iterator[List[tuple]], transform: Callable,
+                      index_name: str) -> Generator[Tuple[List[tuple], float, float, bytes], None, None]:
+    """Параллельный transform пачек из stream в пуле процессов.
+
+    Вперёд читается до settings.transform_workers пачек, результаты отдаются строго
+    в порядке пачек: (пачка строк, время extract, время ожидания transform в секундах, NDJSON). Порядок нужен
+    для контрольной точки: она сохраняется только после загрузки всех предыдущих пачек.
+    Строки передаются процессам кортежами, поэтому transform должен обращаться к колонкам по индексу.
+    """
+    pool = get_transform_pool()
+    pending = deque()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < settings.transform_workers:
+                started = time.perf_counter()
+                records = next(stream, None)
+                extract_time = time.perf_counter() - started
+                if records is None:
+                    exhausted = True
+                    break
+                future = pool.submit(transform_to_ndjson, transform, [tuple(record) for record in records], index_name)
+                pending.append((records, extract_time, future))
+            if not pending:
+                return
+            records, extract_time, future = pending.popleft()
+            started = time.perf_counter()
+            body = future.result()
+            yield records, extract_time, time.perf_counter() - started, body
+    finally:
+        for _, _, future in pending:
+            future.cancel()